@@ -0,0 +1,86 @@
+"""
+Compare the throughput of `Prompt.text_many` with calling `Prompt.text` in a loop, and of the
+thread and process executors on a CPU-bound template.
+
+Run with:
+
+    python benchmarks/batch_rendering.py [--items N]
+"""
+
+import argparse
+import time
+
+from banks import Prompt
+
+TEMPLATE = """
+{% chat role="system" %}You are a helpful assistant working for {{ company }}.{% endchat %}
+{% chat role="user" %}
+Write a short answer to the following question from {{ user.name }}:
+{{ question }}
+{% for item in history %}
+- {{ item }}
+{% endfor %}
+{% endchat %}
+"""
+
+# Large loops keep rendering CPU-bound, where only worker processes scale
+CPU_BOUND_TEMPLATE = """
+{% for i in range(2000) %}{{ (i * seed) % 7 }}{% endfor %}
+"""
+
+
+def contexts(n: int):
+    for i in range(n):
+        yield {
+            "company": "ACME",
+            "user": {"name": f"user-{i}"},
+            "question": f"What is the answer to question number {i}?",
+            "history": [f"previous message {j}" for j in range(10)],
+        }
+
+
+def measure(label: str, func) -> None:
+    start = time.perf_counter()
+    count = sum(1 for _ in func())
+    elapsed = time.perf_counter() - start
+    print(f"{label:<45} {count / elapsed:>10.0f} renders/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=20_000)
+    args = parser.parse_args()
+    n = args.items
+
+    measure("text() loop, new Prompt per call", lambda: (Prompt(TEMPLATE).text(c) for c in contexts(n)))
+    p = Prompt(TEMPLATE)
+    measure("text() loop, same prompt", lambda: (p.text(c) for c in contexts(n)))
+    p = Prompt(TEMPLATE)
+    measure("text_many()", lambda: p.text_many(contexts(n)))
+    p = Prompt(TEMPLATE)
+    measure("text_many(use_cache=False)", lambda: p.text_many(contexts(n), use_cache=False))
+    p = Prompt(TEMPLATE)
+    measure(
+        "text_many(use_cache=False, max_workers=4)",
+        lambda: p.text_many(contexts(n), use_cache=False, max_workers=4),
+    )
+    p = Prompt(TEMPLATE)
+    measure("chat_messages() loop", lambda: (p.chat_messages(c) for c in contexts(n)))
+    p = Prompt(TEMPLATE)
+    measure("chat_messages_many(use_cache=False)", lambda: p.chat_messages_many(contexts(n), use_cache=False))
+
+    print()
+    print("CPU-bound template")
+    n = max(n // 20, 1)
+    cpu_contexts = [{"seed": i} for i in range(n)]
+    p = Prompt(CPU_BOUND_TEMPLATE)
+    measure("text() loop", lambda: (p.text(c) for c in cpu_contexts))
+    measure("text_many(max_workers=4)", lambda: p.text_many(cpu_contexts, use_cache=False, max_workers=4))
+    measure(
+        "text_many(executor='process')",
+        lambda: p.text_many(cpu_contexts, use_cache=False, executor="process", chunk_size=16),
+    )
+
+
+if __name__ == "__main__":
+    main()
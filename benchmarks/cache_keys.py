@@ -0,0 +1,46 @@
+"""
+Compare the time taken to key the render cache with the pickle of the context and with
+`HashFingerprint`, on small contexts, contexts carrying a large image and nested contexts.
+
+Run with:
+
+    python benchmarks/cache_keys.py [--repeat N]
+"""
+
+import argparse
+import time
+
+from banks.cache import HashFingerprint, pickle_fingerprint
+
+
+def measure(label: str, func, repeat: int) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<30} {elapsed / repeat * 1_000_000:>12.1f} us")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    image = bytes(5 * 1024 * 1024)
+    contexts = {
+        "small": {"topic": "retrogame computing", "words": 500},
+        "5 MB image": {"question": "What's in this picture?", "picture": image},
+        "nested": {"history": [{"role": "user", "content": f"message {i}"} for i in range(200)]},
+    }
+    for name, context in contexts.items():
+        print(name)
+        measure("  pickle", lambda c=context: pickle_fingerprint(c), args.repeat)
+        measure("  hash", lambda c=context: HashFingerprint()(c), args.repeat)
+        fingerprint = HashFingerprint()
+        fingerprint(context)
+        measure("  hash, memoized", lambda c=context, f=fingerprint: f(c), args.repeat)
+        print(f"  key size: pickle {len(pickle_fingerprint(context))} bytes, hash {len(fingerprint(context))} bytes")
+
+
+if __name__ == "__main__":
+    main()
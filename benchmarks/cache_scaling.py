@@ -0,0 +1,63 @@
+"""
+Measure the render throughput of a prompt shared by 1 to N threads, with the render cache being
+a `DefaultCache`, guarded by a single lock, or a `ShardedCache`.
+
+Most renders hit the cache, so the throughput is bound by the cache lookups. With the GIL only
+one thread runs at a time and neither cache scales, run it on a free-threaded build of Python
+(`python3.13t`) to see the difference sharding makes.
+
+Run with:
+
+    python benchmarks/cache_scaling.py [--threads N] [--renders N] [--contexts N]
+"""
+
+import argparse
+import random
+import sys
+import threading
+import time
+
+from banks import Prompt
+from banks.cache import DefaultCache, RenderCache, ShardedCache
+
+
+def throughput(cache: RenderCache, threads: int, renders: int, contexts: int) -> float:
+    p = Prompt("Write a {{ words }}-word blog post on {{ topic }}.", render_cache=cache)
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(seed: int) -> None:
+        rng = random.Random(seed)
+        barrier.wait()
+        for _ in range(renders):
+            p.text({"topic": f"topic {rng.randrange(contexts)}", "words": 500})
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    return threads * renders / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--renders", type=int, default=20000, help="Renders per thread")
+    parser.add_argument("--contexts", type=int, default=1000, help="Distinct contexts rendered")
+    args = parser.parse_args()
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}")
+    print(f"{'threads':>8} {'DefaultCache':>16} {'ShardedCache':>16}   renders/s")
+    threads = 1
+    while threads <= args.threads:
+        default = throughput(DefaultCache(), threads, args.renders, args.contexts)
+        sharded = throughput(ShardedCache(), threads, args.renders, args.contexts)
+        print(f"{threads:>8} {default:>16,.0f} {sharded:>16,.0f}")
+        threads *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare `Prompt.chat_messages` going through the JSON lines of the rendered text with the
+structured render, where the `chat` tags hand over the message objects directly, and cache hits
+parsing the cached text with those served from the cached messages. Cached messages pay off
+with large contents, like the inline media of `--image-size`, whose strings copies can share.
+
+Run with:
+
+    python benchmarks/chat_messages.py [--messages N] [--repeat N] [--image-size BYTES]
+"""
+
+import argparse
+import base64
+import time
+
+from banks import Prompt
+from banks.cache import SharedCache
+
+TEMPLATE = """
+{% chat role="system" %}You are a helpful assistant.{% endchat %}
+{% for m in history %}
+{% if m.user %}{% chat role="user" %}{{ m.content }}{% if image %} {{ image | image }}{% endif %}{% endchat %}
+{% else %}{% chat role="assistant" %}{{ m.content }}{% endchat %}{% endif %}
+{% endfor %}
+"""
+
+
+def measure(label: str, func, repeat: int) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<30} {elapsed / repeat * 1000:>10.2f} ms/render")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--image-size", type=int, default=0, help="Attach an image this large to user messages")
+    args = parser.parse_args()
+
+    history = [
+        {"user": i % 2 == 1, "content": f"Message number {i}, with some text in it. " * 5} for i in range(args.messages)
+    ]
+    image = ""
+    if args.image_size:
+        image = "data:image/png;base64," + base64.b64encode(b"\x89PNG" + b"x" * args.image_size).decode()
+    p = Prompt(TEMPLATE)
+
+    def json_lines():
+        # Every call renders, as it would with a different context each time
+        p._render_cache.clear()
+        return p.chat_messages({"history": history, "image": image})
+
+    def structured():
+        return p.chat_messages({"history": history, "image": image}, structured=True)
+
+    # SharedCache only stores the text, hits parse it again
+    text_only = Prompt(TEMPLATE, render_cache=SharedCache())
+    text_only.chat_messages({"history": history, "image": image})
+    p.chat_messages({"history": history, "image": image})
+
+    print(f"{args.messages} messages")
+    measure("chat_messages()", json_lines, args.repeat)
+    measure("chat_messages(structured=True)", structured, args.repeat)
+    measure("cache hit, text", lambda: text_only.chat_messages({"history": history, "image": image}), args.repeat)
+    measure("cache hit, messages", lambda: p.chat_messages({"history": history, "image": image}), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Measure the render time of a prompt with several `{% completion %}` blocks, with the blocks
+calling the LLM one after the other or the independent ones being prefetched.
+
+The LLM is replaced by a stub answering after `--latency` seconds, so nothing is sent over the
+network. The template has `--blocks` independent blocks and a last one summing up their
+responses, which has to wait for them: prefetched, the render takes about two calls.
+
+Run with:
+
+    python benchmarks/completion_prefetch.py [--blocks N] [--latency SECONDS] [--repeat N]
+"""
+
+import argparse
+import time
+from unittest import mock
+
+from litellm.types.utils import Choices, Message, ModelResponse
+
+from banks import Prompt
+from banks.config import config
+
+
+def template(blocks: int) -> str:
+    text = ""
+    for i in range(blocks):
+        text += (
+            f'{{% set r{i} %}}{{% completion model="stub" %}}'
+            f'{{% chat role="user" %}}Write about {{{{ topic }}}}, take {i}{{% endchat %}}'
+            "{% endcompletion %}{% endset %}\n"
+        )
+    responses = " ".join(f"{{{{ r{i} }}}}" for i in range(blocks))
+    return (
+        text
+        + '{% set summary %}{% completion model="stub" %}'
+        + f'{{% chat role="user" %}}Sum up: {responses}{{% endchat %}}'
+        + "{% endcompletion %}{% endset %}\n{{ summary }}"
+    )
+
+
+def measure(label: str, text: str, latency: float, repeat: int) -> None:
+    def completion(**_):
+        time.sleep(latency)
+        return ModelResponse(choices=[Choices(message=Message(content="ok", role="assistant"))])
+
+    with mock.patch("litellm.completion", side_effect=completion):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            # A new prompt each time, so that the render cache doesn't serve the render
+            Prompt(text).text({"topic": "retrogame computing"})
+        elapsed = time.perf_counter() - start
+    print(f"{label:<12} {elapsed / repeat * 1000:>10.1f} ms/render")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=4, help="Independent completion blocks")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the stub LLM takes to respond")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    text = template(args.blocks)
+    config.COMPLETION_PREFETCH_ENABLED = False
+    measure("sequential", text, args.latency, args.repeat)
+    config.COMPLETION_PREFETCH_ENABLED = True
+    measure("prefetched", text, args.latency, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure `chat_message_from_text` on small messages, messages carrying megabytes of base64 image
+data and messages made of many blocks, along with how long splitting the content takes with
+the scanner compared to the regular expression it replaced.
+
+Run with:
+
+    python benchmarks/content_blocks.py [--repeat N]
+"""
+
+import argparse
+import base64
+import re
+import time
+
+from banks.types import (
+    CONTENT_BLOCK_END,
+    ContentBlock,
+    _scan_content_blocks,
+    chat_message_from_text,
+    content_block_start,
+)
+from banks.utils import generate_sentinel
+
+SENTINEL = generate_sentinel()
+
+
+def regex_split(content: str) -> list:
+    """The regular expression `chat_message_from_text` used to split content with."""
+    start = re.escape(content_block_start(SENTINEL))
+    end = re.escape(CONTENT_BLOCK_END)
+    return list(re.finditer(rf"({start}\{{.*?\}}{end})|((?:(?!{start})[\s\S])+)", content))
+
+
+def scanner_split(content: str) -> list:
+    return list(_scan_content_blocks(content, SENTINEL))
+
+
+def image_block(size: int) -> str:
+    data = base64.b64encode(bytes(size)).decode()
+    block = ContentBlock.model_validate({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{data}"}})
+    return content_block_start(SENTINEL) + block.model_dump_json() + CONTENT_BLOCK_END
+
+
+def measure(label: str, func, repeat: int) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / repeat * 1000:>10.3f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    cases = {
+        "small": "Describe this picture, please: " + image_block(100),
+        "large (4 MB of image data)": "Describe this picture:\n" + image_block(3 * 1024 * 1024) + "\nThanks!",
+        "large text (4 MB, no blocks)": "Some text. " * 400_000,
+        "many blocks (1000)": "\n".join(f"Picture {i}: {image_block(100)}" for i in range(1000)),
+    }
+    for name, content in cases.items():
+        print(name)
+        measure("  regex split", lambda c=content: regex_split(c), args.repeat)
+        measure("  scanner split", lambda c=content: scanner_split(c), args.repeat)
+        measure(
+            "  chat_message_from_text",
+            lambda c=content: chat_message_from_text(role="user", content=c, sentinel=SENTINEL),
+            args.repeat,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+from __future__ import annotations
+
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+DEFAULT_CHUNK_SIZE = 64
+
+
+def chunked(items: Iterable[T], chunk_size: int) -> Iterator[list[T]]:
+    """Split `items` into lists of `chunk_size` elements, the last one possibly shorter."""
+    if chunk_size < 1:
+        msg = f"chunk_size must be a positive number, got {chunk_size}"
+        raise ValueError(msg)
+
+    it = iter(items)
+    while chunk := list(islice(it, chunk_size)):
+        yield chunk
+
+
+def map_chunks(
+    func: Callable[[list[T]], list[R]],
+    items: Iterable[T],
+    *,
+    max_workers: int | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    executor_factory: Callable[[int], Executor] = ThreadPoolExecutor,
+) -> Iterator[R]:
+    """
+    Apply `func` to `items` a chunk at a time, yielding the results in the same order as `items`.
+
+    With `max_workers`, chunks are processed by the pool of workers that `executor_factory`
+    creates, a pool of threads by default. Only a couple of chunks per worker are in flight at
+    any time, so `items` is consumed as results are, instead of being submitted to the pool all
+    at once.
+    """
+    chunks = chunked(items, chunk_size)
+    if max_workers is None:
+        for chunk in chunks:
+            yield from func(chunk)
+        return
+
+    executor = executor_factory(max_workers)
+    pending: deque[Future[list[R]]] = deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(func, chunk))
+            if len(pending) >= 2 * max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        # Work still queued when the caller stops iterating early is not needed anymore
+        executor.shutdown(wait=True, cancel_futures=True)
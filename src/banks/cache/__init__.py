@@ -0,0 +1,720 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+import asyncio
+import base64
+import hashlib
+import inspect
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple, Optional, Protocol, Union, runtime_checkable
+
+from pydantic import BaseModel
+
+from banks.cache.codecs import IDENTITY, default_codec, get_codec
+from banks.config import config
+from banks.utils import SENTINEL_VAR
+
+if TYPE_CHECKING:
+    from banks.types import ChatMessage
+
+# Computes the key of a context in a render cache, None meaning the context can't be cached
+Fingerprint = Callable[[dict], Optional[bytes]]
+
+# Key context variable identifying the template, so that a cache can be shared by different prompts
+TEMPLATE_KEY = "_banks_template"
+
+
+class CacheStats(NamedTuple):
+    """Counters describing the state of a render cache."""
+
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    bytes: int
+
+
+@runtime_checkable
+class RenderCache(Protocol):  # pragma: no cover
+    """
+    Interface for rendering cache.
+
+    Prompts with the same template and same context are retrieved from the cache directly,
+    instead of going through the rendering process.
+    """
+
+    def get(self, context: dict) -> Optional[str]: ...
+
+    def set(self, context: dict, prompt: str) -> None: ...
+
+    def clear(self) -> None: ...
+
+    def stats(self) -> CacheStats: ...
+
+
+@runtime_checkable
+class BatchRenderCache(RenderCache, Protocol):  # pragma: no cover
+    """
+    Interface for rendering caches that can look up and store many renders at once.
+
+    Batch renders go through these methods, saving a round trip per prompt with remote caches.
+    """
+
+    def get_many(self, contexts: list[dict]) -> list[Optional[str]]: ...
+
+    def set_many(self, items: list[tuple[dict, str]]) -> None: ...
+
+
+@runtime_checkable
+class MessagesRenderCache(RenderCache, Protocol):  # pragma: no cover
+    """
+    Interface for rendering caches that also keep the chat messages parsed out of their renders.
+
+    Chat messages served from the cache skip parsing. The returned messages are the stored ones,
+    prompts hand out copies of them. Messages are meant to be kept in memory, `AsyncPrompt` looks
+    them up without offloading the call.
+    """
+
+    def get_messages(self, context: dict) -> Optional[Sequence["ChatMessage"]]: ...
+
+    def set_messages(self, context: dict, messages: Sequence["ChatMessage"]) -> None: ...
+
+
+@runtime_checkable
+class AsyncRenderCache(Protocol):  # pragma: no cover
+    """
+    Interface for rendering caches used from async code.
+
+    `AsyncPrompt` awaits caches implementing this interface, so that looking up a render in a
+    remote cache doesn't block the event loop.
+    """
+
+    async def get(self, context: dict) -> Optional[str]: ...
+
+    async def set(self, context: dict, prompt: str) -> None: ...
+
+    async def clear(self) -> None: ...
+
+
+def is_async_cache(cache: object) -> bool:
+    """Return whether `cache` implements `AsyncRenderCache` rather than `RenderCache`."""
+    return inspect.iscoroutinefunction(getattr(cache, "get", None))
+
+
+class AsyncCacheAdapter:
+    """
+    Make a `RenderCache` usable as an `AsyncRenderCache`.
+
+    Calls to the wrapped cache run in `executor`, the default executor of the event loop if not
+    passed, so that caches doing I/O don't block the loop. With `offload=False` they run inline
+    instead, which is faster for in-memory caches.
+
+    Parameters:
+        cache: The cache to wrap.
+        executor: The pool of threads the calls to `cache` run in.
+        offload: Whether to run the calls to `cache` in `executor` at all.
+    """
+
+    def __init__(self, cache: RenderCache, *, executor: Optional[Executor] = None, offload: bool = True) -> None:
+        self.cache = cache
+        self.executor = executor
+        self.offload = offload
+
+    async def _call(self, func: Callable[..., Any], *args: Any) -> Any:
+        if not self.offload:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def get(self, context: dict) -> Optional[str]:
+        return await self._call(self.cache.get, context)
+
+    async def set(self, context: dict, prompt: str) -> None:
+        await self._call(self.cache.set, context, prompt)
+
+    async def clear(self) -> None:
+        await self._call(self.cache.clear)
+
+    async def stats(self) -> CacheStats:
+        return await self._call(self.cache.stats)
+
+
+def pickle_fingerprint(context: dict) -> Optional[bytes]:
+    """Key contexts with their pickle, as the render cache used to."""
+    try:
+        return pickle.dumps(context, pickle.HIGHEST_PROTOCOL)
+    except Exception:  # pylint: disable=broad-exception-caught
+        # Anything can fail while pickling arbitrary objects
+        return None
+
+
+class _HashWriter:
+    """File-like object feeding what's written to it into a hash, for `pickle.Pickler`."""
+
+    def __init__(self, h: Any) -> None:
+        self.write = h.update
+
+
+# How much of a large string is encoded to UTF-8 at a time to be hashed
+_HASH_CHUNK_SIZE = 64 * 1024
+
+
+class HashFingerprint:
+    """
+    Key contexts with a fixed-size digest of their content.
+
+    Contexts holding a large `bytes` or `str` value at the top level are pickled straight into the
+    hash, so the pickle is never held in memory. Large `bytes` values are hashed in place, large
+    `str` values a chunk of UTF-8 at a time, so that neither is copied whole, and their digests
+    are memoized so that the same image passed to many renders is only hashed once. Other
+    contexts are small enough to be hashed out of their pickle, which is faster. A context holding
+    anything that can't be pickled is not cached.
+
+    Parameters:
+        memo_size: How many large values to remember the digest of. The memo keeps them alive.
+        memo_threshold: The size above which the digest of a value is memoized.
+        memo_max_bytes: How much memory the values kept alive by the memo can take, values
+            taking more than that on their own aren't memoized. Defaults to
+            `config.RENDER_CACHE_MEMO_MAX_BYTES`.
+    """
+
+    def __init__(
+        self, memo_size: int = 64, memo_threshold: int = 64 * 1024, memo_max_bytes: Optional[int] = None
+    ) -> None:
+        self.memo_size = memo_size
+        self.memo_threshold = memo_threshold
+        self.memo_max_bytes = config.RENDER_CACHE_MEMO_MAX_BYTES if memo_max_bytes is None else memo_max_bytes
+        # id -> (value, digest, size), the value being kept so that its id can't be reused
+        self._memo: OrderedDict[int, tuple[Any, bytes, int]] = OrderedDict()
+        self._memo_bytes = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, context: dict) -> Optional[bytes]:
+        threshold = self.memo_threshold
+        try:
+            for value in context.values():
+                t = type(value)
+                if (t is bytes or t is str) and len(value) >= threshold:
+                    return self._hash_items(context)
+
+            # Without large values, pickling the whole context at once is much faster than item
+            # by item, and the pickle is small. The tag is a byte no pickle starts with, keeping
+            # apart the encodings of both ways.
+            data = pickle.dumps(context, pickle.HIGHEST_PROTOCOL)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Anything can fail while pickling arbitrary objects
+            return None
+        h = hashlib.sha256(b"p")
+        h.update(data)
+        return h.digest()
+
+    def _hash_items(self, context: dict) -> Optional[bytes]:
+        h = hashlib.sha256()
+        pickler = pickle.Pickler(_HashWriter(h), pickle.HIGHEST_PROTOCOL)  # type: ignore[arg-type]
+        try:
+            # Every pickle ends with a STOP opcode, and a memoized digest is tagged with a byte
+            # no pickle starts with, so the encoding of different contexts can't collide.
+            for name, value in context.items():
+                pickler.dump(name)
+                t = type(value)
+                if (t is bytes or t is str) and len(value) >= self.memo_threshold:
+                    h.update(b"m" if t is bytes else b"M")
+                    h.update(self._digest(value))
+                else:
+                    pickler.dump(value)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Anything can fail while pickling arbitrary objects
+            return None
+        return h.digest()
+
+    def _digest(self, value: Union[str, bytes]) -> bytes:
+        with self._lock:
+            entry = self._memo.get(id(value))
+            if entry is not None and entry[0] is value:
+                self._memo.move_to_end(id(value))
+                return entry[1]
+
+        if isinstance(value, str):
+            h = hashlib.sha256()
+            for start in range(0, len(value), _HASH_CHUNK_SIZE):
+                h.update(value[start : start + _HASH_CHUNK_SIZE].encode("utf-8", "surrogatepass"))
+            digest = h.digest()
+        else:
+            digest = hashlib.sha256(memoryview(value)).digest()
+
+        size = sys.getsizeof(value)
+        if self.memo_size and size <= self.memo_max_bytes:
+            with self._lock:
+                previous = self._memo.pop(id(value), None)
+                if previous is not None:
+                    self._memo_bytes -= previous[2]
+                self._memo[id(value)] = (value, digest, size)
+                self._memo_bytes += size
+                while len(self._memo) > self.memo_size or self._memo_bytes > self.memo_max_bytes:
+                    _, (_, _, evicted) = self._memo.popitem(last=False)
+                    self._memo_bytes -= evicted
+        return digest
+
+
+class DefaultCache:  # pylint: disable=too-many-instance-attributes
+    """
+    In-memory, default rendering cache.
+
+    The cache is bounded by number of entries and by the bytes taken by the keys and the stored
+    prompts: when either bound is exceeded, the least recently used entries are evicted. With a
+    `ttl`, entries also expire that many seconds after being stored. Bounds not passed are read
+    from the config, and a bound of 0 means no limit.
+
+    Contexts are keyed by `fingerprint`, a `HashFingerprint` unless another strategy is passed.
+
+    The chat messages parsed out of a render can be stored along with it, counting towards
+    `max_bytes`, and are evicted with it.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        fingerprint: Optional[Fingerprint] = None,
+    ) -> None:
+        self.max_entries = config.RENDER_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.max_bytes = config.RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.ttl = config.RENDER_CACHE_TTL if ttl is None else ttl
+        self.fingerprint = fingerprint or default_fingerprint
+        self._cache: OrderedDict[bytes, str] = OrderedDict()
+        # Messages parsed out of the stored prompts, along with their size
+        self._messages: dict[bytes, tuple[tuple[ChatMessage, ...], int]] = {}
+        # Expiry time of each entry in the order they were stored, only filled when entries have a TTL
+        self._expires: dict[bytes, float] = {}
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, context: dict) -> Optional[str]:
+        return self.get_by_key(self.fingerprint(context))
+
+    def get_messages(self, context: dict) -> Optional[Sequence["ChatMessage"]]:
+        """Return the messages stored along with the render of `context`, if any."""
+        return self.get_messages_by_key(self.fingerprint(context))
+
+    def set(self, context: dict, prompt: str) -> None:
+        self.set_by_key(self.fingerprint(context), prompt)
+
+    def set_messages(self, context: dict, messages: Sequence["ChatMessage"]) -> None:
+        """Store the messages parsed out of the render of `context`, if the render is still stored."""
+        self.set_messages_by_key(self.fingerprint(context), messages)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache = OrderedDict()
+            self._messages = {}
+            self._expires = {}
+            self._bytes = 0
+
+    def stats(self) -> CacheStats:
+        """Return hit, miss and eviction counters along with the number of entries and their size in bytes."""
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._cache), self._bytes)
+
+    def get_by_key(self, key: Optional[bytes]) -> Optional[str]:
+        """Like `get`, taking the fingerprint of the context, so that callers compute it once."""
+        with self._lock:
+            if key is None or not self._lookup(key):
+                self._misses += 1
+                return None
+            self._hits += 1
+            return self._cache[key]
+
+    def get_messages_by_key(self, key: Optional[bytes]) -> Optional[Sequence["ChatMessage"]]:
+        """Like `get_messages`, taking the fingerprint of the context."""
+        with self._lock:
+            if key is None or not self._lookup(key) or key not in self._messages:
+                # Not a miss yet, the render is looked up next
+                return None
+            self._hits += 1
+            return self._messages[key][0]
+
+    def set_by_key(self, key: Optional[bytes], prompt: str) -> None:
+        """Like `set`, taking the fingerprint of the context."""
+        if key is None:
+            return
+        size = _entry_size(key, prompt)
+        with self._lock:
+            if key in self._cache:
+                self._remove(key)
+            if self.max_bytes and size > self.max_bytes:
+                # Storing it would only flush the whole cache, but the previous render is stale
+                return
+            self._cache[key] = prompt
+            self._bytes += size
+            if self.ttl:
+                self._expires[key] = time.monotonic() + self.ttl
+            self._shrink()
+
+    def set_messages_by_key(self, key: Optional[bytes], messages: Sequence["ChatMessage"]) -> None:
+        """Like `set_messages`, taking the fingerprint of the context."""
+        if key is None:
+            return
+        size = _object_size(messages)
+
+        with self._lock:
+            prompt = self._cache.get(key)
+            if prompt is None or (self.max_bytes and _entry_size(key, prompt) + size > self.max_bytes):
+                return
+            if key in self._messages:
+                self._bytes -= self._messages[key][1]
+            self._messages[key] = (tuple(messages), size)
+            self._bytes += size
+            self._shrink()
+
+    def _shrink(self) -> None:
+        """Evict entries, expired and then least recently used, until the cache is within its bounds."""
+        if self._expires:
+            now = time.monotonic()
+            # Entries get the same TTL when stored, so they expire in the order they were stored,
+            # whether read since or not: all the expired ones are found in O(1) amortized
+            while self._expires:
+                key, expires = next(iter(self._expires.items()))
+                if expires > now:
+                    break
+                self._evict(key)
+        while self._cache and (
+            (self.max_entries and len(self._cache) > self.max_entries)
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            self._evict(next(iter(self._cache)))
+
+    def _lookup(self, key: bytes) -> bool:
+        """Return whether there's an unexpired entry for `key`, making it the most recently used."""
+        if key not in self._cache:
+            return False
+        if self._expires and self._expires[key] <= time.monotonic():
+            self._evict(key)
+            return False
+        self._cache.move_to_end(key)
+        return True
+
+    def _evict(self, key: bytes) -> None:
+        self._remove(key)
+        self._evictions += 1
+
+    def _remove(self, key: bytes) -> None:
+        prompt = self._cache.pop(key)
+        self._expires.pop(key, None)
+        self._bytes -= _entry_size(key, prompt)
+        if key in self._messages:
+            self._bytes -= self._messages.pop(key)[1]
+
+
+class ShardedCache:
+    """
+    In-memory rendering cache split in shards, each guarded by a lock of its own.
+
+    Threads rendering different contexts mostly land on different shards, so they seldom wait
+    for each other, which matters when threads run in parallel, as in free-threaded Python.
+    Each shard is a `DefaultCache` holding its share of the bounds, and evicts its own least
+    recently used entries.
+
+    Parameters:
+        shards: How many shards to split the cache in.
+        max_entries: The number of entries above which entries are evicted, read from
+            `config.RENDER_CACHE_MAX_ENTRIES` if not passed. 0 means no limit.
+        max_bytes: The size of the entries above which entries are evicted, read from
+            `config.RENDER_CACHE_MAX_BYTES` if not passed. 0 means no limit.
+        ttl: How many seconds entries are kept, read from `config.RENDER_CACHE_TTL` if not passed.
+        fingerprint: The strategy to key contexts with, defaults to `HashFingerprint`.
+    """
+
+    def __init__(
+        self,
+        shards: int = 16,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        fingerprint: Optional[Fingerprint] = None,
+    ) -> None:
+        if shards < 1:
+            msg = "A sharded cache needs at least one shard"
+            raise ValueError(msg)
+        max_entries = config.RENDER_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        max_bytes = config.RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.fingerprint = fingerprint or default_fingerprint
+        self._shards = [
+            DefaultCache(-(-max_entries // shards), -(-max_bytes // shards), ttl, self.fingerprint)
+            for _ in range(shards)
+        ]
+
+    def get(self, context: dict) -> Optional[str]:
+        key = self.fingerprint(context)
+        return self._shard(key).get_by_key(key)
+
+    def get_messages(self, context: dict) -> Optional[Sequence["ChatMessage"]]:
+        key = self.fingerprint(context)
+        return self._shard(key).get_messages_by_key(key)
+
+    def set(self, context: dict, prompt: str) -> None:
+        key = self.fingerprint(context)
+        self._shard(key).set_by_key(key, prompt)
+
+    def set_messages(self, context: dict, messages: Sequence["ChatMessage"]) -> None:
+        key = self.fingerprint(context)
+        self._shard(key).set_messages_by_key(key, messages)
+
+    def clear(self) -> None:
+        for shard in self._shards:
+            shard.clear()
+
+    def stats(self) -> CacheStats:
+        """Return the counters of all the shards added up."""
+        return CacheStats(*(sum(counters) for counters in zip(*(shard.stats() for shard in self._shards))))
+
+    def _shard(self, key: Optional[bytes]) -> DefaultCache:
+        return self._shards[hash(key) % len(self._shards)]
+
+
+def _entry_size(key: bytes, prompt: str) -> int:
+    return sys.getsizeof(key) + sys.getsizeof(prompt)
+
+
+def _object_size(obj: Any) -> int:
+    """Return the bytes taken by the models, lists and strings making up `obj`."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, BaseModel):
+        size += sum(_object_size(value) for value in obj.__dict__.values())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_object_size(item) for item in obj)
+    return size
+
+
+class SharedCache:
+    """
+    Render cache that can be shared by all the prompts, whatever their sentinel.
+
+    Each prompt marks the output of tags and filters with a random sentinel of its own, so a
+    render can't be served to another prompt as is. This cache removes the sentinel from both the
+    key and the stored text, and puts back the sentinel of the prompt reading it. Where the
+    sentinel was is recorded apart from the text, so that template data can never turn into a
+    marker on the way back.
+
+    Parameters:
+        backend: The cache storing the renders, a `DefaultCache` if not passed.
+    """
+
+    def __init__(self, backend: Optional[RenderCache] = None) -> None:
+        self.backend = backend or DefaultCache()
+
+    def get(self, context: dict) -> Optional[str]:
+        return self._restore(context, self.backend.get(_neutral_context(context)))
+
+    def get_many(self, contexts: list[dict]) -> list[Optional[str]]:
+        neutral = [_neutral_context(context) for context in contexts]
+        if isinstance(self.backend, BatchRenderCache):
+            stored = self.backend.get_many(neutral)
+        else:
+            stored = [self.backend.get(context) for context in neutral]
+        return [self._restore(context, s) for context, s in zip(contexts, stored)]
+
+    def set(self, context: dict, prompt: str) -> None:
+        self.backend.set(_neutral_context(context), self._store(context, prompt))
+
+    def set_many(self, items: list[tuple[dict, str]]) -> None:
+        neutral = [(_neutral_context(context), self._store(context, prompt)) for context, prompt in items]
+        if isinstance(self.backend, BatchRenderCache):
+            self.backend.set_many(neutral)
+        else:
+            for context, stored in neutral:
+                self.backend.set(context, stored)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> CacheStats:
+        return self.backend.stats()
+
+    @staticmethod
+    def _store(context: dict, prompt: str) -> str:
+        """Return `prompt` without the sentinel, preceded by the lengths of the segments it separated."""
+        segments = prompt.split(context[SENTINEL_VAR]) if SENTINEL_VAR in context else [prompt]
+        header = ",".join(str(len(segment)) for segment in segments[:-1])
+        return header + "\n" + "".join(segments)
+
+    @staticmethod
+    def _restore(context: dict, stored: Optional[str]) -> Optional[str]:
+        """Put the sentinel of `context` back in a render stored by `_store`."""
+        if stored is None:
+            return None
+        header, _, text = stored.partition("\n")
+        if not header:
+            return text
+
+        segments = []
+        pos = 0
+        for length in map(int, header.split(",")):
+            segments.append(text[pos : pos + length])
+            pos += length
+        segments.append(text[pos:])
+        return context[SENTINEL_VAR].join(segments)
+
+
+class CompressionStats(NamedTuple):
+    """Counters describing the work of a `CompressedCache`."""
+
+    # Renders stored compressed, and stored as they are for being below the threshold
+    compressed: int
+    raw: int
+    # Bytes of the compressed renders, before and after compression
+    bytes_in: int
+    bytes_out: int
+    # CPU seconds spent compressing and decompressing
+    compress_time: float
+    decompress_time: float
+
+    @property
+    def ratio(self) -> float:
+        """How many times smaller compressed renders are, 1.0 if nothing was compressed."""
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+
+
+# Tags the renders `CompressedCache` stores encoded in base85 rather than Latin-1
+_BASE85_SUFFIX = "+b85"
+
+
+class CompressedCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Render cache compressing the renders stored in another cache.
+
+    Renders embedding media are large and compress well, smaller ones are stored as they are,
+    since compressing them would take CPU time to save little memory. The ratio achieved and the
+    time spent are reported by `compression_stats()`, giving each prompt a cache of its own tells
+    whether compression pays off for that prompt.
+
+    To share it between prompts, wrap this cache in a `SharedCache` rather than the opposite,
+    since the sentinel must be removed before compressing.
+
+    Render caches store text, so the compressed bytes are handed to `backend` as a string. An
+    in-memory `DefaultCache` or `ShardedCache` gets them decoded as Latin-1, which takes a byte
+    per byte. Any other backend, such as `SQLiteCache` or `RedisCache`, would encode that string
+    to UTF-8 and double the bytes above 0x7f, so it gets them encoded in base85, a quarter larger.
+
+    Parameters:
+        backend: The cache storing the renders, a `DefaultCache` if not passed.
+        compression: How to compress the renders, one of `zlib` and `zstd`. Defaults to `zstd` if
+            zstandard is installed, `zlib` otherwise.
+        threshold: The length of the renders below which they're stored uncompressed.
+    """
+
+    def __init__(
+        self, backend: Optional[RenderCache] = None, *, compression: Optional[str] = None, threshold: int = 4096
+    ) -> None:
+        self.backend = backend or DefaultCache()
+        self.threshold = threshold
+        self._codec = default_codec() if compression is None else get_codec(compression)
+        if self._codec is IDENTITY:
+            # Its name tags the renders stored as they are, that aren't encoded to bytes
+            msg = f"Unknown compression '{compression}', use one of (zlib, zstd)"
+            raise ValueError(msg)
+        # Backends keeping the strings themselves in memory, where Latin-1 costs nothing
+        self._latin1 = isinstance(self.backend, (DefaultCache, ShardedCache))
+        self._lock = threading.Lock()
+        self._compressed = 0
+        self._raw = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._compress_time = 0.0
+        self._decompress_time = 0.0
+
+    def get(self, context: dict) -> Optional[str]:
+        return self._decode(self.backend.get(context))
+
+    def get_many(self, contexts: list[dict]) -> list[Optional[str]]:
+        if isinstance(self.backend, BatchRenderCache):
+            return [self._decode(stored) for stored in self.backend.get_many(contexts)]
+        return [self.get(context) for context in contexts]
+
+    def set(self, context: dict, prompt: str) -> None:
+        self.backend.set(context, self._encode(prompt))
+
+    def set_many(self, items: list[tuple[dict, str]]) -> None:
+        if isinstance(self.backend, BatchRenderCache):
+            self.backend.set_many([(context, self._encode(prompt)) for context, prompt in items])
+        else:
+            for context, prompt in items:
+                self.set(context, prompt)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> CacheStats:
+        return self.backend.stats()
+
+    def compression_stats(self) -> CompressionStats:
+        """Return how many renders were compressed, by how much and how long it took."""
+        with self._lock:
+            return CompressionStats(
+                self._compressed,
+                self._raw,
+                self._bytes_in,
+                self._bytes_out,
+                self._compress_time,
+                self._decompress_time,
+            )
+
+    def _encode(self, prompt: str) -> str:
+        """Return `prompt` preceded by the name of its codec, compressed if it's long enough."""
+        if len(prompt) < self.threshold:
+            with self._lock:
+                self._raw += 1
+            return f"{IDENTITY.name}:{prompt}"
+
+        start = time.thread_time()
+        data = prompt.encode("utf-8")
+        compressed = self._codec.compress(data)
+        elapsed = time.thread_time() - start
+        with self._lock:
+            self._compressed += 1
+            self._bytes_in += len(data)
+            self._bytes_out += len(compressed)
+            self._compress_time += elapsed
+        if self._latin1:
+            # Latin-1 maps each byte to a character, which CPython stores in a byte
+            return f"{self._codec.name}:{compressed.decode('latin-1')}"
+        return f"{self._codec.name}{_BASE85_SUFFIX}:{base64.b85encode(compressed).decode('ascii')}"
+
+    def _decode(self, stored: Optional[str]) -> Optional[str]:
+        if stored is None:
+            return None
+        name, _, data = stored.partition(":")
+        if name == IDENTITY.name:
+            return data
+
+        start = time.thread_time()
+        if name.endswith(_BASE85_SUFFIX):
+            name = name[: -len(_BASE85_SUFFIX)]
+            compressed = base64.b85decode(data)
+        else:
+            compressed = data.encode("latin-1")
+        codec = self._codec if name == self._codec.name else get_codec(name)
+        prompt = codec.decompress(compressed).decode("utf-8")
+        elapsed = time.thread_time() - start
+        with self._lock:
+            self._decompress_time += elapsed
+        return prompt
+
+
+def _neutral_context(context: dict) -> dict:
+    return {name: value for name, value in context.items() if name != SENTINEL_VAR}
+
+
+# Shared by the default caches, so that a large value passed to many prompts is hashed once
+default_fingerprint = HashFingerprint()
+
+# Serves all the prompts when `config.RENDER_CACHE_SHARED` is set
+shared_cache = SharedCache()
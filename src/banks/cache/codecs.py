@@ -0,0 +1,59 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+"""Compression of the rendered prompts that caches store."""
+
+from __future__ import annotations
+
+import zlib
+from typing import Callable, NamedTuple
+
+ZSTD_INSTALL_MSG = "zstandard is not installed. Please install it with `pip install zstandard`."
+
+
+class Codec(NamedTuple):
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+def _identity(data: bytes) -> bytes:
+    return data
+
+
+IDENTITY = Codec("none", _identity, _identity)
+
+
+def get_codec(name: str | None) -> Codec:
+    """
+    Return the codec called `name`, one of `none`, `zlib` and `zstd`.
+
+    Raises:
+        ImportError: If the codec is `zstd` and zstandard is not installed
+        ValueError: If there's no codec with that name
+    """
+    if name is None or name == IDENTITY.name:
+        return IDENTITY
+    if name == "zlib":
+        return Codec("zlib", zlib.compress, zlib.decompress)
+    if name == "zstd":
+        try:
+            import zstandard  # type: ignore[import-not-found]
+        except ImportError as e:
+            raise ImportError(ZSTD_INSTALL_MSG) from e
+        return Codec(
+            "zstd",
+            lambda data: zstandard.ZstdCompressor().compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data),
+        )
+
+    msg = f"Unknown codec '{name}', use one of (none, zlib, zstd)"
+    raise ValueError(msg)
+
+
+def default_codec() -> Codec:
+    """Return the `zstd` codec if zstandard is installed, the `zlib` one otherwise."""
+    try:
+        return get_codec("zstd")
+    except ImportError:
+        return get_codec("zlib")
@@ -0,0 +1,63 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from typing import Any
+
+from banks.cache import CacheStats, DefaultCache, RenderCache
+
+
+class CompletionCache:
+    """
+    Cache of the responses of the LLM to `{% completion %}` blocks.
+
+    Responses are keyed by the model, the messages and the tools sent to the LLM, so a block
+    sending the same request as an earlier one gets the same response without calling the LLM.
+    That includes the request following tool calls, whose messages hold what the tools returned.
+
+    The responses are kept in `backend`, any render cache will do: a `DefaultCache` keeps them
+    in memory, a `SQLiteCache` across restarts. The default backend is bounded by
+    `config.RENDER_CACHE_MAX_ENTRIES` and `config.RENDER_CACHE_MAX_BYTES`, but never expires
+    responses itself, `ttl` being the only expiry.
+
+    Parameters:
+        backend: The cache storing the responses, a `DefaultCache` if not passed.
+        ttl: How many seconds responses are kept, no expiry if not passed.
+    """
+
+    def __init__(self, backend: RenderCache | None = None, *, ttl: float | None = None) -> None:
+        self.backend = backend or DefaultCache(ttl=0)
+        self.ttl = ttl
+
+    def get(self, model: str, messages: list[dict], tools: list[dict] | None) -> dict[str, Any] | None:
+        """Return the message the LLM responded with to the same request, if it's still cached."""
+        stored = self.backend.get(_request(model, messages, tools))
+        if stored is None:
+            return None
+        expires, _, message = stored.partition("\n")
+        if float(expires) and float(expires) <= time.time():
+            return None
+        return json.loads(message)
+
+    def set(self, model: str, messages: list[dict], tools: list[dict] | None, message: dict[str, Any]) -> None:
+        """Store the message the LLM responded with to a request."""
+        # Wall-clock time, since the backend can outlive the process
+        expires = time.time() + self.ttl if self.ttl else 0
+        self.backend.set(_request(model, messages, tools), f"{expires}\n{json.dumps(message)}")
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> CacheStats:
+        return self.backend.stats()
+
+
+def _request(model: str, messages: list[dict], tools: list[dict] | None) -> dict:
+    # A digest of the JSON sent to the LLM, rather than a fingerprint of the objects, since the
+    # pickle of equal messages differs depending on which of their strings are the same object
+    request = json.dumps({"model": model, "messages": messages, "tools": tools}, sort_keys=True, default=str)
+    return {"completion": hashlib.sha256(request.encode("utf-8")).hexdigest()}
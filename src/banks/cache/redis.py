@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+from __future__ import annotations
+
+import math
+import threading
+from typing import Any
+
+from banks.cache import CacheStats, Fingerprint, default_fingerprint
+from banks.cache.codecs import get_codec
+
+REDIS_INSTALL_MSG = "redis is not installed. Please install it with `pip install redis`."
+
+# How many keys `clear` deletes per round trip
+_CLEAR_BATCH_SIZE = 1000
+
+
+class RedisCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Render cache stored in Redis, that can be shared by the nodes of a deployment.
+
+    Entries expire after `ttl` seconds if given, otherwise they stay until Redis evicts them
+    according to its own `maxmemory-policy`. Renders of a batch are looked up and stored with a
+    single round trip each, through `get_many` and `set_many`.
+    """
+
+    def __init__(
+        self,
+        redis_url: str = "redis://localhost:6379",
+        prefix: str = "banks:render:",
+        *,
+        ttl: float | None = None,
+        compression: str | None = None,
+        fingerprint: Fingerprint | None = None,
+        client: Any = None,
+    ) -> None:
+        """
+        Initialize the Redis render cache.
+
+        Parameters:
+            redis_url: Redis connection URL
+            prefix: Key prefix for storing renders in Redis
+            ttl: How many seconds renders are kept, no expiry if not passed
+            compression: How to compress the stored renders, one of `none`, `zlib` and `zstd`
+            fingerprint: The strategy to key contexts with, defaults to `HashFingerprint`
+            client: A Redis client to use instead of connecting to `redis_url`
+        """
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise ImportError(REDIS_INSTALL_MSG) from e
+            client = redis.from_url(redis_url)
+
+        self._redis = client
+        self._prefix = prefix
+        self.ttl = ttl
+        self.fingerprint = fingerprint or default_fingerprint
+        self._codec = get_codec(compression)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _make_key(self, context: dict) -> str | None:
+        """Create Redis key for a context."""
+        fingerprint = self.fingerprint(context)
+        return None if fingerprint is None else f"{self._prefix}{fingerprint.hex()}"
+
+    def get(self, context: dict) -> str | None:
+        return self.get_many([context])[0]
+
+    def get_many(self, contexts: list[dict]) -> list[str | None]:
+        """Return the renders of `contexts`, `None` for the missing ones, fetching them at once."""
+        keys = [self._make_key(context) for context in contexts]
+        found = [k for k in keys if k is not None]
+        values = dict(zip(found, self._redis.mget(found))) if found else {}
+
+        prompts = [self._decode(values[key]) if key is not None and values[key] is not None else None for key in keys]
+        hits = sum(prompt is not None for prompt in prompts)
+        with self._lock:
+            self._hits += hits
+            self._misses += len(prompts) - hits
+        return prompts
+
+    def set(self, context: dict, prompt: str) -> None:
+        self.set_many([(context, prompt)])
+
+    def set_many(self, items: list[tuple[dict, str]]) -> None:
+        """Store the renders of many contexts, in a single round trip."""
+        # Redis counts in whole milliseconds and rejects 0, so shorter TTLs are rounded up
+        px = max(1, math.ceil(self.ttl * 1000)) if self.ttl else None
+        pipe = self._redis.pipeline(transaction=False)
+        for context, prompt in items:
+            key = self._make_key(context)
+            if key is None:
+                continue
+            value = self._codec.name.encode() + b":" + self._codec.compress(prompt.encode("utf-8"))
+            pipe.set(key, value, px=px)
+        pipe.execute()
+
+    def clear(self) -> None:
+        """Delete all the renders stored under the prefix."""
+        pipe = self._redis.pipeline(transaction=False)
+        queued = 0
+        for key in self._redis.scan_iter(match=f"{self._prefix}*", count=_CLEAR_BATCH_SIZE):
+            pipe.unlink(key)
+            queued += 1
+            if queued == _CLEAR_BATCH_SIZE:
+                # Keep the pipeline bounded however many keys there are
+                pipe.execute()
+                queued = 0
+        if queued:
+            pipe.execute()
+
+    def stats(self) -> CacheStats:
+        """
+        Return hit and miss counters of this process, along with the number and size of stored entries.
+
+        Counting the entries walks the keys under the prefix. Redis doesn't report evictions per
+        key, they're always 0.
+        """
+        keys = list(self._redis.scan_iter(match=f"{self._prefix}*", count=1000))
+        pipe = self._redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.strlen(key)
+        total = sum(pipe.execute()) if keys else 0
+        with self._lock:
+            return CacheStats(self._hits, self._misses, 0, len(keys), total)
+
+    @staticmethod
+    def _decode(value: bytes) -> str:
+        codec, _, data = value.partition(b":")
+        return get_codec(codec.decode()).decompress(data).decode("utf-8")
@@ -0,0 +1,215 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from pathlib import Path
+
+from banks.cache import CacheStats, Fingerprint, default_fingerprint
+from banks.cache.codecs import get_codec
+from banks.config import config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS renders (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL,
+    codec TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS renders_accessed ON renders (accessed);
+"""
+
+# key -> (stored value, codec, size)
+_Pending = dict[bytes, tuple[bytes, str, int]]
+
+
+class SQLiteCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Render cache stored in a SQLite database, that survives restarts and can be shared by the
+    processes running on the same host.
+
+    The database runs in WAL mode, so that readers don't wait for writers. Writes are buffered
+    and committed in batches, every `batch_size` entries or `flush_interval` seconds, whichever
+    comes first, and on `flush()`, `close()` or when the process exits. When the stored prompts
+    exceed `max_bytes`, the least recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str | Path | None = None,
+        *,
+        max_bytes: int | None = None,
+        compression: str | None = None,
+        batch_size: int = 64,
+        flush_interval: float = 1.0,
+        timeout: float = 30.0,
+        fingerprint: Fingerprint | None = None,
+    ) -> None:
+        """
+        Initialize the SQLite cache.
+
+        Parameters:
+            path: Path to the database file, defaults to `render_cache.sqlite` in `config.USER_DATA_PATH`
+            max_bytes: The size of the stored prompts above which entries are evicted, read from
+                `config.RENDER_CACHE_MAX_BYTES` if not passed. 0 means no limit.
+            compression: How to compress the stored prompts, one of `none`, `zlib` and `zstd`
+            batch_size: How many entries to buffer before writing them to the database
+            flush_interval: How many seconds entries can stay buffered before being written
+            timeout: How many seconds to wait for the database to be unlocked by other processes
+            fingerprint: The strategy to key contexts with, defaults to `HashFingerprint`
+        """
+        self.path = Path(path) if path else config.USER_DATA_PATH / "render_cache.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = config.RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.fingerprint = fingerprint or default_fingerprint
+        self._codec = get_codec(compression)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending: _Pending = {}
+        self._touched: dict[bytes, float] = {}
+        self._last_flush = time.monotonic()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        # Buffered entries must not be lost when the cache is garbage collected or the process exits
+        self._finalizer = weakref.finalize(self, _write, self.path, self.timeout, self._pending, self._touched)
+
+    def get(self, context: dict) -> str | None:
+        key = self.fingerprint(context)
+        row: tuple[bytes, str, int] | None = None
+        if key is not None:
+            with self._lock:
+                row = self._pending.get(key)
+            if row is None:
+                row = (
+                    self._connection()
+                    .execute("SELECT value, codec, size FROM renders WHERE key = ?", (key,))
+                    .fetchone()
+                )
+
+        with self._lock:
+            if key is None or row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._touched[key] = time.time()
+        self._flush_if_due()
+        return get_codec(row[1]).decompress(row[0]).decode("utf-8")
+
+    def set(self, context: dict, prompt: str) -> None:
+        key = self.fingerprint(context)
+        if key is None:
+            return
+        value = self._codec.compress(prompt.encode("utf-8"))
+        with self._lock:
+            self._pending[key] = (value, self._codec.name, len(key) + len(value))
+        self._flush_if_due()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pending.clear()
+            self._touched.clear()
+            with self._connection() as conn:
+                conn.execute("DELETE FROM renders")
+
+    def stats(self) -> CacheStats:
+        """Return hit, miss and eviction counters of this process, along with the number and size of stored entries."""
+        self.flush()
+        size, total = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM renders").fetchone()
+        return CacheStats(self._hits, self._misses, self._evictions, size, total)
+
+    def flush(self) -> None:
+        """Write the buffered entries to the database, evicting entries if it grew too large."""
+        with self._lock:
+            pending = self._pending.copy()
+            touched = self._touched.copy()
+            self._pending.clear()
+            self._touched.clear()
+            self._last_flush = time.monotonic()
+
+        with self._connection() as conn:
+            _write_batch(conn, pending, touched)
+            if self.max_bytes:
+                evicted = self._evict(conn)
+                with self._lock:
+                    self._evictions += evicted
+
+    def close(self) -> None:
+        """Write the buffered entries and close the connection of the calling thread."""
+        self.flush()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _flush_if_due(self) -> None:
+        with self._lock:
+            due = len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        """Delete the least recently used entries until the stored prompts fit in `max_bytes`."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM renders").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM renders ORDER BY accessed"):
+            keys.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        conn.executemany("DELETE FROM renders WHERE key = ?", keys)
+        return len(keys)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the connection of the calling thread, SQLite connections can't be shared."""
+        # A forked process can't use the connections of its parent either
+        if getattr(self._local, "pid", None) != os.getpid() or self._local.conn is None:
+            self._local.conn = _connect(self.path, self.timeout)
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+
+def _connect(path: Path, timeout: float) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _write_batch(conn: sqlite3.Connection, pending: _Pending, touched: dict[bytes, float]) -> None:
+    now = time.time()
+    conn.executemany(
+        "INSERT OR REPLACE INTO renders (key, value, codec, size, accessed) VALUES (?, ?, ?, ?, ?)",
+        [(key, value, codec, size, now) for key, (value, codec, size) in pending.items()],
+    )
+    conn.executemany(
+        "UPDATE renders SET accessed = ? WHERE key = ?",
+        [(accessed, key) for key, accessed in touched.items() if key not in pending],
+    )
+
+
+def _write(path: Path, timeout: float, pending: _Pending, touched: dict[bytes, float]) -> None:
+    if not pending and not touched:
+        return
+    conn = _connect(path, timeout)
+    try:
+        with conn:
+            _write_batch(conn, pending, touched)
+    finally:
+        conn.close()
@@ -0,0 +1,45 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+from __future__ import annotations
+
+import argparse
+from collections.abc import Sequence
+from functools import partial
+from pathlib import Path
+
+from banks.registries.compiled import compile_registry
+from banks.registries.directory import DirectoryPromptRegistry
+from banks.registries.file import FilePromptRegistry
+
+
+def _compile(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    source = Path(args.registry)
+    if not source.is_dir() and not source.is_file():
+        # Registries create what's missing, which would hide a typo behind an empty package
+        parser.error(f"no registry directory or index file at '{source}'")
+    registry = DirectoryPromptRegistry(str(source)) if source.is_dir() else FilePromptRegistry(str(source))
+    if not registry.list_prompts():
+        parser.error(f"the registry at '{source}' has no prompts to compile")
+    package_dir = compile_registry(registry, args.output, args.package)
+    print(f"Compiled {len(registry.list_prompts())} prompts into {package_dir}")  # noqa: T201
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="banks")
+    subparsers = parser.add_subparsers(required=True)
+
+    compile_parser = subparsers.add_parser("compile", help="compile a prompt registry into a Python package")
+    compile_parser.add_argument("registry", help="a registry directory or a registry index file")
+    compile_parser.add_argument("-o", "--output", default=".", help="where to write the package (default: %(default)s)")
+    compile_parser.add_argument(
+        "-p", "--package", default="banks_prompts", help="name of the package to write (default: %(default)s)"
+    )
+    compile_parser.set_defaults(func=partial(_compile, compile_parser))
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+from __future__ import annotations
+
+import fnmatch
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+
+from jinja2 import Environment, Template, meta, nodes
+from jinja2.bccache import Bucket, BytecodeCache, FileSystemBytecodeCache
+
+from .config import config
+from .extensions.completion import CompletionPrefetcher
+from .utils import COMPLETION_PREFETCH_VAR
+
+
+class TemplateCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+def environment_fingerprint(environment: Environment) -> str:
+    """Return a digest of the environment settings that change the code a template compiles to.
+
+    The digest only depends on plain settings, so it's stable across processes.
+    """
+    autoescape = environment.autoescape
+    if callable(autoescape):
+        # Templates built from a string have no name, and that's what the callable is asked about
+        autoescape = autoescape(None)
+    settings = (
+        type(environment).__module__,
+        type(environment).__qualname__,
+        environment.block_start_string,
+        environment.block_end_string,
+        environment.variable_start_string,
+        environment.variable_end_string,
+        environment.comment_start_string,
+        environment.comment_end_string,
+        environment.line_statement_prefix,
+        environment.line_comment_prefix,
+        environment.trim_blocks,
+        environment.lstrip_blocks,
+        environment.newline_sequence,
+        environment.keep_trailing_newline,
+        environment.optimized,
+        environment.is_async,
+        bool(autoescape),
+        tuple(sorted(environment.extensions)),
+    )
+    return hashlib.sha256(repr(settings).encode()).hexdigest()
+
+
+def source_checksum(source: str) -> str:
+    """Return the digest identifying a template source."""
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def referenced_variables(environment: Environment, source: str) -> frozenset[str] | None:
+    """
+    Return the names of the context variables `source` can read, or None if they can't be known.
+
+    A template including, importing or extending another one can read any variable through it,
+    so in that case there's no telling which variables matter.
+    """
+    ast = environment.parse(source)
+    if next(ast.find_all((nodes.Extends, nodes.Include, nodes.Import, nodes.FromImport)), None) is not None:
+        return None
+    return frozenset(meta.find_undeclared_variables(ast))
+
+
+def compile_template(environment: Environment, source: str) -> Template:
+    """
+    Compile `source` into a template, going through the environment's bytecode cache if it has one.
+
+    Jinja only consults the bytecode cache for templates coming from a loader, while prompts are
+    built from strings, so the lookup is done here. Entries are keyed by the template source and
+    the environment settings: a changed template is a different entry, never a stale one.
+    """
+    bcc = environment.bytecode_cache
+    if bcc is None:
+        return environment.from_string(source)
+
+    key = f"{environment_fingerprint(environment)}:{source_checksum(source)}"
+    bucket = bcc.get_bucket(environment, key, None, source)
+    code = bucket.code
+    if code is None:
+        code = environment.compile(source)
+        bucket.code = code
+        bcc.set_bucket(bucket)
+    return environment.template_class.from_code(environment, code, environment.make_globals(None))
+
+
+class BoundedFileSystemBytecodeCache(FileSystemBytecodeCache):
+    """
+    A bytecode cache storing compiled templates on disk, bounded in size.
+
+    When the files in the cache directory grow past `max_size` bytes, the least recently used
+    ones are removed. Reading an entry refreshes its modification time, which is what decides
+    the eviction order.
+    """
+
+    def __init__(self, directory: str | Path, max_size: int | None = None, pattern: str = "__banks_%s.cache") -> None:
+        """
+        Parameters:
+            directory: Where to store the cache files, it will be created if missing.
+            max_size: The maximum size of the cache in bytes. If `None`, the cache is unbounded.
+            pattern: The file name pattern, `%s` is replaced by the cache key.
+        """
+        directory = Path(directory)
+        # Bytecode is loaded and executed as is, only the current user can be allowed to write it
+        directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        super().__init__(str(directory), pattern)
+        self.max_size = max_size
+
+    def load_bytecode(self, bucket: Bucket) -> None:
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                # The file might have been pruned by another process in the meantime
+                pass
+
+    def dump_bytecode(self, bucket: Bucket) -> None:
+        super().dump_bytecode(bucket)
+        if self.max_size is not None:
+            self.prune(self.max_size)
+
+    def prune(self, max_size: int) -> None:
+        """Remove the least recently used files until the cache takes at most `max_size` bytes."""
+        entries = []
+        for filename in fnmatch.filter(os.listdir(self.directory), self.pattern % ("*",)):
+            try:
+                st = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+            total -= size
+
+
+def bytecode_cache_from_config() -> BytecodeCache | None:
+    """Build the on-disk bytecode cache as set in the config, or return `None` if it's disabled."""
+    if not config.BYTECODE_CACHE_ENABLED:
+        return None
+    directory = config.BYTECODE_CACHE_PATH or config.USER_DATA_PATH / "bytecode"
+    return BoundedFileSystemBytecodeCache(directory, max_size=config.BYTECODE_CACHE_MAX_SIZE)
+
+
+def _add_prefetcher(environment: Environment, source: str, template: Template) -> Template:
+    """Give `template` the prefetcher the `completion` tag looks up, if it can have such blocks."""
+    if "completion" in source:
+        template.globals.setdefault(COMPLETION_PREFETCH_VAR, CompletionPrefetcher(environment, source))
+    return template
+
+
+class TemplateCache:
+    """
+    Process-wide, bounded cache of compiled templates.
+
+    Prompts with the same text share the same `Template` object, so that lexing, parsing and
+    compiling the source happen once per process instead of once per `Prompt` instance. The
+    least recently used template is dropped once the cache holds more than `maxsize` entries.
+
+    Templates compiled ahead of time can be added with `preload`, those are never evicted.
+
+    The context variables each template can read are kept along with it, see `referenced_variables`.
+    """
+
+    def __init__(self, maxsize: int | None = None) -> None:
+        """
+        Parameters:
+            maxsize: How many templates to keep. If `None`, `config.TEMPLATE_CACHE_SIZE` is used.
+        """
+        self._maxsize = maxsize
+        self._templates: OrderedDict[tuple[int, str, str], Template] = OrderedDict()
+        self._preloaded: dict[tuple[int, str, str], Template] = {}
+        self._variables: dict[tuple[int, str, str], frozenset[str] | None] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize if self._maxsize is not None else config.TEMPLATE_CACHE_SIZE
+
+    @staticmethod
+    def _key(environment: Environment, source: str) -> tuple[int, str, str]:
+        # A template is bound to its environment, so the key carries the environment identity
+        # along with the settings, which can still be changed after the environment is created.
+        return (id(environment), environment_fingerprint(environment), source_checksum(source))
+
+    def get_template(self, environment: Environment, source: str) -> Template:
+        """
+        Return the template compiled from `source`, compiling it only if it's not cached.
+
+        Parameters:
+            environment: The Jinja environment the template belongs to.
+            source: The template text.
+        """
+        key = self._key(environment, source)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self._hits += 1
+                return template
+            template = self._preloaded.get(key)
+            if template is not None:
+                self._hits += 1
+                return template
+            self._misses += 1
+
+        template = _add_prefetcher(environment, source, compile_template(environment, source))
+
+        maxsize = self.maxsize
+        with self._lock:
+            if maxsize > 0:
+                self._templates[key] = template
+                self._templates.move_to_end(key)
+            while len(self._templates) > maxsize:
+                evicted, _ = self._templates.popitem(last=False)
+                if evicted not in self._preloaded:
+                    self._variables.pop(evicted, None)
+        return template
+
+    def referenced_variables(self, environment: Environment, source: str) -> frozenset[str] | None:
+        """
+        Return the names of the context variables `source` can read, see `referenced_variables`.
+
+        For cached templates the names are kept, so that the source is parsed once rather than by
+        every prompt built from it.
+
+        Parameters:
+            environment: The Jinja environment the template belongs to.
+            source: The template text.
+        """
+        key = self._key(environment, source)
+        with self._lock:
+            if key in self._variables:
+                return self._variables[key]
+
+        names = referenced_variables(environment, source)
+        with self._lock:
+            if key in self._templates or key in self._preloaded:
+                self._variables[key] = names
+        return names
+
+    def preload(self, environment: Environment, source: str, template: Template) -> None:
+        """
+        Add a template that was compiled from `source` elsewhere, so that it's never compiled here.
+
+        Parameters:
+            environment: The Jinja environment the template belongs to.
+            source: The template text.
+            template: The template compiled from `source`.
+        """
+        _add_prefetcher(environment, source, template)
+        with self._lock:
+            self._preloaded[self._key(environment, source)] = template
+
+    def preload_variables(self, environment: Environment, source: str, variables: frozenset[str] | None) -> None:
+        """
+        Add the context variables a template can read, as `referenced_variables` found them elsewhere.
+
+        Parameters:
+            environment: The Jinja environment the template belongs to.
+            source: The template text.
+            variables: The names of the variables, `None` if they can't be known.
+        """
+        with self._lock:
+            self._variables[self._key(environment, source)] = variables
+
+    def info(self) -> TemplateCacheInfo:
+        """Return hit and miss counters along with the cache size."""
+        with self._lock:
+            return TemplateCacheInfo(
+                self._hits, self._misses, self.maxsize, len(self._templates) + len(self._preloaded)
+            )
+
+    def clear(self) -> None:
+        """Drop every cached template and reset the counters."""
+        with self._lock:
+            self._templates.clear()
+            self._preloaded.clear()
+            self._variables.clear()
+            self._hits = 0
+            self._misses = 0
+
+
+# Shared by every prompt in the process
+template_cache = TemplateCache()
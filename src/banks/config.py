@@ -30,6 +30,21 @@ class _BanksConfig:
     ASYNC_ENABLED: bool = False
     USER_DATA_PATH: Path = user_data_path("banks")
     MEDIA_ROOT: Path | None = None
+    TEMPLATE_CACHE_SIZE: int = 512
+    BYTECODE_CACHE_ENABLED: bool = False
+    BYTECODE_CACHE_PATH: Path | None = None
+    BYTECODE_CACHE_MAX_SIZE: int = 64 * 1024 * 1024
+    ASYNC_PARSE_OFFLOAD_SIZE: int = 256 * 1024
+    RENDER_CACHE_MAX_ENTRIES: int = 1024
+    RENDER_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    RENDER_CACHE_TTL: float = 0
+    RENDER_CACHE_SHARED: bool = False
+    RENDER_CACHE_MEMO_MAX_BYTES: int = 16 * 1024 * 1024
+    COMPLETION_CACHE_ENABLED: bool = False
+    COMPLETION_CACHE_TTL: float = 0
+    COMPLETION_TOOL_CONCURRENCY: int = 8
+    COMPLETION_TOOL_TIMEOUT: float = 0
+    COMPLETION_PREFETCH_ENABLED: bool = False
 
     def __init__(self, env_var_prefix: str = "BANKS_"):
         self._env_var_prefix = env_var_prefix
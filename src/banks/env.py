@@ -4,6 +4,7 @@
 from jinja2 import select_autoescape
 from jinja2.sandbox import SandboxedEnvironment as Environment
 
+from .compiler import bytecode_cache_from_config
 from .config import config
 from .filters import audio, cache_control, document, image, lemmatize, tool, video, xml
 from .utils import ensure_environment_sentinel
@@ -31,6 +32,7 @@ env = Environment(
     trim_blocks=True,
     lstrip_blocks=True,
     enable_async=bool(config.ASYNC_ENABLED),
+    bytecode_cache=bytecode_cache_from_config(),
 )
 
 
@@ -23,3 +23,15 @@ class InvalidPromptError(Exception):
 
 class LLMError(Exception):
     """The LLM had problems."""
+
+
+class ToolCallError(Exception):
+    """A tool called by the LLM didn't complete."""
+
+
+class CompilationError(Exception):
+    """Precompiled templates cannot be used."""
+
+
+class ReadOnlyRegistryError(Exception):
+    """The registry doesn't accept new prompts."""
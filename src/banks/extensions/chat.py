@@ -5,8 +5,8 @@
 from jinja2 import TemplateSyntaxError, nodes
 from jinja2.ext import Extension
 
-from banks.types import chat_message_from_text
-from banks.utils import ensure_environment_sentinel, sentinel_from_context
+from banks.types import ChatMessageCollector, chat_message_from_text
+from banks.utils import CHAT_COLLECTOR_VAR, ensure_environment_sentinel, sentinel_from_context
 
 SUPPORTED_TYPES = ("system", "user", "assistant")
 
@@ -65,15 +65,29 @@ class ChatExtension(Extension):
         # Message body
         body = parser.parse_statements(("name:endchat",), drop_needle=True)
 
-        # Build messages list
-        return nodes.CallBlock(self.call_method("_store_chat_messages", args), [], [], body).set_lineno(lineno)
+        # Build messages list, in async environments the body has to be awaited
+        callback = "_store_chat_messages_async" if parser.environment.is_async else "_store_chat_messages"
+        return nodes.CallBlock(self.call_method(callback, args), [], [], body).set_lineno(lineno)
 
     def _store_chat_messages(self, context, role, caller):
         """
         Helper callback.
         """
+        return self._chat_message_line(context, role, caller())
+
+    async def _store_chat_messages_async(self, context, role, caller):
+        """
+        Helper callback.
+        """
+        return self._chat_message_line(context, role, await caller())
+
+    def _chat_message_line(self, context, role, content):
         sentinel = sentinel_from_context(context)
-        cm = chat_message_from_text(role=role, content=caller(), sentinel=sentinel)
+        cm = chat_message_from_text(role=role, content=content, sentinel=sentinel)
+        collector = context.resolve(CHAT_COLLECTOR_VAR)
+        if isinstance(collector, ChatMessageCollector):
+            # Structured render: the message object is handed over as is, no JSON round-trip
+            return collector.add(cm, sentinel)
         # The sentinel marks this line as coming from a `chat` tag, so that template data
         # rendering to a JSON message can't pick its own role. `model_dump_json` escapes
         # newlines, so the content can't break out onto a line of its own either.
@@ -1,23 +1,102 @@
 # SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
 #
 # SPDX-License-Identifier: MIT
-import json
-from typing import TYPE_CHECKING, Any, Callable, ClassVar, cast
+from __future__ import annotations
 
-from jinja2 import TemplateSyntaxError, nodes
+import asyncio
+import contextvars
+import inspect
+import json
+import threading
+import time
+from collections import Counter
+from collections.abc import Awaitable
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from functools import cached_property, partial
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, NamedTuple, cast
+
+from jinja2 import Environment, Template, TemplateSyntaxError, nodes
 from jinja2.ext import Extension
 from pydantic import ValidationError
 
-from banks.errors import InvalidPromptError, LLMError
-from banks.types import ChatMessage, Tool
-from banks.utils import ensure_environment_sentinel, sentinel_from_context
+from banks.cache.completion import CompletionCache
+from banks.config import config
+from banks.errors import InvalidPromptError, LLMError, ToolCallError
+from banks.types import ChatMessage, ChatMessageCollector, Tool
+from banks.utils import (
+    CHAT_COLLECTOR_VAR,
+    COMPLETION_PREFETCH_VAR,
+    COMPLETION_PREFETCHED_VAR,
+    ensure_environment_sentinel,
+    sentinel_from_context,
+)
 
 if TYPE_CHECKING:
-    from litellm.types.utils import ChatCompletionMessageToolCall
-SUPPORTED_KWARGS = ("model",)
+    from litellm.types.utils import ChatCompletionMessageToolCall, Message
+SUPPORTED_KWARGS = ("model", "cache")
+BOOLEAN_VALUES = {"true": True, "True": True, "false": False, "False": False}
 LITELLM_INSTALL_MSG = "litellm is not installed. Please install it with `pip install litellm`."
 
 
+def _collector(context) -> ChatMessageCollector | None:
+    collector = context.resolve(CHAT_COLLECTOR_VAR)
+    return collector if isinstance(collector, ChatMessageCollector) else None
+
+
+def _prefetch(context) -> tuple[CompletionPrefetcher, PrefetchedCompletions] | None:
+    """Return the prefetcher of the template along with the calls of the render, if the render prefetches."""
+    prefetcher = context.get(COMPLETION_PREFETCH_VAR)
+    prefetched = context.get(COMPLETION_PREFETCHED_VAR)
+    if not isinstance(prefetcher, CompletionPrefetcher) or not isinstance(prefetched, PrefetchedCompletions):
+        return None
+    return prefetcher, prefetched
+
+
+class PrefetchedCompletions:
+    """
+    The LLM calls prefetched in a render, by request.
+
+    Whoever renders the template owns them, and calls `cancel` when the render ends: calls the
+    render didn't take, like those of blocks after a failing one, are then cancelled. A call
+    already running in a thread can't be stopped, it's only no longer waited for.
+    """
+
+    def __init__(self) -> None:
+        # None until the first block of the render starts the calls
+        self.calls: dict[str, list[Any]] | None = None
+
+    def take(self, key: str) -> Any | None:
+        """Return the call prefetched for the request `key`, if any, so that no other block takes it."""
+        calls = (self.calls or {}).get(key)
+        return calls.pop(0) if calls else None
+
+    def cancel(self) -> None:
+        """Cancel the calls the render didn't take."""
+        for calls in (self.calls or {}).values():
+            for call in calls:
+                if not call.cancel() and call.done() and not call.cancelled():
+                    # Retrieve the error, which asyncio would otherwise log as never retrieved
+                    call.exception()
+        self.calls = {}
+
+
+class _Request(NamedTuple):
+    """What a `{% completion %}` block sends to the LLM."""
+
+    model_name: str
+    tools: list[Tool]
+    message_dicts: list[dict]
+    tool_dicts: list[dict] | None
+    use_cache: bool
+
+    @property
+    def key(self) -> str:
+        return json.dumps(
+            [self.model_name, self.message_dicts, self.tool_dicts, self.use_cache], sort_keys=True, default=str
+        )
+
+
 class CompletionExtension(Extension):
     """
     `completion` can be used to send to the LLM the content of the block in form of messages.
@@ -36,6 +115,12 @@ class CompletionExtension(Extension):
         {# output the response content #}
         {{ response }}
         ```
+
+    When the environment has a `completion_cache`, responses to requests already sent are served
+    from it, unless the block is tagged with `cache=false`.
+
+    With `BANKS_COMPLETION_PREFETCH_ENABLED` set, the blocks of a `Prompt` that don't depend on each
+    other send their requests together when the render reaches the first block, see `CompletionPrefetcher`.
     """
 
     # a set of names that trigger the extension.
@@ -48,6 +133,11 @@ class CompletionExtension(Extension):
     def __init__(self, environment):
         super().__init__(environment)
         ensure_environment_sentinel(environment)
+        environment.extend(
+            completion_cache=CompletionCache(ttl=config.COMPLETION_CACHE_TTL)
+            if config.COMPLETION_CACHE_ENABLED
+            else None
+        )
 
     @classmethod
     def register_callable(cls, name: str, func: Callable[..., Any]) -> None:
@@ -62,33 +152,39 @@ class CompletionExtension(Extension):
         while parser.stream.current.type != "block_end":
             gathered.append(next(parser.stream))
 
-        # If all has gone well, we will have one triplet of tokens:
+        # If all has gone well, we will have triplets of tokens like:
         #   (type='name', value='model'),
         #   (type='assign', value='='),
         #   (type='string', value='gpt-3.5-turbo-0125'),
-        # Anything else is a parse error
+        # with `model` required and `cache` optional. Anything else is a parse error
         error_msg = f"Invalid syntax for completion: {gathered}"
-        try:
-            attr_name, attr_assign, attr_value = gathered  # pylint: disable=unbalanced-tuple-unpacking
-        except ValueError:
-            raise TemplateSyntaxError(error_msg, lineno) from None
-
-        # Validate tag attributes
-        if attr_name.value not in SUPPORTED_KWARGS or attr_assign.value != "=":
+        attrs = {}
+        for i in range(0, len(gathered), 3):
+            try:
+                attr_name, attr_assign, attr_value = gathered[i : i + 3]  # pylint: disable=unbalanced-tuple-unpacking
+            except ValueError:
+                raise TemplateSyntaxError(error_msg, lineno) from None
+            # Validate tag attributes
+            if attr_name.value not in SUPPORTED_KWARGS or attr_name.value in attrs or attr_assign.value != "=":
+                raise TemplateSyntaxError(error_msg, lineno)
+            attrs[attr_name.value] = attr_value
+
+        cache = attrs.get("cache")
+        if "model" not in attrs or (cache is not None and (cache.type != "name" or cache.value not in BOOLEAN_VALUES)):
             raise TemplateSyntaxError(error_msg, lineno)
 
         # Pass the render context and the model name to the CallBlock node
-        args: list[nodes.Expr] = [nodes.ContextReference(), nodes.Const(attr_value.value)]
+        args: list[nodes.Expr] = [nodes.ContextReference(), nodes.Const(attrs["model"].value)]
+        kwargs = [nodes.Keyword("use_cache", nodes.Const(BOOLEAN_VALUES[cache.value]))] if cache is not None else []
 
         # Message body
         body = parser.parse_statements(("name:endcompletion",), drop_needle=True)
 
         # Call LLM
-        if parser.environment.is_async:
-            return nodes.CallBlock(self.call_method("_do_completion_async", args), [], [], body).set_lineno(lineno)
-        return nodes.CallBlock(self.call_method("_do_completion", args), [], [], body).set_lineno(lineno)
+        method = "_do_completion_async" if parser.environment.is_async else "_do_completion"
+        return nodes.CallBlock(self.call_method(method, args, kwargs), [], [], body).set_lineno(lineno)
 
-    def _get_tool_callable(self, tools: list[Tool], tool_call: "ChatCompletionMessageToolCall") -> Callable[..., Any]:
+    def _get_tool_callable(self, tools: list[Tool], tool_call: ChatCompletionMessageToolCall) -> Callable[..., Any]:
         """Get the callable function for a tool call.
 
         Args:
@@ -110,93 +206,173 @@ class CompletionExtension(Extension):
             raise ValueError(msg)
         return self._callable_registry[name]
 
-    def _do_completion(self, context, model_name, caller):
+    def _do_completion(self, context, model_name, caller, *, use_cache=True):
+        """
+        Helper callback.
+        """
+        self._start_prefetch(context)
+        request = self._request(context, model_name, caller(), use_cache=use_cache)
+        if (future := self._take_prefetched(context, request)) is not None:
+            return future.result()
+        return self._complete(request)
+
+    async def _do_completion_async(self, context, model_name, caller, *, use_cache=True):
         """
         Helper callback.
         """
+        await self._start_prefetch_async(context)
+        body = caller()
+        if inspect.isawaitable(body):
+            # In async environments, the block body renders to a coroutine
+            body = await body
+        request = self._request(context, model_name, body, use_cache=use_cache)
+        if (task := self._take_prefetched(context, request)) is not None:
+            return await task
+        return await self._complete_async(request)
+
+    def _start_prefetch(self, context) -> None:
+        """Start the calls the render of `context` prefetches, if it's its first block."""
+        prefetch = _prefetch(context)
+        if prefetch is not None and prefetch[1].calls is None:
+            prefetcher, prefetched = prefetch
+            prefetched.calls = prefetcher.prefetch(self, context)
+
+    async def _start_prefetch_async(self, context) -> None:
+        """Start the calls the render of `context` prefetches, if it's its first block."""
+        prefetch = _prefetch(context)
+        if prefetch is not None and prefetch[1].calls is None:
+            prefetcher, prefetched = prefetch
+            prefetched.calls = await prefetcher.prefetch_async(self, context)
+
+    @staticmethod
+    def _take_prefetched(context, request: _Request) -> Any | None:
+        prefetched = context.get(COMPLETION_PREFETCHED_VAR)
+        return prefetched.take(request.key) if isinstance(prefetched, PrefetchedCompletions) else None
+
+    def _request(self, context, model_name: str, body: str, *, use_cache: bool) -> _Request:
+        """Return the request to send to the LLM for the rendered body of a block."""
+        messages, tools = self._body_to_messages(body, sentinel_from_context(context), _collector(context))
+        return _Request(
+            model_name,
+            tools,
+            [m.model_dump() for m in messages],
+            [t.model_dump(exclude={"import_path"}) for t in tools] or None,
+            use_cache,
+        )
+
+    def _complete(self, request: _Request) -> str | None:
+        """Send `request` to the LLM, along with the results of the tools it calls, and return its response."""
         try:
             from litellm import completion
-            from litellm.types.utils import Choices, ModelResponse
         except ImportError as e:
             raise ImportError(LITELLM_INSTALL_MSG) from e
 
-        messages, tools = self._body_to_messages(caller(), sentinel_from_context(context))
-        message_dicts = [m.model_dump() for m in messages]
-        tool_dicts = [t.model_dump(exclude={"import_path"}) for t in tools] or None
+        model_name, tools, message_dicts, tool_dicts, _ = request
+        cache = self._completion_cache() if request.use_cache else None
 
-        response = cast(ModelResponse, completion(model=model_name, messages=message_dicts, tools=tool_dicts))
-        choices = cast(list[Choices], response.choices)
-        tool_calls = choices[0].message.tool_calls
+        message = self._cached_response(cache, model_name, message_dicts, tool_dicts)
+        if message is None:
+            response = completion(model=model_name, messages=message_dicts, tools=tool_dicts)
+            message = self._store_response(cache, model_name, message_dicts, tool_dicts, response)
+        tool_calls = cast("list[ChatCompletionMessageToolCall]", message.tool_calls)
         if not tool_calls:
-            return choices[0].message.content
+            return message.content
 
-        message_dicts.append(choices[0].message.model_dump())
-        for tool_call in tool_calls:
-            if not tool_call.function.name:
-                msg = "Malformed response: function name is empty"
-                raise LLMError(msg)
+        message_dicts = [*message_dicts, message.model_dump()]
+        calls = self._tool_calls(tools, tool_calls, "Malformed response: function name is empty")
+        results = _run_tool_calls(calls, config.COMPLETION_TOOL_CONCURRENCY, config.COMPLETION_TOOL_TIMEOUT)
+        message_dicts.extend(_tool_messages(tool_calls, results))
 
-            func = self._get_tool_callable(tools, tool_call)
-
-            function_args = json.loads(tool_call.function.arguments)
-            function_response = func(**function_args)
-            message_dicts.append(
-                ChatMessage(
-                    tool_call_id=tool_call.id, role="tool", name=tool_call.function.name, content=function_response
-                ).model_dump()
-            )
+        message = self._cached_response(cache, model_name, message_dicts, tool_dicts)
+        if message is None:
+            response = completion(model=model_name, messages=message_dicts, tools=tool_dicts)
+            message = self._store_response(cache, model_name, message_dicts, tool_dicts, response)
+        return message.content
 
-        response = cast(ModelResponse, completion(model=model_name, messages=message_dicts, tools=tool_dicts))
-        choices = cast(list[Choices], response.choices)
-        return choices[0].message.content
-
-    async def _do_completion_async(self, context, model_name, caller):
-        """
-        Helper callback.
-        """
+    async def _complete_async(self, request: _Request) -> str | None:
+        """Send `request` to the LLM, see `_complete`."""
         try:
             from litellm import acompletion
-            from litellm.types.utils import Choices, ModelResponse
         except ImportError as e:
             raise ImportError(LITELLM_INSTALL_MSG) from e
 
-        messages, tools = self._body_to_messages(caller(), sentinel_from_context(context))
-        message_dicts = [m.model_dump() for m in messages]
-        tool_dicts = [t.model_dump(exclude={"import_path"}) for t in tools] or None
+        model_name, tools, message_dicts, tool_dicts, _ = request
+        cache = self._completion_cache() if request.use_cache else None
 
-        response = cast(ModelResponse, await acompletion(model=model_name, messages=message_dicts, tools=tool_dicts))
-        choices = cast(list[Choices], response.choices)
-        tool_calls = choices[0].message.tool_calls or []
+        message = self._cached_response(cache, model_name, message_dicts, tool_dicts)
+        if message is None:
+            response = await acompletion(model=model_name, messages=message_dicts, tools=tool_dicts)
+            message = self._store_response(cache, model_name, message_dicts, tool_dicts, response)
+        tool_calls = cast("list[ChatCompletionMessageToolCall]", message.tool_calls or [])
         if not tool_calls:
-            return choices[0].message.content
-
-        message_dicts.append(choices[0].message.model_dump())
+            return message.content
+
+        message_dicts = [*message_dicts, message.model_dump()]
+        calls = self._tool_calls(tools, tool_calls, "Function name is empty")
+        results = await _run_tool_calls_async(calls, config.COMPLETION_TOOL_CONCURRENCY, config.COMPLETION_TOOL_TIMEOUT)
+        message_dicts.extend(_tool_messages(tool_calls, results))
+
+        message = self._cached_response(cache, model_name, message_dicts, tool_dicts)
+        if message is None:
+            response = await acompletion(model=model_name, messages=message_dicts, tools=tool_dicts)
+            message = self._store_response(cache, model_name, message_dicts, tool_dicts, response)
+        return message.content
+
+    def _tool_calls(
+        self, tools: list[Tool], tool_calls: list[ChatCompletionMessageToolCall], error_msg: str
+    ) -> list[Callable[[], Any]]:
+        """Return the calls to make for the tool calls of the LLM, checking them all before any is made."""
+        calls: list[Callable[[], Any]] = []
         for tool_call in tool_calls:
             if not tool_call.function.name:
-                msg = "Function name is empty"
-                raise LLMError(msg)
-
+                raise LLMError(error_msg)
             func = self._get_tool_callable(tools, tool_call)
-
-            message_dicts.append(
-                ChatMessage(
-                    tool_call_id=tool_call.id,
-                    role="tool",
-                    name=tool_call.function.name,
-                    content=func(**json.loads(tool_call.function.arguments)),
-                ).model_dump()
-            )
-
-        response = cast(ModelResponse, await acompletion(model=model_name, messages=message_dicts, tools=tool_dicts))
-        choices = cast(list[Choices], response.choices)
-        return choices[0].message.content
-
-    def _body_to_messages(self, body: str, sentinel: str) -> tuple[list[ChatMessage], list[Tool]]:
+            calls.append(partial(func, **json.loads(tool_call.function.arguments)))
+        return calls
+
+    def _completion_cache(self) -> CompletionCache | None:
+        return getattr(self.environment, "completion_cache", None)
+
+    @staticmethod
+    def _cached_response(
+        cache: CompletionCache | None, model_name: str, message_dicts: list[dict], tool_dicts: list[dict] | None
+    ) -> Message | None:
+        """Return the message the LLM responded with to the same request, if it's cached."""
+        if cache is None:
+            return None
+        cached = cache.get(model_name, message_dicts, tool_dicts)
+        if cached is None:
+            return None
+
+        from litellm.types.utils import Message
+
+        return Message(**cached)
+
+    @staticmethod
+    def _store_response(
+        cache: CompletionCache | None,
+        model_name: str,
+        message_dicts: list[dict],
+        tool_dicts: list[dict] | None,
+        response: Any,
+    ) -> Message:
+        """Return the message of the LLM response, after storing it in `cache`."""
+        from litellm.types.utils import Choices, ModelResponse
+
+        message = cast(list[Choices], cast(ModelResponse, response).choices)[0].message
+        if cache is not None:
+            cache.set(model_name, message_dicts, tool_dicts, message.model_dump())
+        return message
+
+    def _body_to_messages(
+        self, body: str, sentinel: str, collector: ChatMessageCollector | None = None
+    ) -> tuple[list[ChatMessage], list[Tool]]:
         """Converts each line in the body of a block into a chat message.
 
         Only lines marked with the render sentinel are parsed: they are the ones the `chat`
         tag and the `tool` filter produced. Unmarked lines are template data, which must not
-        be able to declare its own message role or register a tool.
+        be able to declare its own message role or register a tool. In structured renders,
+        messages are references resolved through `collector`.
         """
         body = body.strip()
         messages = []
@@ -208,6 +384,9 @@ class CompletionExtension(Extension):
             if not stripped.startswith(sentinel):
                 continue
             payload = stripped.removeprefix(sentinel)
+            if collector is not None and (message := collector.resolve(payload)) is not None:
+                messages.append(message)
+                continue
             try:
                 # Try to parse a chat message
                 messages.append(ChatMessage.model_validate_json(payload))
@@ -224,3 +403,258 @@ class CompletionExtension(Extension):
             raise InvalidPromptError(msg)
 
         return (messages, tools)
+
+
+class _Block(NamedTuple):
+    """A `{% completion %}` block whose request can be sent ahead of the render."""
+
+    body: Template
+    model_name: str
+    use_cache: bool
+
+
+class CompletionPrefetcher:
+    """
+    Send the requests of the `{% completion %}` blocks of a template that don't depend on each other at once.
+
+    Jinja renders blocks in document order, so each block would wait for the LLM to respond to the
+    ones before it. A block whose body reads no variable the template assigns, the responses of
+    other blocks included, renders the same wherever it sits: when the render reaches the first
+    block, the bodies of those blocks are rendered and their requests sent together, in threads or
+    in tasks for async environments. Each block then takes the response to its own request rather
+    than sending it, so the blocks wait roughly as long as the slowest call.
+
+    Only blocks that always run are sent ahead: those at the top level of the template or of a
+    top-level `{% set %}`, outside of conditions, loops and macros. A block sending a request the
+    prefetched ones didn't is sent as usual, and nothing is prefetched for a template with a
+    single block.
+
+    The template cache gives templates their prefetcher, and prompts with
+    `config.COMPLETION_PREFETCH_ENABLED` set hand each render the `PrefetchedCompletions` it
+    fills, cancelling the calls it didn't take when it ends.
+
+    Parameters:
+        environment: The environment the template is rendered in.
+        source: The template text.
+    """
+
+    # The prefetcher sends requests the way the extension does, through its private methods
+    # pylint: disable=protected-access
+
+    def __init__(self, environment: Environment, source: str) -> None:
+        self.environment = environment
+        self.source = source
+
+    @cached_property
+    def blocks(self) -> list[_Block]:
+        """The blocks to prefetch, in document order."""
+        ast = self.environment.parse(self.source)
+        if next(ast.find_all(nodes.Extends), None) is not None:
+            # The top level of a child template doesn't render
+            return []
+        if sum(1 for node in ast.find_all(nodes.CallBlock) if _completion_call(node)) < 2:
+            return []
+
+        assigned = _stored_names(ast)
+        blocks = []
+        for node in ast.body:
+            for block in node.body if isinstance(node, nodes.AssignBlock) else [node]:
+                call = _completion_call(block)
+                if call is None or not _independent(cast(nodes.CallBlock, block), assigned):
+                    continue
+                body = nodes.Template(cast(nodes.CallBlock, block).body, lineno=1)
+                body.set_environment(self.environment)
+                kwargs = {kw.key: kw.value.as_const() for kw in call.kwargs}
+                blocks.append(
+                    _Block(
+                        self.environment.from_string(body),
+                        call.args[1].as_const(),
+                        kwargs.get("use_cache", True),
+                    )
+                )
+        return blocks
+
+    def prefetch(self, extension: CompletionExtension, context) -> dict[str, list[Future]]:
+        """Start the calls of the blocks in threads, returning their futures by request."""
+        requests = []
+        for block in self.blocks:
+            try:
+                body = block.body.render(context.get_all())
+                requests.append(extension._request(context, block.model_name, body, use_cache=block.use_cache))
+            except Exception:  # noqa: S112  # pylint: disable=broad-exception-caught
+                # The render raises it again when it reaches the block
+                continue
+        if not requests:
+            return {}
+
+        pool = ThreadPoolExecutor(max_workers=len(requests))
+        try:
+            # The calls see the caller's context variables, as the tasks of `prefetch_async` do
+            return self._schedule(
+                extension,
+                requests,
+                lambda request: pool.submit(contextvars.copy_context().run, extension._complete, request),
+            )
+        finally:
+            # The threads exit once their call completes, the render cancelling those it doesn't take
+            pool.shutdown(wait=False)
+
+    async def prefetch_async(self, extension: CompletionExtension, context) -> dict[str, list[asyncio.Task]]:
+        """Start the calls of the blocks in tasks, returning them by request."""
+        requests = []
+        for block in self.blocks:
+            try:
+                body = await block.body.render_async(context.get_all())
+                requests.append(extension._request(context, block.model_name, body, use_cache=block.use_cache))
+            except Exception:  # noqa: S112  # pylint: disable=broad-exception-caught
+                continue
+        return self._schedule(
+            extension, requests, lambda request: asyncio.ensure_future(extension._complete_async(request))
+        )
+
+    @staticmethod
+    def _schedule(
+        extension: CompletionExtension, requests: list[_Request], start: Callable[[_Request], Any]
+    ) -> dict[str, list[Any]]:
+        scheduled: dict[str, list[Any]] = {}
+        cached = extension._completion_cache() is not None
+        for request in requests:
+            calls = scheduled.setdefault(request.key, [])
+            if calls and cached and request.use_cache:
+                # Sent one after the other, the repeated request would get the cached response to the first
+                calls.append(calls[0])
+            else:
+                calls.append(start(request))
+        return scheduled
+
+
+def _completion_call(node: nodes.Node) -> nodes.Call | None:
+    """Return the call to the extension if `node` is a `{% completion %}` block."""
+    if not isinstance(node, nodes.CallBlock) or not isinstance(node.call, nodes.Call):
+        return None
+    attr = node.call.node
+    if not isinstance(attr, nodes.ExtensionAttribute) or attr.identifier != CompletionExtension.identifier:
+        return None
+    return node.call
+
+
+def _stored_names(node: nodes.Node) -> Counter[str]:
+    """Count the assignments to each name in `node`, as targets, loop variables, macros or imports."""
+    names: Counter[str] = Counter()
+    names.update(n.name for n in node.find_all(nodes.Name) if n.ctx in ("store", "param"))
+    names.update(n.name for n in node.find_all(nodes.Macro))
+    names.update(n.target for n in node.find_all(nodes.Import))
+    for n in node.find_all(nodes.FromImport):
+        names.update(name if isinstance(name, str) else name[1] for name in n.names)
+    return names
+
+
+def _independent(block: nodes.CallBlock, assigned: Counter[str]) -> bool:
+    """Return whether the body of `block` only reads variables the template doesn't assign outside of it."""
+    body = nodes.Template(block.body)
+    if next(body.find_all(nodes.Include), None) is not None or any(
+        _completion_call(n) for n in body.find_all(nodes.CallBlock)
+    ):
+        # An included template sees the variables of the render, and nested blocks run with the outer one
+        return False
+    outside = assigned - _stored_names(body)
+    return not any(n.name in outside for n in body.find_all(nodes.Name) if n.ctx == "load")
+
+
+def _tool_messages(tool_calls: list[ChatCompletionMessageToolCall], results: list[Any]) -> list[dict]:
+    """Return the messages handing the results of the tool calls back to the LLM, in the order of the calls."""
+    return [
+        ChatMessage(tool_call_id=tool_call.id, role="tool", name=tool_call.function.name, content=result).model_dump()
+        for tool_call, result in zip(tool_calls, results)
+    ]
+
+
+def _run_tool_calls(calls: list[Callable[[], Any]], concurrency: int, timeout: float) -> list[Any]:
+    """
+    Make the tool calls in a pool of up to `concurrency` threads, returning their results in order.
+
+    Each call has `timeout` seconds from when it starts, 0 meaning no limit. A call running over
+    can't be stopped, its result is just not waited for. Coroutine tools run in an event loop of
+    their own, in the thread of the call. Calls made one after the other with no timeout run in
+    the caller's thread, others see a copy of its context variables.
+
+    Raises:
+        ToolCallError: If a call doesn't complete in time
+    """
+    sequential = len(calls) == 1 or concurrency == 1
+    if sequential and not timeout and not any(inspect.iscoroutinefunction(call) for call in calls):
+        return [_call_sync(call) for call in calls]
+
+    started = [threading.Event() for _ in calls]
+    start_times = [0.0] * len(calls)
+
+    def run(i: int) -> Any:
+        start_times[i] = time.monotonic()
+        started[i].set()
+        return _call_sync(calls[i])
+
+    pool = ThreadPoolExecutor(max_workers=min(concurrency or len(calls), len(calls)))
+    completed = False
+    try:
+        futures = [pool.submit(contextvars.copy_context().run, run, i) for i in range(len(calls))]
+        results = []
+        for i, future in enumerate(futures):
+            # Calls start in order, so those before this one have completed if it's still queued
+            started[i].wait()
+            remaining = start_times[i] + timeout - time.monotonic() if timeout else None
+            try:
+                results.append(future.result(timeout=max(remaining, 0) if remaining is not None else None))
+            except FuturesTimeoutError:
+                msg = f"Tool call {i} did not complete within {timeout} seconds"
+                raise ToolCallError(msg) from None
+        completed = True
+        return results
+    finally:
+        pool.shutdown(wait=completed, cancel_futures=True)
+
+
+def _call_sync(call: Callable[[], Any]) -> Any:
+    """Make a tool call from sync code, running it to completion if it's a coroutine."""
+    result = call()
+    if inspect.isawaitable(result):
+        return asyncio.run(_wait(result))
+    return result
+
+
+async def _wait(awaitable: Awaitable[Any]) -> Any:
+    return await awaitable
+
+
+async def _run_tool_calls_async(calls: list[Callable[[], Any]], concurrency: int, timeout: float) -> list[Any]:
+    """
+    Make the tool calls, up to `concurrency` at a time, returning their results in order.
+
+    Coroutine tools are awaited in the event loop, and cancelled if they run over `timeout`, see
+    `_run_tool_calls`. Other tools run in threads, so that they don't block the loop.
+
+    Raises:
+        ToolCallError: If a call doesn't complete in time
+    """
+    semaphore = asyncio.Semaphore(concurrency or len(calls))
+
+    async def call(i: int) -> Any:
+        if inspect.iscoroutinefunction(calls[i]):
+            return await calls[i]()
+        result = await asyncio.to_thread(calls[i])
+        # Sync callables can still hand back something to await
+        return await result if inspect.isawaitable(result) else result
+
+    async def run(i: int) -> Any:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(call(i), timeout or None)
+            except asyncio.TimeoutError:
+                msg = f"Tool call {i} did not complete within {timeout} seconds"
+                raise ToolCallError(msg) from None
+
+    tasks = [asyncio.ensure_future(run(i)) for i in range(len(calls))]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
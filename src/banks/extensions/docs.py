@@ -39,4 +39,12 @@ def completion(model_name: str):  # pylint: disable=W0613
         {# output the response content #}
         {{ response }}
         ```
+
+    With `BANKS_COMPLETION_CACHE_ENABLED` set, responses are cached and a block sending the same
+    model, messages and tools again doesn't call the LLM. Tag a block with `cache=false` to always
+    call the LLM, as in `{% completion model="gpt-3.5-turbo-0125" cache=false %}`.
+
+    With `BANKS_COMPLETION_PREFETCH_ENABLED` set, blocks whose body doesn't use the response of
+    another one call the LLM at the same time, the render waiting for each response only when it
+    reaches the block.
     """
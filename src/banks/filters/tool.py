@@ -13,6 +13,9 @@ from banks.utils import sentinel_from_context
 def tool(context, function: Callable) -> str:
     """Inspect a Python callable and generates a JSON-schema ready for LLM function calling.
 
+    The callable can be a coroutine function: async prompts await it in their event loop, while
+    other tools are called from a thread so that they don't block the loop.
+
     Important:
         This filter only works when used within a `{% completion %}` block.
     """
@@ -3,8 +3,14 @@
 # SPDX-License-Identifier: MIT
 from __future__ import annotations
 
+import asyncio
+import os
 import uuid
-from typing import Any, Protocol
+from collections.abc import AsyncIterator, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property, partial
+from typing import Any, Literal, NamedTuple, Optional, Protocol, cast
 
 try:
     from typing import Self
@@ -14,15 +20,42 @@ except ImportError:  # pragma: no cover
 from jinja2 import meta
 from pydantic import BaseModel, ValidationError
 
-from .cache import DefaultCache, RenderCache
+from .batch import DEFAULT_CHUNK_SIZE, map_chunks
+from .cache import (
+    TEMPLATE_KEY,
+    AsyncCacheAdapter,
+    AsyncRenderCache,
+    BatchRenderCache,
+    DefaultCache,
+    MessagesRenderCache,
+    RenderCache,
+    default_fingerprint,
+    is_async_cache,
+    shared_cache,
+)
+from .compiler import environment_fingerprint, source_checksum, template_cache
 from .config import config
 from .env import env
-from .errors import AsyncError
-from .types import ChatMessage, chat_message_from_text
-from .utils import SENTINEL_VAR, generate_canary_word, generate_sentinel
+from .errors import AsyncError, CompilationError
+from .extensions.completion import PrefetchedCompletions
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .types import ChatMessage, ChatMessageCollector, chat_message_from_text, copy_chat_messages
+from .utils import (
+    CHAT_COLLECTOR_VAR,
+    COMPLETION_PREFETCH_VAR,
+    COMPLETION_PREFETCHED_VAR,
+    SENTINEL_VAR,
+    SentinelStripper,
+    generate_canary_word,
+    generate_sentinel,
+)
 
 DEFAULT_VERSION = "0"
 
+# Shared by every prompt in the process, so that renders coalesce across `Prompt` instances
+_flights = SingleFlight()
+_async_flights = AsyncSingleFlight()
+
 
 class BasePrompt:
     def __init__(
@@ -51,8 +84,8 @@ class BasePrompt:
         self._metadata = metadata or {}
         self._name = name or str(uuid.uuid4())
         self._raw: str = text
-        self._render_cache = render_cache or DefaultCache()
-        self._template = env.from_string(text)
+        self._render_cache = render_cache or (shared_cache if config.RENDER_CACHE_SHARED else DefaultCache())
+        self._template = template_cache.get_template(env, text)
         self._version = version or DEFAULT_VERSION
 
         # The sentinel is per-instance rather than per-render on purpose: the render cache
@@ -65,6 +98,52 @@ class BasePrompt:
             return self.defaults
         return data | self.defaults
 
+    @contextmanager
+    def _prefetching(self, context: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        """
+        Yield the context to render the template with, letting its `completion` blocks prefetch.
+
+        The LLM calls the render didn't use are cancelled once it ends, see `PrefetchedCompletions`.
+        """
+        if not config.COMPLETION_PREFETCH_ENABLED or COMPLETION_PREFETCH_VAR not in self._template.globals:
+            yield context
+            return
+        prefetched = PrefetchedCompletions()
+        try:
+            yield context | {COMPLETION_PREFETCHED_VAR: prefetched}
+        finally:
+            prefetched.cancel()
+
+    @cached_property
+    def _cache_key_variables(self) -> tuple[str, ...] | None:
+        names = template_cache.referenced_variables(env, self.raw)
+        return None if names is None else tuple(sorted(names - {SENTINEL_VAR}))
+
+    @cached_property
+    def _cache_key_defaults(self) -> dict[str, str]:
+        return {SENTINEL_VAR: self.defaults[SENTINEL_VAR], TEMPLATE_KEY: source_checksum(self.raw)}
+
+    def _cache_key(self, context: dict) -> dict:
+        """Return the part of `context` that can change the render, to key the render cache with.
+
+        Variables the template doesn't reference are left out, so that they're neither pickled
+        nor cause misses. The sentinel, that extensions read, is always kept, along with the
+        checksum of the template so that different prompts can share a cache.
+        """
+        names = self._cache_key_variables
+        if names is None:
+            return context | self._cache_key_defaults
+        return {name: context[name] for name in names if name in context} | self._cache_key_defaults
+
+    @staticmethod
+    def _flight_key(key: dict) -> bytes | None:
+        """Return the key concurrent renders of the render cache `key` coalesce on.
+
+        The sentinel is left out, so that prompts with the same template, told apart by the
+        checksum in `key`, share the render of the first one.
+        """
+        return default_fingerprint({name: value for name, value in key.items() if name != SENTINEL_VAR})
+
     @property
     def metadata(self) -> dict[str, Any]:
         return self._metadata
@@ -108,6 +187,77 @@ class BasePrompt:
         """
         return rendered.replace(self.defaults[SENTINEL_VAR], "")
 
+    def _parse_chat_messages(self, rendered: str) -> list[ChatMessage]:
+        """Build the chat messages out of the text rendered by the template."""
+        sentinel = self.defaults[SENTINEL_VAR]
+
+        messages: list[ChatMessage] = []
+        for line in rendered.strip().split("\n"):
+            # Indentation is matched past rather than rejected, since the JSON parser used to
+            # tolerate it and a `chat` tag can sit inside an indented block.
+            stripped = line.lstrip()
+            if not stripped.startswith(sentinel):
+                # Only the `chat` extension can emit messages: an unmarked line is template
+                # data, and parsing it would let it choose its own role.
+                continue
+            try:
+                messages.append(ChatMessage.model_validate_json(stripped.removeprefix(sentinel)))
+            except ValidationError:
+                # Ignore lines that are not a message
+                pass
+
+        if not messages:
+            # fallback, if there was no {% chat %} block in the template,
+            # try to build a list of messages for the role "user"
+            messages.append(chat_message_from_text(role="user", content=rendered, sentinel=sentinel))
+
+        return messages
+
+    @property
+    def _messages_cache(self) -> MessagesRenderCache | None:
+        """The render cache, if it can also store parsed chat messages."""
+        return self._render_cache if isinstance(self._render_cache, MessagesRenderCache) else None
+
+    def _cached_chat_messages(self, key: dict) -> list[ChatMessage] | None:
+        """Return copies of the messages stored for `key`, so that callers can't alter the stored ones."""
+        cache = self._messages_cache
+        messages = cache.get_messages(key) if cache is not None else None
+        return copy_chat_messages(messages) if messages is not None else None
+
+    def _store_chat_messages(self, key: dict, messages: list[ChatMessage]) -> None:
+        if (cache := self._messages_cache) is not None:
+            cache.set_messages(key, copy_chat_messages(messages))
+
+    def _structured_context(self, data: dict[str, Any] | None) -> tuple[dict[str, Any], ChatMessageCollector]:
+        """Return the context for a structured render, along with the collector the `chat` tags will fill."""
+        collector = ChatMessageCollector()
+        return self._get_context(data) | {CHAT_COLLECTOR_VAR: collector}, collector
+
+    def _resolve_chat_messages(self, rendered: str, collector: ChatMessageCollector) -> list[ChatMessage]:
+        """Return the collected messages referenced in the text of a structured render, in order."""
+        sentinel = self.defaults[SENTINEL_VAR]
+        marker = sentinel + ChatMessageCollector.REF_PREFIX
+        messages: list[ChatMessage] = []
+        seen: set[int] = set()
+        pos = rendered.find(marker)
+        while pos != -1:
+            line_start = rendered.rfind("\n", 0, pos) + 1
+            line_end = rendered.find("\n", pos)
+            if line_end == -1:
+                line_end = len(rendered)
+            # Same rule as the JSON lines: only a reference opening its line is a message
+            if not rendered[line_start:pos].strip():
+                message = collector.resolve(rendered[pos + len(sentinel) : line_end])
+                if message is not None:
+                    # A reference repeated by the template yields a message of its own
+                    messages.append(message.model_copy(deep=True) if id(message) in seen else message)
+                    seen.add(id(message))
+            pos = rendered.find(marker, line_end)
+
+        if not messages:
+            messages.append(chat_message_from_text(role="user", content=rendered, sentinel=sentinel))
+        return messages
+
 
 class Prompt(BasePrompt):
     """
@@ -126,6 +276,39 @@ class Prompt(BasePrompt):
     ```
     """
 
+    def _render(self, data: dict[str, Any] | None, *, use_cache: bool = True) -> str:
+        """Render the template, going through the render cache unless `use_cache` is False."""
+        data = self._get_context(data)
+        if not use_cache:
+            return self._render_template(data)
+
+        key = self._cache_key(data)
+        cached = self._render_cache.get(key)
+        if cached:
+            return cached
+
+        # Threads missing the cache with the same context at once wait for a single render
+        flight = self._flight_key(key)
+        if flight is None:
+            return self._render_and_store(data, key)[1]
+        sentinel, rendered = _flights.do(flight, partial(self._render_and_store, data, key))
+        if sentinel == self.defaults[SENTINEL_VAR]:
+            return rendered
+        # Rendered by another prompt with its own sentinel, and only stored in its own render cache
+        rendered = rendered.replace(sentinel, self.defaults[SENTINEL_VAR])
+        self._render_cache.set(key, rendered)
+        return rendered
+
+    def _render_and_store(self, data: dict[str, Any], key: dict) -> tuple[str, str]:
+        """Render and cache the template, returning the sentinel it was rendered with and the text."""
+        rendered = self._render_template(data)
+        self._render_cache.set(key, rendered)
+        return self.defaults[SENTINEL_VAR], rendered
+
+    def _render_template(self, context: dict[str, Any]) -> str:
+        with self._prefetching(context) as render_context:
+            return self._template.render(render_context)
+
     def text(self, data: dict[str, Any] | None = None) -> str:
         """
         Render the prompt using variables present in `data`
@@ -133,51 +316,221 @@ class Prompt(BasePrompt):
         Parameters:
             data: A dictionary containing the context variables.
         """
-        data = self._get_context(data)
-        cached = self._render_cache.get(data)
-        if cached:
-            return self._strip_sentinel(cached)
-
-        rendered: str = self._template.render(data)
-        self._render_cache.set(data, rendered)
-        return self._strip_sentinel(rendered)
+        return self._strip_sentinel(self._render(data))
 
-    def chat_messages(self, data: dict[str, Any] | None = None) -> list[ChatMessage]:
+    def chat_messages(self, data: dict[str, Any] | None = None, *, structured: bool = False) -> list[ChatMessage]:
         """
         Render the prompt using variables present in `data`
 
+        When the render cache supports it, the parsed messages are cached along with the text, and
+        returned messages are copies that can be changed freely.
+
+        With `structured`, the `chat` tags hand their messages over as objects instead of writing
+        them to the rendered text as JSON, saving a serialization and a parse per message. The
+        render cache is still read, but a structured render isn't stored in it.
+
+        Parameters:
+            data: A dictionary containing the context variables.
+            structured: Whether to collect the messages without going through their JSON.
+        """
+        key = self._cache_key(self._get_context(data))
+        messages = self._cached_chat_messages(key)
+        if messages is not None:
+            return messages
+
+        if structured:
+            cached = self._render_cache.get(key)
+            if not cached:
+                context, collector = self._structured_context(data)
+                return self._resolve_chat_messages(self._render_template(context), collector)
+            messages = self._parse_chat_messages(cached)
+        else:
+            messages = self._parse_chat_messages(self._render(data))
+        self._store_chat_messages(key, messages)
+        return messages
+
+    def stream(self, data: dict[str, Any] | None = None) -> Iterator[str]:
+        """
+        Render the prompt using variables present in `data`, yielding the text as it's produced.
+
+        The prompt is never held in memory as a whole, which makes it possible to start sending
+        large prompts before they're fully rendered. For the same reason, the streamed text is
+        not stored in the render cache, though it's served from the cache when already there.
+
         Parameters:
             data: A dictionary containing the context variables.
         """
         data = self._get_context(data)
-        rendered = self._render_cache.get(data)
-        if not rendered:
-            rendered = self._template.render(data)
-            self._render_cache.set(data, rendered)
+        cached = self._render_cache.get(self._cache_key(data))
+        if cached:
+            yield self._strip_sentinel(cached)
+            return
+
+        stripper = SentinelStripper(self.defaults[SENTINEL_VAR])
+        with self._prefetching(data) as context:
+            for chunk in self._template.generate(context):
+                if text := stripper.feed(chunk):
+                    yield text
+        if text := stripper.flush():
+            yield text
+
+    def _render_many(self, chunk: list[dict[str, Any] | None], *, use_cache: bool) -> list[str]:
+        """Render a chunk of contexts, with a single lookup in the render cache when it supports batches."""
+        if not use_cache or not isinstance(self._render_cache, BatchRenderCache):
+            return [self._render(data, use_cache=use_cache) for data in chunk]
+
+        contexts = [self._get_context(data) for data in chunk]
+        keys = [self._cache_key(context) for context in contexts]
+        cached = self._render_cache.get_many(keys)
+        missing = [i for i, rendered in enumerate(cached) if not rendered]
+        rendered = {i: self._render_template(contexts[i]) for i in missing}
+        if rendered:
+            self._render_cache.set_many([(keys[i], text) for i, text in rendered.items()])
+        return [rendered[i] if i in rendered else cast(str, text) for i, text in enumerate(cached)]
+
+    def _text_chunk(self, chunk: list[dict[str, Any] | None], *, use_cache: bool) -> list[str]:
+        return [self._strip_sentinel(rendered) for rendered in self._render_many(chunk, use_cache=use_cache)]
+
+    def _chat_messages_chunk(
+        self,
+        chunk: list[dict[str, Any] | None],
+        *,
+        use_cache: bool,
+    ) -> list[list[ChatMessage]]:
+        return [self._parse_chat_messages(rendered) for rendered in self._render_many(chunk, use_cache=use_cache)]
 
-        sentinel = self.defaults[SENTINEL_VAR]
+    def _map_chunks(
+        self,
+        method: str,
+        contexts: Iterable[dict[str, Any] | None],
+        *,
+        max_workers: int | None,
+        chunk_size: int,
+        use_cache: bool,
+        executor: Literal["thread", "process"],
+    ) -> Iterator[Any]:
+        if executor == "thread":
+            func = partial(getattr(self, method), use_cache=use_cache)
+            return map_chunks(func, contexts, max_workers=max_workers, chunk_size=chunk_size)
+
+        if executor != "process":
+            msg = f"Unknown executor '{executor}', use one of (thread, process)"
+            raise ValueError(msg)
+
+        # Workers get the compiled template once, when they start, and only contexts travel with each chunk
+        state = _WorkerState(
+            text=self.raw,
+            code=env.compile(self.raw, raw=True),
+            environment=environment_fingerprint(env),
+            defaults=self.defaults,
+        )
+        factory = partial(ProcessPoolExecutor, initializer=_init_worker, initargs=(state,))
+        return map_chunks(
+            partial(_render_in_worker, method, use_cache=use_cache),
+            contexts,
+            max_workers=max_workers or os.cpu_count() or 1,
+            chunk_size=chunk_size,
+            executor_factory=factory,
+        )
+
+    def text_many(
+        self,
+        contexts: Iterable[dict[str, Any] | None],
+        *,
+        max_workers: int | None = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        use_cache: bool = True,
+        executor: Literal["thread", "process"] = "thread",
+    ) -> Iterator[str]:
+        """
+        Render the prompt once for each context in `contexts`, yielding the results in order.
 
-        messages: list[ChatMessage] = []
-        for line in rendered.strip().split("\n"):
-            # Indentation is matched past rather than rejected, since the JSON parser used to
-            # tolerate it and a `chat` tag can sit inside an indented block.
-            stripped = line.lstrip()
-            if not stripped.startswith(sentinel):
-                # Only the `chat` extension can emit messages: an unmarked line is template
-                # data, and parsing it would let it choose its own role.
-                continue
-            try:
-                messages.append(ChatMessage.model_validate_json(stripped.removeprefix(sentinel)))
-            except ValidationError:
-                # Ignore lines that are not a message
-                pass
+        Contexts are consumed lazily, a chunk at a time, so that `contexts` can be a generator
+        producing more items than would fit in memory.
 
-        if not messages:
-            # fallback, if there was no {% chat %} block in the template,
-            # try to build a list of messages for the role "user"
-            messages.append(chat_message_from_text(role="user", content=rendered, sentinel=sentinel))
+        Templates doing CPU-heavy work, like the `lemmatize` filter or large loops, don't scale
+        with threads: the `process` executor renders them in a pool of worker processes instead.
+        In that case contexts must be picklable, and since workers have their own render cache,
+        the cache of this prompt is not used.
 
-        return messages
+        Parameters:
+            contexts: An iterable of dictionaries containing the context variables.
+            max_workers: How many workers to render with. If `None`, rendering happens in the caller thread
+                with the `thread` executor, and one process per CPU is used with the `process` executor.
+            chunk_size: How many contexts each worker renders at a time.
+            use_cache: Whether to go through the render cache. Batches where every context is seen
+                once don't benefit from the cache, and skipping it saves computing cache keys.
+            executor: Whether workers are threads or processes.
+        """
+        return self._map_chunks(
+            "_text_chunk",
+            contexts,
+            max_workers=max_workers,
+            chunk_size=chunk_size,
+            use_cache=use_cache,
+            executor=executor,
+        )
+
+    def chat_messages_many(
+        self,
+        contexts: Iterable[dict[str, Any] | None],
+        *,
+        max_workers: int | None = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        use_cache: bool = True,
+        executor: Literal["thread", "process"] = "thread",
+    ) -> Iterator[list[ChatMessage]]:
+        """
+        Render the prompt as chat messages once for each context in `contexts`, yielding the results in order.
+
+        See `text_many` for how contexts are processed.
+
+        Parameters:
+            contexts: An iterable of dictionaries containing the context variables.
+            max_workers: How many workers to render with. If `None`, rendering happens in the caller thread
+                with the `thread` executor, and one process per CPU is used with the `process` executor.
+            chunk_size: How many contexts each worker renders at a time.
+            use_cache: Whether to go through the render cache.
+            executor: Whether workers are threads or processes.
+        """
+        return self._map_chunks(
+            "_chat_messages_chunk",
+            contexts,
+            max_workers=max_workers,
+            chunk_size=chunk_size,
+            use_cache=use_cache,
+            executor=executor,
+        )
+
+
+class _WorkerState(NamedTuple):
+    text: str
+    code: str
+    environment: str
+    defaults: dict[str, str]
+
+
+# The prompt a worker process renders, set once when the process starts
+_worker_prompt: Prompt | None = None  # pylint: disable=invalid-name
+
+
+def _init_worker(state: _WorkerState) -> None:
+    """Rebuild the prompt in a worker process from the code compiled by the parent."""
+    global _worker_prompt  # noqa: PLW0603  # pylint: disable=global-statement
+
+    if state.environment != environment_fingerprint(env):
+        msg = "Worker processes have different environment settings than the parent process"
+        raise CompilationError(msg)
+
+    template = env.template_class.from_code(env, compile(state.code, "<template>", "exec"), env.make_globals(None))
+    template_cache.preload(env, state.text, template)
+    _worker_prompt = Prompt(state.text)
+    # Same sentinel and canary word as the parent, so that the output is what the parent would render
+    _worker_prompt.defaults = state.defaults
+
+
+def _render_in_worker(method: str, chunk: list[dict[str, Any] | None], *, use_cache: bool) -> list[Any]:
+    return getattr(_worker_prompt, method)(chunk, use_cache=use_cache)
 
 
 class AsyncPrompt(BasePrompt):
@@ -235,28 +588,126 @@ class AsyncPrompt(BasePrompt):
     ```
     """
 
-    def __init__(self, *args: Any, **kwargs: Any) -> None:
-        super().__init__(*args, **kwargs)
+    def __init__(self, *args: Any, render_cache: RenderCache | AsyncRenderCache | None = None, **kwargs: Any) -> None:
+        """
+        Prompt constructor, see `Prompt` for the parameters.
+
+        Besides a `RenderCache`, `render_cache` can be an `AsyncRenderCache`. Calls to a sync cache
+        run inline, wrap it in an `AsyncCacheAdapter` if it does any I/O.
+        """
+        if is_async_cache(render_cache):
+            super().__init__(*args, **kwargs)
+            self._async_render_cache = cast(AsyncRenderCache, render_cache)
+        else:
+            super().__init__(*args, render_cache=cast(Optional[RenderCache], render_cache), **kwargs)
+            self._async_render_cache = AsyncCacheAdapter(self._render_cache, offload=False)
 
         if not config.ASYNC_ENABLED:
             msg = "Async is not enabled. Please set the environment variable 'BANKS_ASYNC_ENABLED=on' and try again."
             raise AsyncError(msg)
 
+    @property
+    def _messages_cache(self) -> MessagesRenderCache | None:
+        cache = self._async_render_cache
+        if isinstance(cache, AsyncCacheAdapter) and isinstance(cache.cache, MessagesRenderCache):
+            return cache.cache
+        return None
+
+    async def _render(self, data: dict[str, Any] | None) -> str:
+        """Render the template, going through the render cache."""
+        data = self._get_context(data)
+        key = self._cache_key(data)
+        cached = await self._async_render_cache.get(key)
+        if cached:
+            return cached
+
+        # Coroutines missing the cache with the same context at once wait for a single render
+        flight = self._flight_key(key)
+        if flight is None:
+            return (await self._render_and_store(data, key))[1]
+        sentinel, rendered = await _async_flights.do(flight, partial(self._render_and_store, data, key))
+        if sentinel == self.defaults[SENTINEL_VAR]:
+            return rendered
+        # Rendered by another prompt with its own sentinel, and only stored in its own render cache
+        rendered = rendered.replace(sentinel, self.defaults[SENTINEL_VAR])
+        await self._async_render_cache.set(key, rendered)
+        return rendered
+
+    async def _render_and_store(self, data: dict[str, Any], key: dict) -> tuple[str, str]:
+        """Render and cache the template, returning the sentinel it was rendered with and the text."""
+        rendered = await self._render_template(data)
+        await self._async_render_cache.set(key, rendered)
+        return self.defaults[SENTINEL_VAR], rendered
+
+    async def _render_template(self, context: dict[str, Any]) -> str:
+        with self._prefetching(context) as render_context:
+            return await self._template.render_async(render_context)
+
     async def text(self, data: dict[str, Any] | None = None) -> str:
         """
         Render the prompt using variables present in `data`
 
+        Parameters:
+            data: A dictionary containing the context variables.
+        """
+        return self._strip_sentinel(await self._render(data))
+
+    async def chat_messages(self, data: dict[str, Any] | None = None, *, structured: bool = False) -> list[ChatMessage]:
+        """
+        Render the prompt using variables present in `data`
+
+        Parsing the messages out of a large render can take long enough to stall the event loop:
+        above `config.ASYNC_PARSE_OFFLOAD_SIZE` characters, it's done in a worker thread. With
+        `structured`, there's no parsing at all, see `Prompt.chat_messages`.
+
+        Parameters:
+            data: A dictionary containing the context variables.
+            structured: Whether to collect the messages without going through their JSON.
+        """
+        key = self._cache_key(self._get_context(data))
+        messages = self._cached_chat_messages(key)
+        if messages is not None:
+            return messages
+
+        if structured:
+            cached = await self._async_render_cache.get(key)
+            if not cached:
+                context, collector = self._structured_context(data)
+                return self._resolve_chat_messages(await self._render_template(context), collector)
+            rendered = cached
+        else:
+            rendered = await self._render(data)
+        if len(rendered) > config.ASYNC_PARSE_OFFLOAD_SIZE:
+            messages = await asyncio.to_thread(self._parse_chat_messages, rendered)
+        else:
+            messages = self._parse_chat_messages(rendered)
+        self._store_chat_messages(key, messages)
+        return messages
+
+    async def stream(self, data: dict[str, Any] | None = None) -> AsyncIterator[str]:
+        """
+        Render the prompt using variables present in `data`, yielding the text as it's produced.
+
+        Text preceding a `{% completion %}` block reaches the consumer while the LLM call is
+        still in flight. As with `Prompt.stream`, the streamed text is not stored in the render
+        cache, though it's served from the cache when already there.
+
         Parameters:
             data: A dictionary containing the context variables.
         """
         data = self._get_context(data)
-        cached = self._render_cache.get(data)
+        cached = await self._async_render_cache.get(self._cache_key(data))
         if cached:
-            return self._strip_sentinel(cached)
-
-        rendered: str = await self._template.render_async(data)
-        self._render_cache.set(data, rendered)
-        return self._strip_sentinel(rendered)
+            yield self._strip_sentinel(cached)
+            return
+
+        stripper = SentinelStripper(self.defaults[SENTINEL_VAR])
+        with self._prefetching(data) as context:
+            async for chunk in self._template.generate_async(context):
+                if text := stripper.feed(chunk):
+                    yield text
+        if text := stripper.flush():
+            yield text
 
 
 class PromptRegistry(Protocol):  # pragma: no cover
@@ -0,0 +1,172 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+"""
+Ahead-of-time compilation of prompt registries.
+
+`compile_registry` writes the compiled code of every prompt in a registry to an importable Python
+package, and `CompiledPromptRegistry` serves prompts out of that package, so that no template
+needs to be compiled at runtime.
+"""
+
+from __future__ import annotations
+
+import importlib
+import importlib.resources
+from pathlib import Path
+
+import jinja2
+from jinja2 import Template
+from pydantic import BaseModel, Field
+
+from banks.compiler import environment_fingerprint, referenced_variables, source_checksum, template_cache
+from banks.env import env
+from banks.errors import CompilationError, PromptNotFoundError, ReadOnlyRegistryError
+from banks.prompt import DEFAULT_VERSION, Prompt, PromptModel
+from banks.registries.directory import DirectoryPromptRegistry
+from banks.registries.file import FilePromptRegistry
+
+MANIFEST_NAME = "manifest.json"
+MODULE_PREFIX = "tmpl_"
+
+
+class CompiledPromptModel(PromptModel):
+    """A prompt along with the module holding its compiled template and the variables it reads."""
+
+    module: str
+    # Left unset by packages compiled before it was recorded, `None` when it can't be known
+    variables: list[str] | None = None
+
+
+class CompiledManifest(BaseModel):
+    """Index of a package of compiled prompts."""
+
+    jinja_version: str
+    environment: str
+    prompts: list[CompiledPromptModel] = Field(default=[])
+
+
+def compile_registry(
+    registry: DirectoryPromptRegistry | FilePromptRegistry,
+    output_dir: str | Path,
+    package_name: str = "banks_prompts",
+) -> Path:
+    """
+    Compile all the prompts in a registry into a Python package.
+
+    The package contains one module per template, with the code Jinja generates for it, and a
+    manifest listing the prompts. Templates are compiled with the Banks environment, so the
+    compiled package can only be loaded with the same environment settings.
+
+    Args:
+        registry: The registry holding the prompts to compile
+        output_dir: Path to the directory where the package will be written
+        package_name: Name of the Python package to write
+
+    Returns:
+        The path to the package directory
+    """
+    package_dir = Path(output_dir) / package_name
+    package_dir.mkdir(parents=True, exist_ok=True)
+    # Leftovers from a previous compilation would otherwise be shipped along with the package
+    for stale in package_dir.glob(f"{MODULE_PREFIX}*.py"):
+        stale.unlink()
+
+    manifest = CompiledManifest(jinja_version=jinja2.__version__, environment=environment_fingerprint(env))
+    for model in registry.list_prompts():
+        module = f"{MODULE_PREFIX}{source_checksum(model.text)}"
+        module_path = package_dir / f"{module}.py"
+        if not module_path.exists():
+            code = env.compile(model.text, name=model.name, raw=True, defer_init=True)
+            module_path.write_text(code, encoding="utf-8")
+        names = referenced_variables(env, model.text)
+        manifest.prompts.append(
+            CompiledPromptModel(
+                **model.model_dump(), module=module, variables=sorted(names) if names is not None else None
+            )
+        )
+
+    (package_dir / MANIFEST_NAME).write_text(manifest.model_dump_json(), encoding="utf-8")
+    (package_dir / "__init__.py").write_text('"""Prompts compiled by `banks compile`, do not edit."""\n')
+    return package_dir
+
+
+class CompiledPromptRegistry:
+    """A read-only registry serving prompts from a package written by `compile_registry`."""
+
+    def __init__(self, package: str) -> None:
+        """
+        Initialize the compiled prompt registry.
+
+        Args:
+            package: Import name of the package holding the compiled prompts
+
+        Raises:
+            CompilationError: If the package was compiled with different Jinja version or settings
+        """
+        self._package = package
+        manifest_text = importlib.resources.files(package).joinpath(MANIFEST_NAME).read_text(encoding="utf-8")
+        self._manifest = CompiledManifest.model_validate_json(manifest_text)
+
+        if self._manifest.jinja_version != jinja2.__version__:
+            msg = f"Prompts were compiled with Jinja {self._manifest.jinja_version}, running {jinja2.__version__}"
+            raise CompilationError(msg)
+        if self._manifest.environment != environment_fingerprint(env):
+            msg = "Prompts were compiled with different environment settings, please compile them again"
+            raise CompilationError(msg)
+
+        self._templates: dict[str, Template] = {}
+
+    def list_prompts(self) -> list[PromptModel]:
+        """
+        Return all the prompts stored in the registry.
+
+        Returns:
+            A list of PromptModel objects, one per prompt version
+        """
+        return [PromptModel(**m.model_dump(exclude={"module", "variables"})) for m in self._manifest.prompts]
+
+    def get(self, *, name: str, version: str | None = None) -> Prompt:
+        """
+        Retrieve a prompt by name and version.
+
+        Args:
+            name: Name of the prompt to retrieve
+            version: Version of the prompt (optional)
+
+        Returns:
+            The requested Prompt object
+
+        Raises:
+            PromptNotFoundError: If prompt doesn't exist
+        """
+        version = version or DEFAULT_VERSION
+        for model in self._manifest.prompts:
+            if model.name == name and (model.version or DEFAULT_VERSION) == version:
+                template_cache.preload(env, model.text, self._load_template(model.module))
+                if "variables" in model.model_fields_set:
+                    variables = frozenset(model.variables) if model.variables is not None else None
+                    template_cache.preload_variables(env, model.text, variables)
+                return Prompt(**model.model_dump(exclude={"module", "variables"}))
+
+        msg = f"cannot find prompt with name '{name}' and version '{version}'"
+        raise PromptNotFoundError(msg)
+
+    def set(self, *, prompt: Prompt, overwrite: bool = False) -> None:  # noqa: ARG002  # pylint: disable=unused-argument
+        """
+        Compiled registries are read-only, add prompts to the source registry and compile it again.
+
+        Raises:
+            ReadOnlyRegistryError: Always
+        """
+        msg = "Compiled prompt registries are read-only"
+        raise ReadOnlyRegistryError(msg)
+
+    def _load_template(self, module_name: str) -> Template:
+        """Import the compiled module of a template, the first time it's requested."""
+        template = self._templates.get(module_name)
+        if template is None:
+            module = importlib.import_module(f"{self._package}.{module_name}")
+            template = env.template_class.from_module_dict(env, module.__dict__, env.make_globals(None))
+            self._templates[module_name] = template
+        return template
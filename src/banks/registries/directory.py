@@ -130,6 +130,15 @@ class DirectoryPromptRegistry:
                 return Prompt(**pf.model_dump())
         raise PromptNotFoundError
 
+    def list_prompts(self) -> list[PromptModel]:
+        """
+        Return all the prompts stored in the registry.
+
+        Returns:
+            A list of PromptModel objects, one per prompt version
+        """
+        return [PromptModel(**pf.model_dump()) for pf in self._index.files if pf.path and pf.path.exists()]
+
     def set(self, *, prompt: Prompt, overwrite: bool = False):
         """
         Store a prompt in the registry.
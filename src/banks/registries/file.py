@@ -67,6 +67,15 @@ class FilePromptRegistry:
         _, model = self._get_prompt_model(name, version)
         return Prompt(**model.model_dump())
 
+    def list_prompts(self) -> list[PromptModel]:
+        """
+        Return all the prompts stored in the registry.
+
+        Returns:
+            A list of PromptModel objects, one per prompt version
+        """
+        return list(self._index.prompts)
+
     def set(self, *, prompt: Prompt, overwrite: bool = False) -> None:
         """
         Store a prompt in the registry.
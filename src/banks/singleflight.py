@@ -0,0 +1,80 @@
+# SPDX-FileCopyrightText: 2023-present Massimiliano Pippi <mpippi@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+"""
+Coalescing of concurrent calls doing the same work.
+
+When many callers need the same result at once, as when a burst of requests renders a prompt
+with the same context before the first render reaches the cache, only the first caller does the
+work and the others wait for its result.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from collections.abc import Awaitable, Hashable
+from concurrent.futures import Future
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Run a function once per key at a time, across threads."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future[Any]] = {}
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> T:
+        """
+        Return the result of `func`, or of the call already running for `key`.
+
+        Callers with the same key as a running call wait for it, getting its result or its
+        exception, instead of calling their own `func`.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if future is None:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """Run a coroutine function once per key at a time, within an event loop."""
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Task[Any]] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Return the result of `func`, or of the call already running for `key`.
+
+        The call runs in a task of its own, so that a caller being cancelled doesn't cancel the
+        work the other callers are waiting for.
+        """
+        task = self._calls.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda t: self._forget(key, t))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task[Any]) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
@@ -4,14 +4,13 @@
 from __future__ import annotations
 
 import base64
-import re
 from base64 import b64decode, b64encode
 from binascii import Error as BinasciiError
+from collections.abc import Iterable, Iterator
 from enum import Enum
-from functools import lru_cache
 from inspect import Parameter, getdoc, signature
 from pathlib import Path
-from typing import Callable, Literal, Union, cast
+from typing import Callable, Literal, TypeVar, Union, cast
 
 import filetype  # type: ignore[import-untyped]
 from pydantic import BaseModel
@@ -21,6 +20,8 @@ from .config import config
 from .utils import parse_params_from_docstring, python_type_to_jsonschema
 
 # pylint: disable=invalid-name
+_Model = TypeVar("_Model", bound=BaseModel)
+
 CONTENT_BLOCK_END = "</content_block>"
 
 
@@ -33,16 +34,33 @@ def content_block_start(sentinel: str) -> str:
     return f"<content_block>{sentinel}"
 
 
-@lru_cache(maxsize=16)
-def _content_block_regex(sentinel: str) -> re.Pattern[str]:
-    """Build the pattern splitting a rendered message into content blocks and plain text.
+def _scan_content_blocks(content: str, sentinel: str) -> Iterator[tuple[bool, int, int]]:
+    """Split a rendered message into content blocks and plain text, in a single pass.
 
-    The marker carries the render sentinel so that only filter output is parsed as a
-    structured block; anything else stays literal text.
+    Yields `(is_block, start, end)` spans of `content`: for content blocks the span covers the
+    JSON between the markers, for plain text the text itself. The markers carry the render
+    sentinel so that only filter output is parsed as a structured block; an opening marker
+    that isn't followed by `{...}` and the closing marker on the same line stays literal text.
     """
-    start = re.escape(content_block_start(sentinel))
-    end = re.escape(CONTENT_BLOCK_END)
-    return re.compile(rf"({start}\{{.*?\}}{end})|((?:(?!{start})[\s\S])+)")
+    start_marker = content_block_start(sentinel)
+    end_marker = "}" + CONTENT_BLOCK_END
+    text_start = 0
+    pos = content.find(start_marker)
+    while pos != -1:
+        json_start = pos + len(start_marker)
+        # The closing brace can't be the opening one, hence the search from `json_start + 1`
+        json_end = content.find(end_marker, json_start + 1) if content.startswith("{", json_start) else -1
+        if json_end == -1 or content.find("\n", json_start, json_end) != -1:
+            pos = content.find(start_marker, json_start)
+            continue
+        if text_start < pos:
+            yield False, text_start, pos
+        json_end += 1
+        yield True, json_start, json_end
+        text_start = json_end + len(CONTENT_BLOCK_END)
+        pos = content.find(start_marker, text_start)
+    if text_start < len(content):
+        yield False, text_start, len(content)
 
 
 def _safe_resolve_path(file_path: Path) -> Path:
@@ -291,6 +309,36 @@ class ChatMessage(BaseModel):
     name: str | None = None
 
 
+class ChatMessageCollector:
+    """Collects the messages built by `chat` tags during a structured render.
+
+    Instead of its JSON, a collected message leaves a reference to its position in the rendered
+    text. Parsing the messages back then comes down to resolving the references, and since the
+    references end up wherever the text goes, messages keep their order and are dropped or
+    repeated along with it.
+    """
+
+    # What follows the sentinel in a reference, JSON messages start with `{` instead
+    REF_PREFIX = "@"
+
+    def __init__(self) -> None:
+        self.messages: list[ChatMessage] = []
+
+    def add(self, message: ChatMessage, sentinel: str) -> str:
+        """Collect `message` and return the line referencing it."""
+        self.messages.append(message)
+        return f"{sentinel}{self.REF_PREFIX}{len(self.messages) - 1}\n"
+
+    def resolve(self, payload: str) -> ChatMessage | None:
+        """Return the message a reference points to, `payload` being the reference without the sentinel."""
+        if not payload.startswith(self.REF_PREFIX):
+            return None
+        index = payload[len(self.REF_PREFIX) :].rstrip()
+        if not index.isdecimal() or int(index) >= len(self.messages):
+            return None
+        return self.messages[int(index)]
+
+
 class FunctionParameter(BaseModel):
     type: str
     description: str
@@ -378,18 +426,13 @@ def chat_message_from_text(role: str, content: str, sentinel: str | None = None)
     text, so that untrusted input can never be turned into a structured block.
     """
     content_blocks: list[ContentBlock] = []
-    block_start = content_block_start(sentinel) if sentinel else ""
-
-    # Find all content block matches
-    matches = _content_block_regex(sentinel).finditer(content) if sentinel else []
-    for match in matches:
-        if match.group(1):
-            # content block match
-            content_block_json_str = match.group(1).strip().removeprefix(block_start).removesuffix(CONTENT_BLOCK_END)
-            content_blocks.append(ContentBlock.model_validate_json(content_block_json_str))
-        elif match.group(2):
-            # plain-text match
-            text = match.group(2).strip()
+
+    spans = _scan_content_blocks(content, sentinel) if sentinel else ()
+    for is_block, start, end in spans:
+        if is_block:
+            content_blocks.append(ContentBlock.model_validate_json(content[start:end]))
+        else:
+            text = content[start:end].strip()
             if text:
                 content_blocks.append(ContentBlock(type=ContentBlockType.text, text=text))
 
@@ -400,3 +443,30 @@ def chat_message_from_text(role: str, content: str, sentinel: str | None = None)
     final_content = content_blocks
 
     return ChatMessage(role=role, content=final_content)
+
+
+def copy_chat_messages(messages: Iterable[ChatMessage]) -> list[ChatMessage]:
+    """
+    Return copies of `messages` that can be changed without affecting the originals.
+
+    Strings can't be changed, so unlike `model_copy(deep=True)` this only copies the models and
+    the lists holding them, which makes it cheaper than parsing the messages again.
+    """
+    return [_copy_model(message) for message in messages]
+
+
+def _copy_model(model: _Model) -> _Model:
+    # What `BaseModel.__copy__` does, without its checks for private attributes
+    fields = model.__dict__.copy()
+    for name, value in fields.items():
+        t = type(value)
+        if t is list:
+            fields[name] = [_copy_model(item) if isinstance(item, BaseModel) else item for item in value]
+        elif value is not None and t is not str and isinstance(value, BaseModel):
+            fields[name] = _copy_model(value)
+    new = object.__new__(type(model))
+    object.__setattr__(new, "__dict__", fields)
+    object.__setattr__(new, "__pydantic_fields_set__", set(model.__pydantic_fields_set__))
+    object.__setattr__(new, "__pydantic_extra__", model.__pydantic_extra__)
+    object.__setattr__(new, "__pydantic_private__", model.__pydantic_private__)
+    return new
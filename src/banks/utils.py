@@ -32,6 +32,18 @@ def generate_canary_word(prefix: str = "BANKS[", suffix: str = "]", token_length
 SENTINEL_VAR = "_banks_sentinel"
 
 
+# Name of the context variable holding the `ChatMessageCollector` of a structured render.
+CHAT_COLLECTOR_VAR = "_banks_chat_collector"
+
+
+# Name of the template global holding the `CompletionPrefetcher` of a template.
+COMPLETION_PREFETCH_VAR = "_banks_completion_prefetch"
+
+
+# Name of the context variable holding the `PrefetchedCompletions` of a render.
+COMPLETION_PREFETCHED_VAR = "_banks_completion_prefetched"
+
+
 def generate_sentinel() -> str:
     return secrets.token_hex(16)
 
@@ -51,6 +63,45 @@ def ensure_environment_sentinel(environment) -> None:
     environment.globals.setdefault(SENTINEL_VAR, generate_sentinel())
 
 
+class SentinelStripper:
+    """Remove the sentinel from text produced in chunks, like a streamed render.
+
+    The output is the same as removing the sentinel from the whole text at once: the end of a
+    chunk that could be the beginning of a sentinel is held back until the next chunk tells.
+    """
+
+    def __init__(self, sentinel: str) -> None:
+        self._sentinel = sentinel
+        self._pending = ""
+
+    def feed(self, chunk: str) -> str:
+        """Return the part of the text seen so far that is certainly free of sentinels."""
+        buf = self._pending + chunk
+        sentinel = self._sentinel
+        parts = []
+        pos = 0
+        while (i := buf.find(sentinel, pos)) != -1:
+            parts.append(buf[pos:i])
+            pos = i + len(sentinel)
+
+        # Hold back the longest tail that is a prefix of the sentinel
+        keep = 0
+        for k in range(min(len(sentinel) - 1, len(buf) - pos), 0, -1):
+            if buf.endswith(sentinel[:k]):
+                keep = k
+                break
+
+        end = len(buf) - keep
+        parts.append(buf[pos:end])
+        self._pending = buf[end:]
+        return "".join(parts)
+
+    def flush(self) -> str:
+        """Return the text held back, once there are no more chunks."""
+        pending, self._pending = self._pending, ""
+        return pending
+
+
 def python_type_to_jsonschema(python_type: type) -> str:
     """Given a Python type, returns the jsonschema string describing it."""
     if python_type is str:
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from banks.batch import chunked, map_chunks
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
+    with pytest.raises(ValueError, match="chunk_size must be a positive number"):
+        list(chunked([1], 0))
+
+
+@pytest.mark.parametrize("max_workers", [None, 1, 4])
+def test_map_chunks_order(max_workers):
+    def double(chunk):
+        return [i * 2 for i in chunk]
+
+    assert list(map_chunks(double, range(1000), max_workers=max_workers, chunk_size=3)) == [i * 2 for i in range(1000)]
+
+
+def test_map_chunks_threads():
+    threads = set()
+
+    def record(chunk):
+        threads.add(threading.get_ident())
+        return chunk
+
+    list(map_chunks(record, range(100), max_workers=2, chunk_size=10))
+    assert threading.get_ident() not in threads
+
+
+def test_map_chunks_lazy():
+    consumed = []
+
+    def items():
+        for i in range(1000):
+            consumed.append(i)
+            yield i
+
+    results = map_chunks(lambda chunk: chunk, items(), max_workers=2, chunk_size=10)
+    assert next(results) == 0
+    # Only a few chunks per worker are read ahead
+    assert len(consumed) <= 5 * 10
+    results.close()
+
+
+def test_map_chunks_error():
+    def fail(chunk):
+        msg = "boom"
+        raise ValueError(msg)
+
+    with pytest.raises(ValueError, match="boom"):
+        list(map_chunks(fail, range(10), max_workers=2))
@@ -1,6 +1,33 @@
+import hashlib
+import pickle
+import random
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
 import pytest
 
-from banks.cache import DefaultCache
+from banks import Prompt
+from banks.cache import (
+    AsyncCacheAdapter,
+    AsyncRenderCache,
+    BatchRenderCache,
+    CacheStats,
+    CompressedCache,
+    DefaultCache,
+    HashFingerprint,
+    MessagesRenderCache,
+    RenderCache,
+    ShardedCache,
+    SharedCache,
+    is_async_cache,
+    pickle_fingerprint,
+)
+from banks.cache.sqlite import SQLiteCache
+from banks.types import ChatMessage
+from banks.utils import SENTINEL_VAR
 
 
 @pytest.fixture
@@ -24,7 +51,425 @@ def test_default_cache_get(cache):
     assert cache.get({"bar"}) is None
 
 
+def test_default_cache_by_key(cache):
+    key = cache.fingerprint({"foo": "bar"})
+    cache.set_by_key(key, "My prompt")
+    assert cache.get({"foo": "bar"}) == "My prompt"
+    assert cache.get_by_key(key) == "My prompt"
+    assert cache.get_by_key(None) is None
+
+
 def test_default_cache_clear(cache):
     cache.set({"foo": "bar"}, "My prompt")
     cache.clear()
     assert not len(cache._cache)
+
+
+def test_default_cache_max_entries():
+    cache = DefaultCache(max_entries=2)
+    cache.set({"n": 1}, "one")
+    cache.set({"n": 2}, "two")
+    # touch the first entry so that the second is the least recently used
+    assert cache.get({"n": 1}) == "one"
+    cache.set({"n": 3}, "three")
+
+    assert cache.get({"n": 2}) is None
+    assert cache.get({"n": 1}) == "one"
+    assert cache.get({"n": 3}) == "three"
+    assert cache.stats()[:4] == (3, 1, 1, 2)
+
+
+def test_default_cache_max_bytes():
+    cache = DefaultCache(max_entries=0, max_bytes=1000)
+    cache.set({"n": 1}, "x" * 400)
+    cache.set({"n": 2}, "x" * 400)
+    assert cache.stats().size == 1
+    assert cache.get({"n": 2}) is not None
+    assert cache.stats().bytes <= 1000
+
+    # an entry larger than the whole cache is not stored
+    cache.set({"n": 3}, "x" * 2000)
+    assert cache.get({"n": 3}) is None
+    assert cache.stats().size == 1
+
+    # nor does it leave the render it replaces in the cache
+    cache.set({"n": 2}, "x" * 2000)
+    assert cache.get({"n": 2}) is None
+    assert cache.stats().size == 0
+    assert cache.stats().bytes == 0
+
+
+def test_default_cache_overwrite():
+    cache = DefaultCache()
+    cache.set({"n": 1}, "one")
+    size = cache.stats().bytes
+    cache.set({"n": 1}, "uno")
+    assert cache.get({"n": 1}) == "uno"
+    assert cache.stats().size == 1
+    assert cache.stats().bytes == size
+
+
+def test_default_cache_ttl():
+    cache = DefaultCache(ttl=10)
+    with mock.patch("banks.cache.time.monotonic", return_value=100):
+        cache.set({"n": 1}, "one")
+        cache.set({"n": 2}, "two")
+    with mock.patch("banks.cache.time.monotonic", return_value=105):
+        assert cache.get({"n": 1}) == "one"
+    with mock.patch("banks.cache.time.monotonic", return_value=110):
+        assert cache.get({"n": 1}) is None
+        # expired entries are dropped when new ones are stored
+        cache.set({"n": 3}, "three")
+    assert cache.stats() == CacheStats(hits=1, misses=1, evictions=2, size=1, bytes=cache.stats().bytes)
+
+
+def test_default_cache_ttl_recently_used():
+    cache = DefaultCache(ttl=10)
+    with mock.patch("banks.cache.time.monotonic", return_value=100):
+        cache.set({"n": 1}, "one")
+    with mock.patch("banks.cache.time.monotonic", return_value=105):
+        cache.set({"n": 2}, "two")
+        # the first entry is now the most recently used, behind one that hasn't expired
+        assert cache.get({"n": 1}) == "one"
+    with mock.patch("banks.cache.time.monotonic", return_value=111):
+        cache.set({"n": 3}, "three")
+    # the expired entry no longer counts towards the bounds
+    assert cache.stats().size == 2
+    assert cache.stats().evictions == 1
+
+
+def test_default_cache_clear_stats(cache):
+    cache.set({"foo": "bar"}, "My prompt")
+    cache.clear()
+    assert cache.stats().size == 0
+    assert cache.stats().bytes == 0
+
+
+def test_default_cache_config(monkeypatch):
+    monkeypatch.setenv("BANKS_RENDER_CACHE_MAX_ENTRIES", "3")
+    monkeypatch.setenv("BANKS_RENDER_CACHE_MAX_BYTES", "4096")
+    monkeypatch.setenv("BANKS_RENDER_CACHE_TTL", "1.5")
+    cache = DefaultCache()
+    assert (cache.max_entries, cache.max_bytes, cache.ttl) == (3, 4096, 1.5)
+    assert isinstance(cache, RenderCache)
+
+
+def test_default_cache_messages(cache):
+    messages = [ChatMessage(role="user", content="Hello")]
+    assert isinstance(cache, MessagesRenderCache)
+    # messages are only stored along with their render
+    cache.set_messages({"n": 1}, messages)
+    assert cache.get_messages({"n": 1}) is None
+
+    cache.set({"n": 1}, "Hello")
+    size = cache.stats().bytes
+    cache.set_messages({"n": 1}, messages)
+    assert cache.get_messages({"n": 1}) == tuple(messages)
+    assert cache.stats().bytes > size
+    assert cache.stats()[:2] == (1, 0)
+
+    # storing the render again drops the messages parsed out of the previous one
+    cache.set({"n": 1}, "Hello again")
+    assert cache.get_messages({"n": 1}) is None
+    assert cache.stats().bytes < size + 100
+
+
+def test_default_cache_messages_evicted():
+    cache = DefaultCache(max_entries=0, max_bytes=2000)
+    cache.set({"n": 1}, "x" * 400)
+    cache.set({"n": 2}, "x" * 400)
+    # the messages count towards the bound, pushing the least recently used entry out
+    cache.set_messages({"n": 2}, [ChatMessage(role="user", content="x" * 1000)])
+    assert cache.get({"n": 1}) is None
+    assert cache.get_messages({"n": 2}) is not None
+    assert cache.stats().bytes <= 2000
+
+    # messages larger than the whole cache are not stored
+    cache.set_messages({"n": 2}, [ChatMessage(role="user", content="x" * 2000)])
+    assert cache.get_messages({"n": 2})[0].content == "x" * 1000
+
+    cache.clear()
+    assert cache.get_messages({"n": 2}) is None
+    assert cache.stats().bytes == 0
+
+
+@pytest.mark.parametrize("fingerprint", [HashFingerprint(), pickle_fingerprint])
+def test_fingerprint_equal_contexts(fingerprint):
+    assert fingerprint({"a": [1, "x"], "b": {"c": None}}) == fingerprint({"a": [1, "x"], "b": {"c": None}})
+    assert fingerprint({"a": 1}) != fingerprint({"a": "1"})
+    assert fingerprint({"a": 1}) != fingerprint({"a": True})
+    assert fingerprint({"a": [1]}) != fingerprint({"a": (1,)})
+    assert fingerprint({"a": lambda: 1}) is None
+
+
+def test_hash_fingerprint_size():
+    fingerprint = HashFingerprint()
+    assert len(fingerprint({"image": bytes(1024 * 1024)})) == len(fingerprint({}))
+
+
+def test_hash_fingerprint_encoding():
+    fingerprint = HashFingerprint(memo_threshold=4)
+    assert fingerprint({"a": "b"}) != fingerprint({"a": b"b"})
+    assert fingerprint({"ab": ""}) != fingerprint({"a": "b"})
+    assert fingerprint({"a": "long string"}) != fingerprint({"a": b"long string"})
+    assert fingerprint({"a": "long string"}) != fingerprint({"a": ["long string"]})
+    assert fingerprint({"a": {1, 2}}) == fingerprint({"a": {2, 1}})
+    assert fingerprint({"a": {1, 2}}) != fingerprint({"a": {1, 3}})
+
+
+def test_hash_fingerprint_memo():
+    fingerprint = HashFingerprint(memo_size=1, memo_threshold=16)
+    large = b"x" * 32
+    digest = fingerprint({"image": large})
+    with mock.patch("banks.cache.hashlib.sha256", wraps=hashlib.sha256) as mocked_sha256:
+        assert fingerprint({"image": large}) == digest
+        # only the context hash, the image's digest comes from the memo
+        mocked_sha256.assert_called_once()
+    # an equal value that's a different object is hashed to the same digest
+    assert fingerprint({"image": large[:16] + large[16:]}) == digest
+    assert fingerprint({"image": "x" * 32}) != digest
+    assert len(fingerprint._memo) == 1
+
+
+def test_hash_fingerprint_memo_max_bytes():
+    fingerprint = HashFingerprint(memo_threshold=16, memo_max_bytes=3000)
+    values = [bytes([i]) * 1000 for i in range(4)]
+    for value in values:
+        fingerprint({"image": value})
+    # each value takes a bit more than its length, so only two fit
+    assert [entry[0] for entry in fingerprint._memo.values()] == values[2:]
+    assert fingerprint._memo_bytes <= 3000
+
+    # a value larger than the bound isn't kept at all
+    fingerprint({"image": b"x" * 4000})
+    assert [entry[0] for entry in fingerprint._memo.values()] == values[2:]
+
+
+def test_hash_fingerprint_memo_max_bytes_config(monkeypatch):
+    monkeypatch.setenv("BANKS_RENDER_CACHE_MEMO_MAX_BYTES", "1024")
+    assert HashFingerprint().memo_max_bytes == 1024
+
+
+def test_hash_fingerprint_large_str():
+    fingerprint = HashFingerprint(memo_size=0, memo_threshold=16)
+    value = "é✓\ud800x" * 50_000
+    # hashed a chunk at a time, to the digest of the whole string
+    assert fingerprint._digest(value) == hashlib.sha256(value.encode("utf-8", "surrogatepass")).digest()
+    assert fingerprint({"text": value}) != fingerprint({"text": value[:-1] + "y"})
+
+
+def test_hash_fingerprint_small_context():
+    fingerprint = HashFingerprint(memo_threshold=64)
+    with mock.patch("banks.cache.pickle.Pickler", wraps=pickle.Pickler) as mocked_pickler:
+        digest = fingerprint({"topic": "retrogame computing", "words": 500})
+        # hashed out of a single pickle
+        mocked_pickler.assert_not_called()
+        fingerprint({"image": b"x" * 64})
+        mocked_pickler.assert_called_once()
+    assert digest == fingerprint({"topic": "retrogame computing", "words": 500})
+    assert digest != fingerprint({"topic": "retrogame computing", "words": 501})
+    assert fingerprint({"a": "b"}) != fingerprint({"a": ["b"]})
+
+
+def test_hash_fingerprint_cycle():
+    items: list = []
+    items.append(items)
+    assert HashFingerprint()({"items": items}) == HashFingerprint()({"items": items})
+
+
+def test_default_cache_unpicklable():
+    cache = DefaultCache()
+    cache.set({"tool": lambda: 1}, "My prompt")
+    assert cache.get({"tool": lambda: 1}) is None
+    assert cache.stats().size == 0
+    assert cache.stats().misses == 1
+
+
+def test_default_cache_fingerprint():
+    cache = DefaultCache(fingerprint=pickle_fingerprint)
+    cache.set({"foo": "bar"}, "My prompt")
+    assert next(iter(cache._cache)) == pickle_fingerprint({"foo": "bar"})
+
+
+@pytest.mark.asyncio
+async def test_async_cache_adapter():
+    cache = DefaultCache()
+    adapter = AsyncCacheAdapter(cache)
+    assert is_async_cache(adapter)
+    assert isinstance(adapter, AsyncRenderCache)
+    assert not is_async_cache(cache)
+
+    main_thread = threading.get_ident()
+    threads = []
+    cache.set = mock.Mock(side_effect=lambda *_: threads.append(threading.get_ident()))
+    await adapter.set({"foo": "bar"}, "My prompt")
+    assert threads[0] != main_thread
+
+    adapter.offload = False
+    await adapter.set({"foo": "bar"}, "My prompt")
+    assert threads[1] == main_thread
+
+
+@pytest.mark.asyncio
+async def test_async_cache_adapter_executor():
+    cache = DefaultCache()
+    with ThreadPoolExecutor(1, thread_name_prefix="cache") as executor:
+        adapter = AsyncCacheAdapter(cache, executor=executor)
+        with mock.patch.object(cache, "get", side_effect=lambda _: threading.current_thread().name):
+            assert (await adapter.get({})).startswith("cache")
+        await adapter.set({"foo": "bar"}, "My prompt")
+        assert await adapter.get({"foo": "bar"}) == "My prompt"
+        assert (await adapter.stats()).size == 1
+        await adapter.clear()
+        assert await adapter.get({"foo": "bar"}) is None
+
+
+def test_compressed_cache():
+    cache = CompressedCache(compression="zlib", threshold=100)
+    long_prompt = "Describe this image: data:image/png;base64," + "QUFB" * 1000 + " ✓"
+    cache.set({"n": 1}, "Short ✓")
+    cache.set({"n": 2}, long_prompt)
+    assert cache.get({"n": 1}) == "Short ✓"
+    assert cache.get({"n": 2}) == long_prompt
+    assert cache.get({"n": 3}) is None
+
+    stored = cache.backend._cache
+    assert sorted(value.partition(":")[0] for value in stored.values()) == ["none", "zlib"]
+    assert cache.stats().bytes < len(long_prompt) / 10
+
+    stats = cache.compression_stats()
+    assert (stats.compressed, stats.raw, stats.bytes_in) == (1, 1, len(long_prompt.encode()))
+    assert stats.ratio > 10
+    assert stats.compress_time >= 0
+    assert stats.decompress_time >= 0
+
+
+def test_compressed_cache_text_backend(tmp_path):
+    backend = SQLiteCache(tmp_path / "renders.sqlite")
+    cache = CompressedCache(backend, compression="zlib", threshold=0)
+    rng = random.Random(0)  # noqa: S311
+    prompt = "".join(rng.choice("abcdefghij✓") for _ in range(20000))
+    cache.set({"n": 1}, prompt)
+    backend.flush()
+    assert cache.get({"n": 1}) == prompt
+
+    compressed = cache.compression_stats().bytes_out
+    conn = sqlite3.connect(backend.path)
+    try:
+        (value,) = conn.execute("SELECT value FROM renders").fetchone()
+    finally:
+        conn.close()
+    # base85 takes 5 bytes per 4, where UTF-8 would take up to 2 per byte
+    assert value.startswith(b"zlib+b85:")
+    assert len(value) <= len(b"zlib+b85:") + compressed * 5 / 4 + 4
+    backend.close()
+
+
+@pytest.mark.parametrize("compression", ["zlib", "zstd"])
+def test_compressed_cache_non_ascii(compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    cache = CompressedCache(compression=compression, threshold=0)
+    cache.set({"n": 1}, "café ✓")
+    assert cache.get({"n": 1}) == "café ✓"
+
+
+def test_compressed_cache_no_compression():
+    with pytest.raises(ValueError, match="Unknown compression 'none'"):
+        CompressedCache(compression="none")
+
+
+def test_compressed_cache_default_codec():
+    try:
+        import zstandard  # noqa: F401
+
+        expected = "zstd"
+    except ImportError:
+        expected = "zlib"
+    assert CompressedCache()._codec.name == expected
+    assert CompressedCache().compression_stats().ratio == 1.0
+
+
+def test_compressed_cache_batches():
+    cache = CompressedCache(SharedCache(), threshold=0)
+    assert isinstance(cache, BatchRenderCache)
+    cache.set_many([({"n": 1}, "one"), ({"n": 2}, "two")])
+    assert cache.get_many([{"n": 1}, {"n": 2}, {"n": 3}]) == ["one", "two", None]
+    assert cache.compression_stats().compressed == 2
+
+
+def test_compressed_cache_shared():
+    cache = SharedCache(CompressedCache(threshold=0))
+    p1 = Prompt("{{ x | image }}", render_cache=cache)
+    p2 = Prompt("{{ x | image }}", render_cache=cache)
+    text = p1._render({"x": "https://example.com/cat.png"})
+    # the sentinel is put back in the decompressed render
+    assert p2._render({"x": "https://example.com/cat.png"}) == text.replace(
+        p1.defaults[SENTINEL_VAR], p2.defaults[SENTINEL_VAR]
+    )
+    assert cache.backend.compression_stats().compressed == 1
+
+
+def test_sharded_cache():
+    cache = ShardedCache(shards=4, max_entries=10, max_bytes=0)
+    assert isinstance(cache, MessagesRenderCache)
+    assert [shard.max_entries for shard in cache._shards] == [3] * 4
+    for n in range(100):
+        cache.set({"n": n}, f"prompt {n}")
+    assert cache.get({"n": 99}) == "prompt 99"
+    assert cache.get({"n": 100}) is None
+
+    stats = cache.stats()
+    assert stats.size <= 12
+    assert stats.size + stats.evictions == 100
+    assert (stats.hits, stats.misses) == (1, 1)
+    assert stats.bytes == sum(shard.stats().bytes for shard in cache._shards)
+
+    messages = [ChatMessage(role="user", content="prompt 99")]
+    cache.set_messages({"n": 99}, messages)
+    assert cache.get_messages({"n": 99}) == tuple(messages)
+
+    cache.clear()
+    assert cache.stats()[3:] == (0, 0)
+
+
+def test_sharded_cache_shards():
+    with pytest.raises(ValueError, match="at least one shard"):
+        ShardedCache(shards=0)
+
+
+@pytest.mark.parametrize("cache", [DefaultCache(max_entries=50), ShardedCache(shards=8, max_entries=50)])
+def test_cache_concurrent_access(cache):
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)  # noqa: S311
+        try:
+            for _ in range(2000):
+                n = rng.randrange(100)
+                op = rng.random()
+                if op < 0.5:
+                    prompt = cache.get({"n": n})
+                    if prompt is not None and prompt != f"prompt {n}":
+                        errors.append((n, prompt))
+                elif op < 0.99:
+                    cache.set({"n": n}, f"prompt {n}")
+                else:
+                    cache.clear()
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    shards = cache._shards if isinstance(cache, ShardedCache) else [cache]
+    for shard in shards:
+        # the accounting matches what's left in the cache
+        assert shard.stats().size == len(shard._cache) <= shard.max_entries
+        assert shard.stats().bytes == sum(
+            sys.getsizeof(key) + sys.getsizeof(prompt) for key, prompt in shard._cache.items()
+        )
@@ -80,3 +80,14 @@ And here is an image:
     assert blocks[1].type == "image_url"
     assert blocks[2].type == "text"
     assert blocks[3].type == "image_url"
+
+
+@pytest.mark.asyncio
+async def test_async_environment():
+    from jinja2 import Environment
+
+    from banks.extensions.chat import ChatExtension
+
+    e = Environment(autoescape=True, enable_async=True, extensions=[ChatExtension])
+    rendered = await e.from_string('{% chat role="user" %}Hello {{ name }}{% endchat %}').render_async(name="world")
+    assert rendered.endswith('{"role":"user","content":[{"type":"text","text":"Hello world"}]}\n')
@@ -0,0 +1,130 @@
+import sys
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from banks.cli import main
+from banks.compiler import template_cache
+from banks.env import env
+from banks.errors import CompilationError, PromptNotFoundError, ReadOnlyRegistryError
+from banks.prompt import Prompt
+from banks.registries.compiled import MANIFEST_NAME, CompiledManifest, CompiledPromptRegistry, compile_registry
+from banks.registries.directory import DirectoryPromptRegistry
+from banks.registries.file import FilePromptRegistry
+
+
+@pytest.fixture
+def source_registry(tmp_path: Path):
+    d = tmp_path / "templates"
+    d.mkdir()
+    for fp in (Path(__file__).parent / "templates").iterdir():
+        (d / fp.name).write_text(fp.read_text())
+    return DirectoryPromptRegistry(str(d), force_reindex=True)
+
+
+@pytest.fixture
+def import_path(tmp_path: Path):
+    sys.path.insert(0, str(tmp_path))
+    yield tmp_path
+    sys.path.remove(str(tmp_path))
+    for name in list(sys.modules):
+        if name.startswith("compiled_"):
+            del sys.modules[name]
+
+
+def test_compile_registry(source_registry, import_path):
+    package_dir = compile_registry(source_registry, import_path, "compiled_dir")
+
+    assert (package_dir / "__init__.py").exists()
+    manifest = CompiledManifest.model_validate_json((package_dir / MANIFEST_NAME).read_text())
+    assert {p.name for p in manifest.prompts} == {p.name for p in source_registry.list_prompts()}
+    assert len(list(package_dir.glob("tmpl_*.py"))) == len(manifest.prompts)
+
+
+def test_get_does_not_compile(source_registry, import_path):
+    compile_registry(source_registry, import_path, "compiled_get")
+    registry = CompiledPromptRegistry("compiled_get")
+    template_cache.clear()
+
+    with mock.patch.object(env, "from_string") as mocked_from_string:
+        with mock.patch.object(env, "compile") as mocked_compile:
+            with mock.patch.object(env, "parse") as mocked_parse:
+                p = registry.get(name="chat")
+                messages = p.chat_messages()
+                assert registry.get(name="chat").text() == p.text()
+                mocked_from_string.assert_not_called()
+                mocked_compile.assert_not_called()
+                mocked_parse.assert_not_called()
+
+    expected = source_registry.get(name="chat")
+    assert p.raw == expected.raw
+    assert p.text() == expected.text()
+    assert messages == expected.chat_messages()
+
+
+def test_get_not_found(source_registry, import_path):
+    compile_registry(source_registry, import_path, "compiled_not_found")
+    registry = CompiledPromptRegistry("compiled_not_found")
+    with pytest.raises(PromptNotFoundError):
+        registry.get(name="blog", version="42")
+
+
+def test_set_read_only(source_registry, import_path):
+    compile_registry(source_registry, import_path, "compiled_set")
+    registry = CompiledPromptRegistry("compiled_set")
+    with pytest.raises(ReadOnlyRegistryError):
+        registry.set(prompt=Prompt("foo", name="foo"))
+
+
+def test_environment_mismatch(source_registry, import_path):
+    compile_registry(source_registry, import_path, "compiled_mismatch")
+    with mock.patch("banks.registries.compiled.environment_fingerprint", return_value="something else"):
+        with pytest.raises(CompilationError, match="different environment settings"):
+            CompiledPromptRegistry("compiled_mismatch")
+
+
+def test_recompile_removes_stale_modules(tmp_path, import_path):
+    registry = FilePromptRegistry(str(tmp_path / "index.json"))
+    registry.set(prompt=Prompt("Version one", name="p"))
+    package_dir = compile_registry(registry, import_path, "compiled_stale")
+    registry.set(prompt=Prompt("Version two", name="p"), overwrite=True)
+    compile_registry(registry, import_path, "compiled_stale")
+
+    assert len(list(package_dir.glob("tmpl_*.py"))) == 1
+    assert CompiledPromptRegistry("compiled_stale").get(name="p").text() == "Version two"
+
+
+def test_cli_compile(tmp_path, import_path, capsys):
+    d = tmp_path / "registry"
+    d.mkdir()
+    source_registry = DirectoryPromptRegistry(str(d))
+    source_registry.set(prompt=Prompt("Write a blog post about {{ topic }}", name="blog"))
+    source_registry.set(prompt=Prompt("Summarize {{ text }}", name="summarize", version="2"))
+
+    main(["compile", str(d), "--output", str(import_path), "--package", "compiled_cli"])
+    assert "Compiled 2 prompts" in capsys.readouterr().out
+
+    registry = CompiledPromptRegistry("compiled_cli")
+    assert registry.get(name="blog").text({"topic": "AI"}) == "Write a blog post about AI"
+    assert registry.get(name="summarize", version="2").raw == "Summarize {{ text }}"
+
+
+def test_cli_compile_missing_registry(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as excinfo:
+        main(["compile", "nope/typo.json", "--output", "out"])
+    assert excinfo.value.code != 0
+    assert "no registry directory or index file at 'nope/typo.json'" in capsys.readouterr().err
+    # nothing is created for the mistyped registry, nor written to the output
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cli_compile_empty_registry(tmp_path, capsys):
+    d = tmp_path / "registry"
+    d.mkdir()
+    with pytest.raises(SystemExit) as excinfo:
+        main(["compile", str(d), "--output", str(tmp_path / "out")])
+    assert excinfo.value.code != 0
+    assert "has no prompts to compile" in capsys.readouterr().err
+    assert not (tmp_path / "out").exists()
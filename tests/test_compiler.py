@@ -0,0 +1,189 @@
+import os
+from unittest import mock
+
+import pytest
+from jinja2 import Environment
+
+from banks import Prompt
+from banks.compiler import (
+    BoundedFileSystemBytecodeCache,
+    TemplateCache,
+    bytecode_cache_from_config,
+    compile_template,
+    environment_fingerprint,
+    referenced_variables,
+    template_cache,
+)
+from banks.env import env
+
+
+@pytest.fixture
+def cache():
+    return TemplateCache(maxsize=2)
+
+
+def test_get_template_hit(cache):
+    t1 = cache.get_template(env, "Hello {{ name }}")
+    t2 = cache.get_template(env, "Hello {{ name }}")
+    assert t1 is t2
+    assert t1.render(name="world") == "Hello world"
+    info = cache.info()
+    assert (info.hits, info.misses, info.maxsize, info.currsize) == (1, 1, 2, 1)
+
+
+def test_get_template_evicts_least_recently_used(cache):
+    t1 = cache.get_template(env, "one")
+    cache.get_template(env, "two")
+    # touch "one" so that "two" is the oldest entry
+    cache.get_template(env, "one")
+    cache.get_template(env, "three")
+    assert cache.info().currsize == 2
+    assert cache.get_template(env, "one") is t1
+    assert cache.info().misses == 3
+    cache.get_template(env, "two")
+    assert cache.info().misses == 4
+
+
+def test_get_template_disabled():
+    cache = TemplateCache(maxsize=0)
+    assert cache.get_template(env, "one") is not cache.get_template(env, "one")
+    assert cache.info().currsize == 0
+
+
+def test_get_template_environment_config():
+    cache = TemplateCache()
+    e1 = Environment(autoescape=True, trim_blocks=True)
+    e2 = Environment(autoescape=True, trim_blocks=False)
+    t1 = cache.get_template(e1, "{% if true %}\nfoo{% endif %}")
+    t2 = cache.get_template(e2, "{% if true %}\nfoo{% endif %}")
+    assert t1 is not t2
+    assert t1.render() == "foo"
+    assert t2.render() == "\nfoo"
+    assert t1.environment is e1
+    assert t2.environment is e2
+
+
+def test_environment_fingerprint():
+    assert environment_fingerprint(Environment(autoescape=True)) == environment_fingerprint(
+        Environment(autoescape=True)
+    )
+    assert environment_fingerprint(Environment(autoescape=True)) != environment_fingerprint(
+        Environment(autoescape=True, lstrip_blocks=True)
+    )
+    assert environment_fingerprint(env) != environment_fingerprint(Environment(autoescape=True))
+
+
+def test_clear(cache):
+    cache.get_template(env, "one")
+    cache.get_template(env, "one")
+    cache.clear()
+    assert cache.info() == (0, 0, 2, 0)
+
+
+def test_maxsize_from_config(monkeypatch):
+    monkeypatch.setenv("BANKS_TEMPLATE_CACHE_SIZE", "7")
+    assert TemplateCache().maxsize == 7
+
+
+def test_prompts_share_template():
+    text = "A prompt compiled once: {{ topic }}"
+    misses = template_cache.info().misses
+    p1 = Prompt(text)
+    p2 = Prompt(text)
+    assert p1._template is p2._template
+    assert template_cache.info().misses == misses + 1
+    assert p2.text({"topic": "cache"}) == "A prompt compiled once: cache"
+
+
+def test_compile_template_bytecode_cache(tmp_path):
+    bcc = BoundedFileSystemBytecodeCache(tmp_path / "bytecode")
+    e = Environment(autoescape=True, bytecode_cache=bcc)
+    assert compile_template(e, "Hello {{ name }}").render(name="world") == "Hello world"
+    assert len(os.listdir(tmp_path / "bytecode")) == 1
+
+    # A fresh environment, as a restarted process would have, finds the compiled code on disk
+    e = Environment(autoescape=True, bytecode_cache=bcc)
+    with mock.patch.object(e, "compile", wraps=e.compile) as mocked_compile:
+        assert compile_template(e, "Hello {{ name }}").render(name="world") == "Hello world"
+        mocked_compile.assert_not_called()
+
+        # A changed source gets its own entry
+        assert compile_template(e, "Hi {{ name }}").render(name="world") == "Hi world"
+        mocked_compile.assert_called_once()
+    assert len(os.listdir(tmp_path / "bytecode")) == 2
+
+
+def test_compile_template_bytecode_cache_environment_config(tmp_path):
+    bcc = BoundedFileSystemBytecodeCache(tmp_path)
+    source = "{% if true %}\nfoo{% endif %}"
+    assert (
+        compile_template(Environment(autoescape=True, bytecode_cache=bcc, trim_blocks=True), source).render() == "foo"
+    )
+    assert compile_template(Environment(autoescape=True, bytecode_cache=bcc), source).render() == "\nfoo"
+
+
+def test_bytecode_cache_max_size(tmp_path):
+    bcc = BoundedFileSystemBytecodeCache(tmp_path)
+    e = Environment(autoescape=True, bytecode_cache=bcc)
+    compile_template(e, "one")
+    entry_size = sum(f.stat().st_size for f in tmp_path.iterdir())
+    os.utime(next(tmp_path.iterdir()), (0, 0))
+
+    bcc.max_size = entry_size
+    compile_template(e, "two")
+    assert len(os.listdir(tmp_path)) == 1
+    # "one" was the oldest entry and got pruned
+    with mock.patch.object(e, "compile", wraps=e.compile) as mocked_compile:
+        compile_template(e, "two")
+        mocked_compile.assert_not_called()
+
+
+def test_bytecode_cache_from_config(monkeypatch, tmp_path):
+    assert bytecode_cache_from_config() is None
+
+    monkeypatch.setenv("BANKS_BYTECODE_CACHE_ENABLED", "true")
+    monkeypatch.setenv("BANKS_BYTECODE_CACHE_PATH", str(tmp_path / "bcc"))
+    monkeypatch.setenv("BANKS_BYTECODE_CACHE_MAX_SIZE", "1024")
+    bcc = bytecode_cache_from_config()
+    assert isinstance(bcc, BoundedFileSystemBytecodeCache)
+    assert bcc.directory == str(tmp_path / "bcc")
+    assert bcc.max_size == 1024
+
+    monkeypatch.delenv("BANKS_BYTECODE_CACHE_PATH")
+    monkeypatch.setenv("BANKS_USER_DATA_PATH", str(tmp_path))
+    assert bytecode_cache_from_config().directory == str(tmp_path / "bytecode")
+
+
+def test_referenced_variables():
+    source = (
+        "{% set x = 1 %}{{ x }}{{ name }}{% for i in items %}{{ i }}{% endfor %}{% chat role='user' %}{% endchat %}"
+    )
+    assert referenced_variables(env, source) == {"name", "items"}
+    assert referenced_variables(env, "{% extends 'base.jinja' %}") is None
+    assert referenced_variables(env, "{% from 'macros.jinja' import m %}{{ m(name) }}") is None
+
+
+def test_template_cache_referenced_variables(cache):
+    cache.get_template(env, "Hello {{ name }}")
+    with mock.patch.object(env, "parse", wraps=env.parse) as mocked_parse:
+        assert cache.referenced_variables(env, "Hello {{ name }}") == {"name"}
+        assert cache.referenced_variables(env, "Hello {{ name }}") == {"name"}
+        assert mocked_parse.call_count == 1
+        # names of templates that aren't cached aren't kept
+        cache.referenced_variables(env, "Bye {{ name }}")
+        cache.referenced_variables(env, "Bye {{ name }}")
+        assert mocked_parse.call_count == 3
+
+    cache.preload_variables(env, "Bye {{ name }}", None)
+    assert cache.referenced_variables(env, "Bye {{ name }}") is None
+    cache.clear()
+    assert cache.referenced_variables(env, "Bye {{ name }}") == {"name"}
+
+
+def test_prompts_share_referenced_variables():
+    template_cache.clear()
+    with mock.patch.object(env, "parse", wraps=env.parse) as mocked_parse:
+        for _ in range(3):
+            Prompt("Shared {{ name }}").text({"name": "world"})
+        # the template is compiled without going through `parse`, the names need it once
+        assert mocked_parse.call_count == 1
@@ -1,13 +1,35 @@
+import asyncio
+import contextvars
+import gc
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
 from os import getenv
+from typing import Optional
 from unittest import mock
 
 import pytest
+from jinja2 import TemplateSyntaxError
 from jinja2.environment import Environment
-from litellm.types.utils import ChatCompletionMessageToolCall, Function
-
-from banks.errors import InvalidPromptError, LLMError
-from banks.extensions.completion import CompletionExtension
-from banks.types import ChatMessage, Tool
+from litellm.types.utils import ChatCompletionMessageToolCall, Choices, Function, Message, ModelResponse
+
+from banks import Prompt
+from banks.cache.completion import CompletionCache
+from banks.cache.sqlite import SQLiteCache
+from banks.config import config
+from banks.env import env
+from banks.errors import InvalidPromptError, LLMError, ToolCallError
+from banks.extensions.chat import ChatExtension
+from banks.extensions.completion import (
+    CompletionExtension,
+    CompletionPrefetcher,
+    PrefetchedCompletions,
+    _run_tool_calls,
+    _run_tool_calls_async,
+)
+from banks.types import ChatMessage, ChatMessageCollector, Tool
+from banks.utils import COMPLETION_PREFETCH_VAR, COMPLETION_PREFETCHED_VAR
 
 
 @pytest.fixture(autouse=True)
@@ -129,6 +151,17 @@ def test__body_to_messages_ignores_unmarked_lines(ext, sentinel):
     )
 
 
+def test__body_to_messages_collector(ext, sentinel):
+    collector = ChatMessageCollector()
+    body = collector.add(ChatMessage(role="user", content="hello"), sentinel)
+    body += sentinel + '{"role":"system", "content":"json"}\n' + sentinel + "@1"
+
+    assert ext._body_to_messages(body, sentinel, collector) == (
+        [ChatMessage(role="user", content="hello"), ChatMessage(role="system", content="json")],
+        [],
+    )
+
+
 def test__do_completion_no_prompt(ext, jinja_context):
     with pytest.raises(InvalidPromptError, match="Completion must contain at least one chat message"):
         ext._do_completion(jinja_context, "test-model", lambda: " ")
@@ -280,3 +313,497 @@ def test__get_tool_callable_rejects_malicious_import_path(ext):
     tool_call.function.name = "rce"
     with pytest.raises(ValueError):
         ext._get_tool_callable([malicious_tool], tool_call)
+
+
+def _response(content=None, tool_calls=None):
+    return ModelResponse(choices=[Choices(message=Message(content=content, role="assistant", tool_calls=tool_calls))])
+
+
+def test__do_completion_cache(ext, jinja_context, sentinel):
+    ext.environment.completion_cache = CompletionCache()
+    body = sentinel + '{"role":"user", "content":"hello"}'
+    with mock.patch("litellm.completion", return_value=_response("hi")) as mocked_completion:
+        assert ext._do_completion(jinja_context, "test-model", lambda: body) == "hi"
+        assert ext._do_completion(jinja_context, "test-model", lambda: body) == "hi"
+        assert mocked_completion.call_count == 1
+        # a different model is a different request
+        ext._do_completion(jinja_context, "other-model", lambda: body)
+        assert mocked_completion.call_count == 2
+        # and blocks can opt out
+        ext._do_completion(jinja_context, "test-model", lambda: body, use_cache=False)
+        assert mocked_completion.call_count == 3
+
+
+def test__do_completion_cache_tools(ext, jinja_context, sentinel, tools):
+    ext.environment.completion_cache = CompletionCache()
+    calls = []
+    CompletionExtension.register_callable("getenv", lambda key: calls.append(key) or f"value of {key}")
+    tool_call = ChatCompletionMessageToolCall(
+        id="call_1", function=Function(arguments='{"key": "HOME"}', name="getenv")
+    )
+    ext._body_to_messages = mock.MagicMock(return_value=([ChatMessage(role="user", content="hello")], tools))
+
+    with mock.patch(
+        "litellm.completion", side_effect=[_response(tool_calls=[tool_call]), _response("HOME is value of HOME")]
+    ) as mocked_completion:
+        assert ext._do_completion(jinja_context, "test-model", lambda: "") == "HOME is value of HOME"
+        # both the first request and the one following the tool call are served from the cache
+        assert ext._do_completion(jinja_context, "test-model", lambda: "") == "HOME is value of HOME"
+        assert mocked_completion.call_count == 2
+
+    # the tools still run, their results being part of the second request
+    assert calls == ["HOME", "HOME"]
+    assert ext.environment.completion_cache.stats().size == 2
+
+
+@pytest.mark.asyncio
+async def test__do_completion_async_cache(ext, jinja_context, sentinel):
+    ext.environment.completion_cache = CompletionCache()
+    body = sentinel + '{"role":"user", "content":"hello"}'
+    with mock.patch("litellm.acompletion", return_value=_response("hi")) as mocked_completion:
+        assert await ext._do_completion_async(jinja_context, "test-model", lambda: body) == "hi"
+        assert await ext._do_completion_async(jinja_context, "test-model", lambda: body) == "hi"
+        assert mocked_completion.call_count == 1
+        await ext._do_completion_async(jinja_context, "test-model", lambda: body, use_cache=False)
+        assert mocked_completion.call_count == 2
+
+
+def test_completion_cache_ttl():
+    cache = CompletionCache(ttl=10)
+    messages = [{"role": "user", "content": "hello"}]
+    with mock.patch("banks.cache.completion.time.time", return_value=100):
+        cache.set("test-model", messages, None, {"role": "assistant", "content": "hi"})
+    with mock.patch("banks.cache.completion.time.time", return_value=105):
+        assert cache.get("test-model", messages, None) == {"role": "assistant", "content": "hi"}
+        assert cache.get("test-model", messages, [{"type": "function"}]) is None
+    with mock.patch("banks.cache.completion.time.time", return_value=110):
+        assert cache.get("test-model", messages, None) is None
+
+
+def test_completion_cache_ignores_render_cache_ttl(monkeypatch):
+    monkeypatch.setenv("BANKS_RENDER_CACHE_TTL", "0.01")
+    cache = CompletionCache()
+    assert cache.backend.ttl == 0
+    messages = [{"role": "user", "content": "hello"}]
+    cache.set("test-model", messages, None, {"role": "assistant", "content": "hi"})
+    with mock.patch("banks.cache.time.monotonic", return_value=time.monotonic() + 60):
+        assert cache.get("test-model", messages, None) == {"role": "assistant", "content": "hi"}
+
+
+def test_completion_cache_config(monkeypatch):
+    assert Environment(extensions=[CompletionExtension]).completion_cache is None
+    monkeypatch.setenv("BANKS_COMPLETION_CACHE_ENABLED", "true")
+    monkeypatch.setenv("BANKS_COMPLETION_CACHE_TTL", "60")
+    assert Environment(extensions=[CompletionExtension]).completion_cache.ttl == 60
+
+
+@pytest.mark.parametrize(
+    "tag",
+    [
+        "{% completion cache=false %}{% endcompletion %}",
+        '{% completion model="m" cache="false" %}{% endcompletion %}',
+        '{% completion model="m" cache=maybe %}{% endcompletion %}',
+        '{% completion model="m" model="n" %}{% endcompletion %}',
+        '{% completion model="m" cache %}{% endcompletion %}',
+    ],
+)
+def test_completion_tag_invalid(tag):
+    with pytest.raises(TemplateSyntaxError, match="Invalid syntax for completion"):
+        Environment(extensions=[CompletionExtension]).from_string(tag)
+
+
+def test_completion_tag_cache_false(monkeypatch):
+    monkeypatch.setattr(env, "completion_cache", CompletionCache())
+    text = '{% completion model="test-model" cache=false %}{% chat role="user" %}hello{% endchat %}{% endcompletion %}'
+    with mock.patch("litellm.completion", return_value=_response("hi")) as mocked_completion:
+        # separate prompts, so that the second render isn't served from the render cache
+        assert Prompt(text).text() == "hi"
+        assert Prompt(text).text() == "hi"
+        assert mocked_completion.call_count == 2
+    assert env.completion_cache.stats().size == 0
+
+    with mock.patch("litellm.completion", return_value=_response("hi")) as mocked_completion:
+        text = text.replace(" cache=false", "")
+        assert Prompt(text).text() == "hi"
+        assert Prompt(text).text() == "hi"
+        assert mocked_completion.call_count == 1
+
+
+def test_completion_cache_sqlite(tmp_path):
+    messages = [{"role": "user", "content": "hello"}]
+    cache = CompletionCache(SQLiteCache(tmp_path / "completions.sqlite"))
+    cache.set("test-model", messages, None, {"role": "assistant", "content": "hi"})
+    cache.backend.close()
+
+    cache = CompletionCache(SQLiteCache(tmp_path / "completions.sqlite"))
+    assert cache.get("test-model", messages, None) == {"role": "assistant", "content": "hi"}
+
+
+def _sleepy(seconds, result):
+    def call():
+        time.sleep(seconds)
+        return result
+
+    return call
+
+
+def test_run_tool_calls_concurrently():
+    start = time.monotonic()
+    results = _run_tool_calls([_sleepy(0.3, "a"), _sleepy(0.1, "b"), _sleepy(0.2, "c")], 8, 0)
+    assert results == ["a", "b", "c"]
+    assert time.monotonic() - start < 0.55
+
+
+def test_run_tool_calls_concurrency_limit():
+    running = []
+    peak = []
+
+    def call():
+        running.append(1)
+        peak.append(len(running))
+        time.sleep(0.05)
+        running.pop()
+
+    _run_tool_calls([call] * 6, 2, 0)
+    assert max(peak) <= 2
+
+
+def test_run_tool_calls_timeout():
+    start = time.monotonic()
+    with pytest.raises(ToolCallError, match=r"Tool call 1 did not complete within 0\.2 seconds"):
+        _run_tool_calls([_sleepy(0, "a"), _sleepy(1, "b")], 8, 0.2)
+    assert time.monotonic() - start < 0.9
+
+    # queued calls get the whole timeout once they start
+    assert _run_tool_calls([_sleepy(0.15, "a"), _sleepy(0.15, "b")], 1, 0.2) == ["a", "b"]
+
+
+def test_run_tool_calls_error():
+    def fail():
+        msg = "boom"
+        raise RuntimeError(msg)
+
+    with pytest.raises(RuntimeError, match="boom"):
+        _run_tool_calls([_sleepy(0, "a"), fail], 8, 0)
+
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+
+def test_run_tool_calls_context():
+    def call():
+        return _request_id.get(), threading.current_thread()
+
+    token = _request_id.set("request-42")
+    try:
+        # one after the other, the calls stay in the caller's thread
+        assert _run_tool_calls([call, call], 1, 0) == [("request-42", threading.current_thread())] * 2
+        # in the pool, they see the caller's context
+        assert [request_id for request_id, _ in _run_tool_calls([call, call], 8, 0)] == ["request-42"] * 2
+        assert [request_id for request_id, _ in _run_tool_calls([call, call], 1, 5)] == ["request-42"] * 2
+    finally:
+        _request_id.reset(token)
+
+
+@pytest.mark.asyncio
+async def test_run_tool_calls_async():
+    start = time.monotonic()
+    results = await _run_tool_calls_async([_sleepy(0.3, "a"), _sleepy(0.1, "b"), _sleepy(0.2, "c")], 8, 0)
+    assert results == ["a", "b", "c"]
+    assert time.monotonic() - start < 0.55
+
+    with pytest.raises(ToolCallError, match="Tool call 0 did not complete"):
+        await _run_tool_calls_async([_sleepy(1, "a")], 8, 0.1)
+
+
+def test__do_completion_tool_messages_order(ext, jinja_context, mocked_choices_with_tools, tools):
+    ext._get_tool_callable = mock.MagicMock(
+        return_value=lambda location, **_: time.sleep(0.1 if location == "San Francisco" else 0) or location
+    )
+    ext._body_to_messages = mock.MagicMock(return_value=([ChatMessage(role="user", content="hello")], tools))
+    with mock.patch("litellm.completion") as mocked_completion:
+        mocked_completion.return_value.choices = mocked_choices_with_tools
+        ext._do_completion(jinja_context, "test-model", lambda: "")
+        tool_messages = [m for m in mocked_completion.call_args_list[1].kwargs["messages"] if m["role"] == "tool"]
+
+    assert [m["content"] for m in tool_messages] == ["San Francisco", "Tokyo", "Paris"]
+    assert [m["tool_call_id"] for m in tool_messages] == [
+        tool_call.id for tool_call in mocked_choices_with_tools[0].message.tool_calls
+    ]
+
+
+def test__do_completion_tool_calls_checked_first(ext, jinja_context, mocked_choices_with_tools, tools):
+    func = mock.MagicMock()
+    ext._get_tool_callable = mock.MagicMock(return_value=func)
+    mocked_choices_with_tools[0].message.tool_calls[2].function.name = None
+    with mock.patch("litellm.completion") as mocked_completion:
+        mocked_completion.return_value.choices = mocked_choices_with_tools
+        with pytest.raises(LLMError):
+            ext._do_completion(
+                jinja_context, "test-model", lambda: "test-sentinel:" + '{"role":"user", "content":"hi"}'
+            )
+    func.assert_not_called()
+
+
+async def _async_sleepy(seconds, result):
+    await asyncio.sleep(seconds)
+    return result
+
+
+@pytest.mark.asyncio
+async def test_run_tool_calls_async_coroutines():
+    threads = []
+
+    async def tool(seconds, result):
+        threads.append(threading.get_ident())
+        return await _async_sleepy(seconds, result)
+
+    start = time.monotonic()
+    calls = [partial(tool, 0.3, "a"), partial(tool, 0.1, "b"), _sleepy(0.2, "c")]
+    assert await _run_tool_calls_async(calls, 8, 0) == ["a", "b", "c"]
+    assert time.monotonic() - start < 0.55
+    # coroutine tools are awaited in the event loop
+    assert threads == [threading.get_ident()] * 2
+
+
+@pytest.mark.asyncio
+async def test_run_tool_calls_async_offloads_sync_tools():
+    ticks = []
+
+    async def ticker():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.02)
+
+    # a blocking tool doesn't stall the other coroutines
+    ticking = asyncio.ensure_future(ticker())
+    assert await _run_tool_calls_async([_sleepy(0.2, "a")], 8, 0) == ["a"]
+    await ticking
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.15
+
+
+@pytest.mark.asyncio
+async def test_run_tool_calls_async_coroutine_timeout():
+    cancelled = []
+
+    async def tool():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(ToolCallError, match="Tool call 0 did not complete"):
+        await _run_tool_calls_async([tool], 8, 0.1)
+    assert cancelled == [True]
+
+
+def test_run_tool_calls_coroutines():
+    assert _run_tool_calls([partial(_async_sleepy, 0, "a")], 8, 0) == ["a"]
+    assert _run_tool_calls([partial(_async_sleepy, 0.1, "a"), _sleepy(0, "b")], 8, 0) == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test__do_completion_async_coroutine_tool(ext, jinja_context, tools):
+    async def getenv(key):
+        await asyncio.sleep(0)
+        return f"value of {key}"
+
+    CompletionExtension.register_callable("getenv", getenv)
+    tool_call = ChatCompletionMessageToolCall(
+        id="call_1", function=Function(arguments='{"key": "HOME"}', name="getenv")
+    )
+    ext._body_to_messages = mock.MagicMock(return_value=([ChatMessage(role="user", content="hello")], tools))
+    with mock.patch(
+        "litellm.acompletion", side_effect=[_response(tool_calls=[tool_call]), _response("done")]
+    ) as mocked_completion:
+        assert await ext._do_completion_async(jinja_context, "test-model", lambda: "") == "done"
+        messages = mocked_completion.call_args_list[1].kwargs["messages"]
+
+    assert messages[-1]["role"] == "tool"
+    assert messages[-1]["content"] == "value of HOME"
+
+
+def _block(name, body):
+    return (
+        f'{{% set {name} %}}{{% completion model="test-model" %}}'
+        f'{{% chat role="user" %}}{body}{{% endchat %}}{{% endcompletion %}}{{% endset %}}\n'
+    )
+
+
+PREFETCHED_TEMPLATE = (
+    _block("a", "one {{ topic }}")
+    + _block("b", "two {{ topic }}")
+    + _block("c", "three {{ a }}")
+    + "{{ a }}|{{ b }}|{{ c }}"
+)
+
+
+def _echo(seconds, running, peak):
+    """A stand-in for the LLM, answering with the last message after `seconds`."""
+
+    def completion(model, messages, tools):
+        running.append(1)
+        peak.append(len(running))
+        time.sleep(seconds)
+        running.pop()
+        return _response(f"re {messages[-1]['content'][0]['text']}")
+
+    return completion
+
+
+@pytest.mark.parametrize(
+    ("text", "prefetched"),
+    [
+        (PREFETCHED_TEMPLATE, ["one T", "two T"]),
+        # variables assigned in the block itself don't make it depend on others
+        (_block("a", "{% for t in topics %}{{ t }}{% endfor %}") + _block("b", "two"), ["xy", "two"]),
+        # a single block has nothing to run alongside
+        (_block("a", "one"), []),
+        # neither have blocks that may not run
+        ("{% if x %}" + _block("a", "one") + "{% endif %}" + _block("b", "two"), ["two"]),
+        ("{% set t = 1 %}" + _block("a", "{{ t }}") + _block("b", "two"), ["two"]),
+        ('{% extends "base" %}' + _block("a", "one") + _block("b", "two"), []),
+    ],
+)
+def test_completion_prefetcher_blocks(text, prefetched):
+    environment = Environment(extensions=[ChatExtension, CompletionExtension])
+    blocks = CompletionPrefetcher(environment, text).blocks
+    assert len(blocks) == len(prefetched)
+    for block, content in zip(blocks, prefetched):
+        assert block.model_name == "test-model"
+        assert block.use_cache
+        assert content in block.body.render(topic="T", topics=["x", "y"])
+
+
+def test_completion_prefetch(monkeypatch):
+    monkeypatch.setattr(config, "COMPLETION_PREFETCH_ENABLED", True)
+    running, peak = [], []
+    with mock.patch("litellm.completion", side_effect=_echo(0.2, running, peak)) as mocked_completion:
+        start = time.monotonic()
+        assert Prompt(PREFETCHED_TEMPLATE).text({"topic": "T"}) == "re one T|re two T|re three re one T"
+        # the first two blocks run together, the last one waits for the first
+        assert time.monotonic() - start < 0.55
+        assert mocked_completion.call_count == 3
+    assert max(peak) == 2
+
+
+def test_completion_prefetch_disabled():
+    # prefetching is opt-in
+    running, peak = [], []
+    with mock.patch("litellm.completion", side_effect=_echo(0, running, peak)) as mocked_completion:
+        assert Prompt(PREFETCHED_TEMPLATE).text({"topic": "T"}) == "re one T|re two T|re three re one T"
+        assert mocked_completion.call_count == 3
+    assert max(peak) == 1
+
+
+def test_completion_prefetch_context(monkeypatch):
+    monkeypatch.setattr(config, "COMPLETION_PREFETCH_ENABLED", True)
+    monkeypatch.setattr(env, "completion_cache", None)
+    seen = []
+
+    def completion(**_):
+        seen.append(_request_id.get())
+        return _response("x")
+
+    token = _request_id.set("request-42")
+    try:
+        with mock.patch("litellm.completion", side_effect=completion):
+            Prompt(PREFETCHED_TEMPLATE).text({"topic": "T"})
+    finally:
+        _request_id.reset(token)
+    # the prefetched calls see the caller's context too
+    assert seen == ["request-42"] * 3
+
+
+def test_completion_prefetch_repeated_request(monkeypatch):
+    monkeypatch.setattr(config, "COMPLETION_PREFETCH_ENABLED", True)
+    monkeypatch.setattr(env, "completion_cache", None)
+    text = _block("a", "one") + _block("b", "one") + "{{ a }}|{{ b }}"
+    with mock.patch("litellm.completion", side_effect=[_response("x"), _response("y")]) as mocked_completion:
+        # without a cache, each block gets a response of its own
+        assert sorted(Prompt(text).text().split("|")) == ["x", "y"]
+        assert mocked_completion.call_count == 2
+
+    monkeypatch.setattr(env, "completion_cache", CompletionCache())
+    with mock.patch("litellm.completion", return_value=_response("x")) as mocked_completion:
+        assert Prompt(text).text() == "x|x"
+        assert mocked_completion.call_count == 1
+
+
+def _async_template(text):
+    environment = Environment(extensions=[ChatExtension, CompletionExtension], trim_blocks=True, enable_async=True)
+    template = environment.from_string(text)
+    template.globals[COMPLETION_PREFETCH_VAR] = CompletionPrefetcher(environment, text)
+    return template
+
+
+def test_completion_prefetcher_installed():
+    assert isinstance(Prompt(PREFETCHED_TEMPLATE)._template.globals[COMPLETION_PREFETCH_VAR], CompletionPrefetcher)
+    assert COMPLETION_PREFETCH_VAR not in Prompt("{{ topic }}")._template.globals
+
+
+@pytest.mark.asyncio
+async def test_completion_prefetch_async():
+    async def completion(model, messages, tools):
+        await asyncio.sleep(0.2)
+        return _response(f"re {messages[-1]['content'][0]['text']}")
+
+    template = _async_template(PREFETCHED_TEMPLATE)
+    prefetched = PrefetchedCompletions()
+    with mock.patch("litellm.acompletion", side_effect=completion) as mocked_completion:
+        start = time.monotonic()
+        rendered = await template.render_async(topic="T", **{COMPLETION_PREFETCHED_VAR: prefetched})
+        assert rendered == "re one T|re two T|re three re one T"
+        assert time.monotonic() - start < 0.55
+        assert mocked_completion.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_completion_prefetch_async_cancelled():
+    cancelled = []
+
+    async def completion(model, messages, tools):
+        text = messages[-1]["content"][0]["text"]
+        if text == "one":
+            await asyncio.sleep(0.1)
+            msg = "first block failed"
+            raise LLMError(msg)
+        if text == "two":
+            msg = "second block failed"
+            raise LLMError(msg)
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(text)
+            raise
+
+    errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda _, error: errors.append(error))
+    prefetched = PrefetchedCompletions()
+    text = _block("a", "one") + _block("b", "two") + _block("c", "three") + "{{ a }}|{{ b }}|{{ c }}"
+    with mock.patch("litellm.acompletion", side_effect=completion):
+        with pytest.raises(LLMError, match="first block failed"):
+            try:
+                await _async_template(text).render_async(**{COMPLETION_PREFETCHED_VAR: prefetched})
+            finally:
+                prefetched.cancel()
+        await asyncio.sleep(0)
+
+    # the call of the last block is cancelled, the error of the second one retrieved
+    assert cancelled == ["three"]
+    del prefetched
+    gc.collect()
+    assert errors == []
+
+
+def test_prefetched_completions_cancel():
+    pending, failed = Future(), Future()
+    failed.set_exception(LLMError("failed"))
+    prefetched = PrefetchedCompletions()
+    prefetched.calls = {"a": [pending], "b": [failed]}
+    assert prefetched.take("b") is failed
+    assert prefetched.take("b") is None
+    prefetched.cancel()
+    assert pending.cancelled()
+    assert prefetched.take("a") is None
@@ -0,0 +1,168 @@
+import fnmatch
+import time
+import zlib
+from unittest import mock
+
+import pytest
+
+from banks import Prompt
+from banks.cache import BatchRenderCache, SharedCache
+from banks.cache.redis import RedisCache
+
+
+class FakeRedis:
+    """In-memory stand-in for the subset of the Redis client the cache uses."""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.round_trips = 0
+        self.largest_pipeline = 0
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            del self.data[key]
+            del self.expires[key]
+        return key in self.data
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [self.data[k] if self._alive(k) else None for k in keys]
+
+    def set(self, key, value, px=None):
+        if px is not None and px <= 0:
+            msg = "invalid expire time in 'set' command"
+            raise ValueError(msg)
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if px:
+            self.expires[key] = time.monotonic() + px / 1000
+
+    def strlen(self, key):
+        return len(self.data[key]) if self._alive(key) else 0
+
+    def unlink(self, key):
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+    def scan_iter(self, match, count):  # noqa: ARG002
+        return [k for k in list(self.data) if self._alive(k) and fnmatch.fnmatch(k, match)]
+
+    def pipeline(self, transaction):  # noqa: ARG002
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        self.redis.round_trips += 1
+        self.redis.largest_pipeline = max(self.redis.largest_pipeline, len(self.commands))
+        commands, self.commands = self.commands, []
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+@pytest.fixture
+def client():
+    return FakeRedis()
+
+
+@pytest.fixture
+def cache(client):
+    return RedisCache(client=client)
+
+
+def test_get_set(cache, client):
+    cache.set({"foo": "bar"}, "My prompt")
+    assert cache.get({"foo": "bar"}) == "My prompt"
+    assert cache.get({"foo": "baz"}) is None
+    assert next(iter(client.data)).startswith("banks:render:")
+    assert cache.stats() == (1, 1, 0, 1, len(next(iter(client.data.values()))))
+
+
+def test_ttl(client):
+    cache = RedisCache(client=client, ttl=1.5)
+    cache.set({"foo": "bar"}, "My prompt")
+    assert cache.get({"foo": "bar"}) == "My prompt"
+    with mock.patch("time.monotonic", return_value=time.monotonic() + 2):
+        assert cache.get({"foo": "bar"}) is None
+
+
+def test_ttl_below_a_millisecond(client):
+    cache = RedisCache(client=client, ttl=0.0004)
+    cache.set({"foo": "bar"}, "My prompt")
+    # rounded up to the millisecond Redis counts in
+    assert cache.get({"foo": "bar"}) == "My prompt"
+    with mock.patch("time.monotonic", return_value=time.monotonic() + 0.002):
+        assert cache.get({"foo": "bar"}) is None
+
+
+def test_compression(client):
+    cache = RedisCache(client=client, compression="zlib")
+    prompt = "A rather repetitive prompt. " * 100
+    cache.set({"foo": "bar"}, prompt)
+    assert next(iter(client.data.values())) == b"zlib:" + zlib.compress(prompt.encode())
+    # entries are read with the codec they were stored with
+    assert RedisCache(client=client).get({"foo": "bar"}) == prompt
+
+
+def test_get_many_set_many(cache, client):
+    cache.set_many([({"n": i}, f"prompt {i}") for i in range(10)])
+    client.round_trips = 0
+    assert cache.get_many([{"n": 0}, {"n": 42}, {"n": 9}, {"tool": lambda: 1}]) == ["prompt 0", None, "prompt 9", None]
+    assert client.round_trips == 1
+    assert isinstance(cache, BatchRenderCache)
+
+
+def test_clear(cache, client):
+    client.set("other:key", b"value")
+    cache.set({"foo": "bar"}, "My prompt")
+    cache.clear()
+    assert cache.get({"foo": "bar"}) is None
+    assert list(client.data) == ["other:key"]
+
+
+def test_clear_in_batches(cache, client):
+    cache.set_many([({"n": n}, "My prompt") for n in range(5)])
+    client.round_trips = client.largest_pipeline = 0
+    with mock.patch("banks.cache.redis._CLEAR_BATCH_SIZE", 2):
+        cache.clear()
+    assert client.data == {}
+    assert client.round_trips == 3
+    assert client.largest_pipeline == 2
+
+
+def test_text_many(client):
+    p = Prompt("Hello {{ name }}", render_cache=SharedCache(RedisCache(client=client)))
+    names = [{"name": f"user {i}"} for i in range(10)]
+    assert list(p.text_many(names[:5])) == [f"Hello user {i}" for i in range(5)]
+
+    # another node finds the first renders, and gets the rest rendered and stored at once
+    p = Prompt(p.raw, render_cache=SharedCache(RedisCache(client=client)))
+    client.round_trips = 0
+    with mock.patch.object(p._template, "render", wraps=p._template.render) as mocked_render:
+        assert list(p.text_many(names)) == [f"Hello user {i}" for i in range(10)]
+        assert mocked_render.call_count == 5
+    assert client.round_trips == 2
+
+
+def test_redis_not_installed():
+    with mock.patch.dict("sys.modules", {"redis": None}):
+        with pytest.raises(ImportError, match="redis is not installed"):
+            RedisCache()
+
+
+@pytest.mark.redis
+def test_redis_server():
+    cache = RedisCache(prefix="banks:test:render:", ttl=60, compression="zlib")
+    cache.clear()
+    cache.set_many([({"n": 1}, "one"), ({"n": 2}, "two")])
+    assert cache.get_many([{"n": 1}, {"n": 2}, {"n": 3}]) == ["one", "two", None]
+    assert cache.stats().size == 2
+    cache.clear()
+    assert cache.get({"n": 1}) is None
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from banks.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "done"
+
+    with ThreadPoolExecutor(8) as pool:
+        leader = pool.submit(flights.do, "key", work)
+        started.wait(5)
+        followers = [pool.submit(flights.do, "key", work) for _ in range(7)]
+        # let the followers reach the running call before it completes
+        time.sleep(0.05)
+        release.set()
+        assert [f.result() for f in [leader, *followers]] == ["done"] * 8
+
+    assert calls == [1]
+    # the next call runs again
+    assert flights.do("key", lambda: "again") == "again"
+
+
+def test_single_flight_different_keys():
+    flights = SingleFlight()
+    assert flights.do("a", lambda: 1) == 1
+    assert flights.do("b", lambda: 2) == 2
+
+
+def test_single_flight_error():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        msg = "boom"
+        raise RuntimeError(msg)
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(flights.do, "key", fail)
+        started.wait(5)
+        follower = pool.submit(flights.do, "key", fail)
+        time.sleep(0.05)
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(RuntimeError, match="boom"):
+                future.result()
+
+    assert flights._calls == {}
+
+
+@pytest.mark.asyncio
+async def test_async_single_flight():
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "done"
+
+    assert await asyncio.gather(*[flights.do("key", work) for _ in range(8)]) == ["done"] * 8
+    assert calls == [1]
+    assert flights._calls == {}
+
+
+@pytest.mark.asyncio
+async def test_async_single_flight_error():
+    flights = AsyncSingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        msg = "boom"
+        raise RuntimeError(msg)
+
+    results = await asyncio.gather(*[flights.do("key", fail) for _ in range(3)], return_exceptions=True)
+    assert [str(r) for r in results] == ["boom"] * 3
+
+
+@pytest.mark.asyncio
+async def test_async_single_flight_cancelled_caller():
+    flights = AsyncSingleFlight()
+    release = asyncio.Event()
+
+    async def work():
+        await release.wait()
+        return "done"
+
+    leader = asyncio.ensure_future(flights.do("key", work))
+    follower = asyncio.ensure_future(flights.do("key", work))
+    await asyncio.sleep(0)
+    leader.cancel()
+    release.set()
+
+    # cancelling the first caller doesn't cancel the work the others wait for
+    assert await follower == "done"
+    with pytest.raises(asyncio.CancelledError):
+        await leader
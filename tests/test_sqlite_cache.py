@@ -0,0 +1,147 @@
+import multiprocessing
+import sqlite3
+from unittest import mock
+
+import pytest
+
+from banks import Prompt
+from banks.cache import SharedCache
+from banks.cache.codecs import get_codec
+from banks.cache.sqlite import SQLiteCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.sqlite", batch_size=2, flush_interval=60)
+    yield cache
+    cache.close()
+
+
+def _rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT key, value, codec FROM renders").fetchall()
+    finally:
+        conn.close()
+
+
+def test_get_set(cache):
+    cache.set({"foo": "bar"}, "My prompt")
+    assert cache.get({"foo": "bar"}) == "My prompt"
+    assert cache.get({"foo": "baz"}) is None
+    assert cache.stats()[:4] == (1, 1, 0, 1)
+
+
+def test_wal(cache):
+    conn = sqlite3.connect(cache.path)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    conn.close()
+
+
+def test_batched_writes(cache):
+    cache.set({"n": 1}, "one")
+    assert _rows(cache.path) == []
+    # buffered entries are served before being written
+    assert cache.get({"n": 1}) == "one"
+    cache.set({"n": 2}, "two")
+    assert len(_rows(cache.path)) == 2
+
+
+def test_flush_interval(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.sqlite", flush_interval=10)
+    with mock.patch("banks.cache.sqlite.time.monotonic", return_value=cache._last_flush + 11):
+        cache.set({"n": 1}, "one")
+    assert len(_rows(cache.path)) == 1
+
+
+def test_persistence(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    cache = SQLiteCache(path)
+    cache.set({"foo": "bar"}, "My prompt")
+    del cache
+
+    assert SQLiteCache(path).get({"foo": "bar"}) == "My prompt"
+
+
+def test_max_bytes(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.sqlite", max_bytes=1000, batch_size=1)
+    cache.set({"n": 1}, "x" * 400)
+    cache.set({"n": 2}, "x" * 400)
+    # touch the first entry so that the second is the least recently used
+    with mock.patch("banks.cache.sqlite.time.time", return_value=1e10):
+        assert cache.get({"n": 1}) is not None
+        cache.flush()
+    cache.set({"n": 3}, "x" * 400)
+
+    assert cache.get({"n": 2}) is None
+    assert cache.get({"n": 1}) is not None
+    stats = cache.stats()
+    assert stats.evictions == 1
+    assert stats.bytes <= 1000
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_compression(tmp_path, compression):
+    cache = SQLiteCache(tmp_path / "cache.sqlite", compression=compression)
+    prompt = "A rather repetitive prompt. " * 100
+    cache.set({"foo": "bar"}, prompt)
+    cache.flush()
+    ((_, value, codec),) = _rows(cache.path)
+    assert codec == compression
+    assert value == get_codec(compression).compress(prompt.encode())
+    # entries are read with the codec they were stored with
+    assert SQLiteCache(cache.path).get({"foo": "bar"}) == prompt
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError, match="Unknown codec"):
+        SQLiteCache(tmp_path / "cache.sqlite", compression="lzma")
+
+
+def test_clear(cache):
+    cache.set({"n": 1}, "one")
+    cache.set({"n": 2}, "two")
+    cache.set({"n": 3}, "three")
+    cache.clear()
+    assert cache.get({"n": 1}) is None
+    assert cache.stats().size == 0
+
+
+def test_prompt(tmp_path):
+    cache = SharedCache(SQLiteCache(tmp_path / "cache.sqlite"))
+    p = Prompt('{% chat role="user" %}Hello {{ name }}{% endchat %}', render_cache=cache)
+    messages = p.chat_messages({"name": "Ada"})
+    cache.backend.close()
+
+    # a new prompt, as a restarted worker would have, finds the render in the database
+    p = Prompt(p.raw, render_cache=SharedCache(SQLiteCache(tmp_path / "cache.sqlite")))
+    with mock.patch.object(p._template, "render") as mocked_render:
+        assert p.chat_messages({"name": "Ada"}) == messages
+        mocked_render.assert_not_called()
+
+
+def _worker(path, worker, n):
+    cache = SQLiteCache(path, batch_size=5, timeout=60)
+    for i in range(n):
+        cache.set({"worker": worker, "i": i}, f"prompt {worker} {i}")
+        # reads interleave with the writes of the other processes
+        cache.get({"worker": (worker + 1) % 3, "i": i})
+    cache.close()
+    # entries are read back from the database, not from the buffer
+    cache = SQLiteCache(path, timeout=60)
+    return sum(cache.get({"worker": worker, "i": i}) == f"prompt {worker} {i}" for i in range(n))
+
+
+def test_multiple_processes(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    SQLiteCache(path)
+    n = 50
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(3) as pool:
+        results = pool.starmap(_worker, [(path, worker, n) for worker in range(3)])
+
+    assert results == [n, n, n]
+    cache = SQLiteCache(path)
+    assert cache.stats().size == 3 * n
+    for worker in range(3):
+        assert cache.get({"worker": worker, "i": n - 1}) == f"prompt {worker} {n - 1}"
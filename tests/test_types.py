@@ -3,7 +3,16 @@ from pathlib import Path
 
 import pytest
 
-from banks.types import ImageUrl, InputAudio
+from banks.types import (
+    CONTENT_BLOCK_END,
+    ChatMessage,
+    ContentBlock,
+    ImageUrl,
+    InputAudio,
+    chat_message_from_text,
+    content_block_start,
+    copy_chat_messages,
+)
 
 
 def test_image_url_from_base64():
@@ -88,3 +97,56 @@ def test_input_audio_from_path_outside_cwd():
     """Test that paths outside CWD are rejected"""
     with pytest.raises(ValueError, match="Access denied"):
         InputAudio.from_path(Path("/etc/hosts"))
+
+
+def _block(sentinel, block):
+    return content_block_start(sentinel) + block.model_dump_json() + CONTENT_BLOCK_END
+
+
+def test_chat_message_from_text_blocks(sentinel):
+    image = ContentBlock.model_validate({"type": "image_url", "image_url": {"url": "http://example.com/a.png"}})
+    content = f"Look at this:\n{_block(sentinel, image)}{_block(sentinel, image)}\n  and this  "
+    message = chat_message_from_text(role="user", content=content, sentinel=sentinel)
+    assert [b.type for b in message.content] == ["text", "image_url", "image_url", "text"]
+    assert message.content[0].text == "Look at this:"
+    assert message.content[1] == image
+    assert message.content[3].text == "and this"
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "{start}not json{end} text",
+        '{start}{{"type": "text",\n"text": "newline"}}{end}',
+        '{start}{{"type": "text", "text": "no end"}}',
+        "text {start}",
+    ],
+)
+def test_chat_message_from_text_invalid_markers(sentinel, content):
+    content = content.format(start=content_block_start(sentinel), end=CONTENT_BLOCK_END)
+    message = chat_message_from_text(role="user", content=content, sentinel=sentinel)
+    assert [(b.type, b.text) for b in message.content] == [("text", content.strip())]
+
+
+def test_chat_message_from_text_no_sentinel(sentinel):
+    block = ContentBlock.model_validate({"type": "text", "text": "hi"})
+    content = _block(sentinel, block)
+    assert chat_message_from_text(role="user", content=content).content[0].text == content
+    # a marker carrying another sentinel is just text too
+    assert chat_message_from_text(role="user", content=content, sentinel="other").content[0].text == content
+
+
+def test_copy_chat_messages():
+    messages = [
+        ChatMessage(role="system", content="Be brief"),
+        ChatMessage(role="user", content=[ContentBlock(type="image_url", image_url=ImageUrl(url="https://x.y/z.png"))]),
+    ]
+    copies = copy_chat_messages(messages)
+    assert copies == messages
+    assert copies[1].model_fields_set == messages[1].model_fields_set
+
+    copies[0].content = "Be verbose"
+    copies[1].content[0].image_url.url = "https://x.y/w.png"
+    copies[1].content.append(ContentBlock(type="text", text="What's this?"))
+    assert messages[0].content == "Be brief"
+    assert messages[1].content == [ContentBlock(type="image_url", image_url=ImageUrl(url="https://x.y/z.png"))]
@@ -1,7 +1,13 @@
 import pytest
 import regex as re
 
-from banks.utils import generate_canary_word, parse_params_from_docstring, python_type_to_jsonschema, strtobool
+from banks.utils import (
+    SentinelStripper,
+    generate_canary_word,
+    parse_params_from_docstring,
+    python_type_to_jsonschema,
+    strtobool,
+)
 
 
 def test_generate_canary_word_defaults():
@@ -110,3 +116,28 @@ def test_parse_params_from_docstring_sphinx():
 
 def test_parse_params_from_docstring_empty():
     assert parse_params_from_docstring("") == {}
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        ["Hello S3NT1N3L world"],
+        ["Hello S3N", "T1N3L world"],
+        ["Hello S", "3", "N", "T", "1", "N", "3", "L", " world"],
+        ["S3NT1N3LHello", " world", "S3NT1N3L"],
+        ["Hello S3N", "T1NEL world S3NT1N3", ""],
+        ["SS3NT1N3LS3", "NT1N3LL"],
+        ["S3NT1S3NT1N3L", "N3L"],
+    ],
+)
+def test_sentinel_stripper(chunks):
+    stripper = SentinelStripper("S3NT1N3L")
+    streamed = "".join(stripper.feed(chunk) for chunk in chunks) + stripper.flush()
+    assert streamed == "".join(chunks).replace("S3NT1N3L", "")
+
+
+def test_sentinel_stripper_holds_back_only_prefixes():
+    stripper = SentinelStripper("S3NT1N3L")
+    assert stripper.feed("Hello S3N") == "Hello "
+    assert stripper.feed("ice") == "S3Nice"
+    assert stripper.flush() == ""